@@ -0,0 +1,541 @@
+'''
+Benchmarks for the particle pipeline.
+Every benchmark is timed for a grid of parameters (particle counts,
+grid intervals, ...). Results are saved as json and compared with a
+stored baseline: a benchmark slower than baseline * (1 + tolerance)
+makes the run fail.
+
+usage:
+python bench.py                   run, compare with bench_baseline.json
+python bench.py --save-baseline   run and store the results as baseline
+python bench.py --quick -k render only small sizes of matching benchmarks
+'''
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # no window needed
+
+import pygame
+
+from utils import *
+from game import *
+from control import *
+
+BASELINE_PATH = "bench_baseline.json"
+OUTPUT_PATH = "bench_results.json"
+DEFAULT_TOLERANCE = 0.25
+
+
+class OwnerStub(ParticleOwnerBase):
+    ''' owner of the core of a benchmark player '''
+
+    def getForce(self, particle):
+        return Vec2d()
+
+
+def buildManager(particles, interval=10, columnar=True, seed=0, workers=0,
+                 historyStride=None):
+    '''
+    a 640x480 world with one player and the given number of particles
+    scattered around it, committed to the manager
+    '''
+    manager = ParticleManager((640, 480), (interval, interval),
+                              columnar=columnar, workers=workers,
+                              historyStride=historyStride)
+    player = Player("bench", manager, OwnerStub("core"),
+                    (255, 0, 0), (320, 240))
+    rand = random.Random(seed)
+    group = ParticleGroup()
+    for i in range(particles):
+        group.append(ParticleState(
+            owner=player,
+            mass=1 + rand.random() / 5,
+            pos=Vec2d((rand.uniform(0, 640), rand.uniform(0, 480)))
+        ))
+    manager.addParticlesToBuffer(group)
+    manager.commitParticles()
+    return manager, player
+
+
+def benchVec2d(count, inPlace):
+    a = Vec2d((1.5, 2.5))
+    b = Vec2d((0.5, -1.0))
+    scratch = Vec2d()
+
+    def run():
+        for i in range(count):
+            c = (a + b) * 0.5 - b / 2.0
+            c.length()
+
+    def runInPlace():
+        for i in range(count):
+            c = scratch.set(a.x, a.y)
+            c += b
+            c *= 0.5
+            c.scaledAdd(b, -0.5)
+            c.length()
+    return runInPlace if inPlace else run
+
+
+def benchStateStep(particles):
+    manager, player = buildManager(particles, columnar=False)
+    group = ParticleGroup(manager.frame.group)
+
+    def run():
+        group.physicalStepCopy()
+    return run
+
+
+def benchFrameStep(particles, interval, columnar):
+    manager, player = buildManager(particles, interval, columnar)
+
+    def run():
+        manager.frame.step()
+    return run
+
+
+def benchFrameBackward(particles, interval, columnar):
+    manager, player = buildManager(particles, interval, columnar)
+    for i in range(30):
+        manager.frame.step()
+
+    def getPeriod(key):
+        dist = abs(key[0] - 320) + abs(key[1] - 240)
+        return 5 if 20 < dist < 100 else 0
+
+    def run():
+        manager.frame.backward(getPeriod)
+        manager.frame.step()
+    return run
+
+
+def benchParallelStep(particles, workers):
+    manager, player = buildManager(particles, workers=workers)
+
+    def run():
+        manager.frame.step()
+    return run
+
+
+def benchUpdateStatistics(particles, columnar):
+    manager, player = buildManager(particles, columnar=columnar)
+
+    def run():
+        manager.updateStatistics()
+    return run
+
+
+def benchRingSkill(particles, interval):
+    manager, player = buildManager(particles, interval)
+    skill = RingSkill(player)
+    for i in range(30):
+        manager.step()
+
+    def run():
+        skill.useSkillOn(manager)
+        manager.step()
+    return run
+
+
+def benchSkillBatch(particles, skills, batched):
+    '''
+    frame where skills rings are used at once, around points spread over
+    the world: queued and rewound in one pass, or each rewound on its own
+    '''
+    manager, player = buildManager(particles, columnar=True)
+    for i in range(30):
+        manager.step()
+    points = [(320 + 200 * cos(2 * pi * i / skills),
+               240 + 150 * sin(2 * pi * i / skills)) for i in range(skills)]
+    rings = [manager.grid.queryAnnulus(point, 20, 100, manhattan=True)
+             for point in points]
+
+    def run():
+        for cells in rings:
+            if batched:
+                manager.queueBackwardCells(cells, 50)
+            else:
+                manager.backwardCells(cells, 50)
+        manager.step()
+    return run
+
+
+def benchTimeField(particles, skills, field):
+    '''
+    frame where skills rings are used at once, their rewind depths given
+    by a getPeriod callback asked about every container, or drawn on a
+    TimeField and rewound in one vectorized pass
+    '''
+    manager, player = buildManager(particles, columnar=True)
+    for i in range(30):
+        manager.step()
+    points = [(320 + 200 * cos(2 * pi * i / skills),
+               240 + 150 * sin(2 * pi * i / skills)) for i in range(skills)]
+
+    def getPeriod(key):
+        period = 0
+        for x, y in points:
+            dist = abs(x - key[0]) + abs(y - key[1])
+            if 20 < dist < 100:
+                period += 50
+        return period
+
+    def run():
+        if field:
+            effects = TimeField(manager.grid)
+            for point in points:
+                effects.ring(point, 20, 100, 50, manhattan=True)
+            manager.backwardField(effects)
+        else:
+            manager.backward(getPeriod)
+        manager.step()
+    return run
+
+
+def benchEmitter(particles, columnar):
+    '''
+    frame of a player emitting particles / 100 per frame that live 100
+    frames: spawn, despawn and step at steady state
+    '''
+    manager, player = buildManager(0, columnar=columnar)
+    player.timeToLive = 100
+    player.emitter = ParticleEmitter(player, particles / 100)
+    for i in range(player.timeToLive + 10):
+        player.step()
+        manager.step()
+
+    def run():
+        player.step()
+        manager.step()
+    return run
+
+
+def benchInteractions(particles):
+    '''
+    interaction kernel of two owners with particles scattered over the
+    world: neighbour lists, annihilation, capture and repulsion
+    '''
+    manager = ParticleManager((640, 480), (10, 10), columnar=True)
+    rand = np.random.RandomState(0)
+    for identity in ("a", "b"):
+        manager.spawn(OwnerStub(identity),
+                      rand.uniform((0, 0), (640, 480), (particles // 2, 2)))
+    engine = InteractionEngine()
+    pos, vel, mass, ownerIndex, owners = manager.ownerColumns()
+    side, representative, sides = engine.sides(ownerIndex, owners)
+
+    def run():
+        engine.compute(manager.grid, pos, mass, side, sides)
+    return run
+
+
+# frames and particles the accuracy of integrators is measured on
+ACCURACY_FRAMES = 40
+ACCURACY_PARTICLES = 1000
+# reference trajectory: RK4 with this many substeps per frame
+ACCURACY_SUBSTEPS = 64
+
+
+def integratorAccuracy(integrator):
+    '''
+    {"error", "evaluations"}: mean distance of particles stepped by
+    integrator to the reference trajectory over ACCURACY_FRAMES frames,
+    falling onto a player with the velocities and masses they spawn with,
+    and evaluations of forces per particle and frame
+    '''
+    manager, player = buildManager(ACCURACY_PARTICLES)
+    store = manager.frame.group
+    rand = np.random.RandomState(0)
+    store.columns()[1][:] = rand.normal(0, 2, (len(store), 2))
+    store.columns()[3][:] = rand.uniform(0.8, 1.2, len(store))
+    reference = store.copy()
+    stepped = store.copy()
+    rk4 = RungeKutta4()
+    evaluations = [0]
+    accelerationOf = stepped.accelerationOf
+
+    def countingAccelerationOf(rows):
+        accel = accelerationOf(rows)
+
+        def counted(pos, vel):
+            evaluations[0] += len(pos)
+            return accel(pos, vel)
+        return counted
+    stepped.accelerationOf = countingAccelerationOf
+    error = 0
+    for frame in range(ACCURACY_FRAMES):
+        for i in range(ACCURACY_SUBSTEPS):
+            reference.physicalStep(1 / ACCURACY_SUBSTEPS, rk4)
+        stepped.physicalStep(1, integrator)
+        delta = stepped.columns()[0] - reference.columns()[0]
+        error += np.sqrt(delta[:, 0]**2 + delta[:, 1]**2).mean()
+    return {"error": error / ACCURACY_FRAMES,
+            "evaluations": evaluations[0] / ACCURACY_FRAMES / len(store)}
+
+
+def benchIntegrator(particles, integrator):
+    '''
+    frame step with the given integrator (a name of INTEGRATORS),
+    reporting its accuracy (see integratorAccuracy)
+    '''
+    manager, player = buildManager(particles)
+    manager.frame.integrator = INTEGRATORS[integrator]()
+
+    def run():
+        manager.frame.step()
+    run.metrics = integratorAccuracy(INTEGRATORS[integrator]())
+    return run
+
+
+# frames simulated before measuring rewinds, and rewind periods measured
+HISTORY_FRAMES = 60
+HISTORY_PERIODS = range(1, 41)
+
+
+def historyAccuracy(particles, stride):
+    '''
+    {"bytes", "error", "misplaced"} of history sampled every stride
+    frames after HISTORY_FRAMES frames: its size, and over rewinds of
+    HISTORY_PERIODS, the mean distance of rewound particles to where
+    they were and the share of them restored by another container
+    '''
+    managers = [buildManager(particles, historyStride=stride)[0]
+                for stride in (1, stride)]
+    for manager in managers:
+        # born frames tell particles apart
+        manager.frame.group.columns()[5][:] = np.arange(particles)
+        for i in range(HISTORY_FRAMES):
+            manager.step()
+    exact, sampled = [manager.frame.history for manager in managers]
+    error = 0
+    misplaced = 0
+    for period in HISTORY_PERIODS:
+        frame = exact.frame - period
+        rows = []
+        for history in (exact, sampled):
+            keys = list(history.keyFrames)
+            groups = [history.groupAt(frame, key) for key in keys]
+            store = ParticleStore.concat(groups)
+            cell = np.repeat([managers[0].grid.indexOf(key) for key in keys],
+                             [len(group) for group in groups])
+            order = np.argsort(store.columns()[5])
+            rows.append((store.columns()[0][order], cell[order]))
+        (exactPos, exactCell), (pos, cell) = rows
+        delta = pos - exactPos
+        error += np.sqrt(delta[:, 0]**2 + delta[:, 1]**2).mean()
+        misplaced += (cell != exactCell).mean()
+    periods = len(HISTORY_PERIODS)
+    return {"bytes": sampled.bytes, "error": error / periods,
+            "misplaced": misplaced / periods}
+
+
+def benchHistoryStride(particles, stride):
+    '''
+    frame step keeping a history sample every stride frames, reporting
+    the accuracy of rewinds against the memory used (historyAccuracy)
+    '''
+    manager, player = buildManager(particles, historyStride=stride)
+
+    def run():
+        manager.step()
+    run.metrics = historyAccuracy(particles, stride)
+    return run
+
+
+def benchRender(particles, batch):
+    if pygame.display.get_surface() == None:
+        pygame.display.init()
+        pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0, 32)
+    manager, player = buildManager(particles, columnar=True)
+    renderer = ParticleRenderer(manager, batch=batch)
+
+    def run():
+        renderer.render()
+    return run
+
+
+# name -> (setup, full parameter grid, quick parameter grid)
+BENCHMARKS = {
+    "vec2d": (benchVec2d,
+              {"count": [10000], "inPlace": [False, True]},
+              {"count": [1000], "inPlace": [False, True]}),
+    "stateStep": (benchStateStep,
+                  {"particles": [1000, 5000]},
+                  {"particles": [200]}),
+    "frameStep": (benchFrameStep,
+                  {"particles": [1000, 5000], "interval": [10, 5],
+                   "columnar": [False, True]},
+                  {"particles": [200], "interval": [10],
+                   "columnar": [False, True]}),
+    "frameBackward": (benchFrameBackward,
+                      {"particles": [1000, 5000], "interval": [10, 5],
+                       "columnar": [False, True]},
+                      {"particles": [200], "interval": [10],
+                       "columnar": [False, True]}),
+    "parallelStep": (benchParallelStep,
+                     {"particles": [20000, 100000], "workers": [0, 4]},
+                     {"particles": [20000], "workers": [0, 2]}),
+    "updateStatistics": (benchUpdateStatistics,
+                         {"particles": [1000, 5000],
+                          "columnar": [False, True]},
+                         {"particles": [200], "columnar": [True]}),
+    "ringSkill": (benchRingSkill,
+                  {"particles": [1000, 5000], "interval": [10, 5]},
+                  {"particles": [200], "interval": [10]}),
+    "skillBatch": (benchSkillBatch,
+                   {"particles": [5000, 20000], "skills": [1, 4, 8],
+                    "batched": [False, True]},
+                   {"particles": [1000], "skills": [4],
+                    "batched": [False, True]}),
+    "timeField": (benchTimeField,
+                  {"particles": [5000, 20000], "skills": [1, 8],
+                   "field": [False, True]},
+                  {"particles": [1000], "skills": [4],
+                   "field": [False, True]}),
+    "emitter": (benchEmitter,
+                {"particles": [1000, 10000], "columnar": [False, True]},
+                {"particles": [1000], "columnar": [True]}),
+    "interactions": (benchInteractions,
+                     {"particles": [1000, 10000, 50000]},
+                     {"particles": [1000]}),
+    "integrator": (benchIntegrator,
+                   {"particles": [1000, 10000],
+                    "integrator": sorted(INTEGRATORS)},
+                   {"particles": [1000], "integrator": sorted(INTEGRATORS)}),
+    "historyStride": (benchHistoryStride,
+                      {"particles": [1000, 10000], "stride": [1, 2, 4, 8]},
+                      {"particles": [1000], "stride": [1, 4]}),
+    "render": (benchRender,
+               {"particles": [1000, 10000], "batch": [False, True]},
+               {"particles": [200], "batch": [False, True]}),
+}
+
+
+def caseName(name, params):
+    return name + "[" + ",".join(
+        "{0}={1}".format(key, params[key]) for key in sorted(params)) + "]"
+
+
+def timeCase(run, repeats, minTime):
+    '''
+    call run() until it ran repeats times and at least minTime seconds,
+    return sorted per-call times. The garbage collector is paused while
+    timing, like timeit does.
+    '''
+    run()  # warm up
+    times = []
+    total = 0
+    gc.collect()
+    gc.disable()
+    try:
+        while len(times) < repeats or total < minTime:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            times.append(elapsed)
+            total += elapsed
+            if len(times) >= 10 * repeats:
+                break
+    finally:
+        gc.enable()
+    return sorted(times)
+
+
+def runBenchmarks(pattern=None, quick=False, repeats=5, minTime=0.2):
+    results = {}
+    for name, (setup, grid, quickGrid) in BENCHMARKS.items():
+        if pattern != None and pattern not in name:
+            continue
+        grid = quickGrid if quick else grid
+        keys = sorted(grid)
+        for values in itertools.product(*[grid[key] for key in keys]):
+            params = dict(zip(keys, values))
+            run = setup(**params)
+            times = timeCase(run, repeats, minTime)
+            case = caseName(name, params)
+            results[case] = {
+                "benchmark": name,
+                "params": params,
+                "repeats": len(times),
+                "min": times[0],
+                "median": times[len(times) // 2],
+                "mean": sum(times) / len(times)
+            }
+            # other measures a benchmark reports, e.g. accuracy
+            metrics = getattr(run, "metrics", {})
+            results[case].update(metrics)
+            print("{0:<60} median {1:9.3f} ms".format(
+                case, results[case]["median"] * 1000) + "".join(
+                " {0} {1:.4g}".format(key, value)
+                for key, value in sorted(metrics.items())))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    return (case, ratio) of cases slower than baseline by more than
+    tolerance, ratio being current / baseline fastest time
+    (the least noisy statistic)
+    '''
+    regressions = []
+    for case, result in results.items():
+        reference = baseline.get(case)
+        if reference == None or reference["min"] <= 0:
+            continue
+        ratio = result["min"] / reference["min"]
+        print("{0:<60} {1:6.2f}x baseline".format(case, ratio))
+        if ratio > 1 + tolerance:
+            regressions.append((case, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="particle benchmarks")
+    parser.add_argument("-k", dest="pattern", default=None,
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true",
+                        help="small parameter grid, for smoke runs")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=OUTPUT_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown, 0.25 means 25%%")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.pattern, args.quick, args.repeats)
+    report = {
+        "machine": platform.platform(),
+        "python": platform.python_version(),
+        "time": time.time(),
+        "results": results
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=1)
+        print("baseline saved to", args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline at", args.baseline, "- nothing to compare")
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    for case, ratio in regressions:
+        print("REGRESSION: {0} is {1:.2f}x slower".format(case, ratio))
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
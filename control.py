@@ -1,46 +1,162 @@
+import copy
 import os
+import zlib
+from collections import defaultdict, OrderedDict
 
 import pygame
 from pygame.locals import *
 
 from utils import *
 from game import *
+from profiler import *
+from snapshot import *
 from math import sqrt
 
+import numpy as np
+
 CONTROLLER_UPDATE_FPS = 40
 WORLD_HEIGHT = 480
 WORLD_WIDTH = 640
 HEIGHT_INTERVAL = 10
 WIDTH_INTERVAL = 10
+# keep particles in a columnar store (see ParticleStore)
+COLUMNAR_PARTICLES = True
+# render particles in one vectorized pass (see ParticleRenderer)
+BATCH_RENDERING = True
+# only compose and update changed areas of the screen (see LayerManager)
+DIRTY_RECTS = True
+# threads stepping particles by tiles, 0 steps them on the game thread
+PARALLEL_WORKERS = 0
+# particles every player emits per frame (0: none), and frames they live
+# (None: until they leave the world)
+PLAYER_SPAWN_RATE = 0
+PLAYER_PARTICLE_TIME_TO_LIVE = None
+# frames between samples of particle history (1: every frame, exact
+# rewinds), see FrameHistory
+PARTICLE_HISTORY_STRIDE = 1
+# how particles are stepped, a name of INTEGRATORS in integrate.py,
+# None for explicit Euler with one force evaluation per frame
+PARTICLE_INTEGRATOR = None
+# particles of the two players repel, annihilate and capture each other
+PARTICLE_INTERACTIONS = False
+# print the profiler and frame pacing summaries every few seconds
+PROFILE_CONSOLE_REPORT = False
+# F3 toggles the profiler overlay, F4 starts / stops writing a trace here
+PROFILE_TRACE_PATH = "trace.json"
+# images are found here, by file name without extension (any case)
+RESOURCE_DIRECTORY = "resources"
+RESOURCE_EXTENSIONS = (".png", ".bmp", ".jpg", ".jpeg", ".gif", ".tga")
+# scaled / rotated images and circle stamps kept at most
+RESOURCE_CACHE_SIZE = 64
 
 
 def blitCentering(dest, image, pos):
     x, y = pos
     x = x - image.get_width()/2
     y = y - image.get_height()/2
-    dest.blit(image, (x, y))
+    return dest.blit(image, (x, y))
 
 
 class ResourcePack():
-    # TODO: implement auto loading from resource directory
-    def __init__(self):
+    '''
+    Images of the resource directory, scanned once and loaded on first use.
+    Surfaces are converted to the display format as they are loaded (when
+    a display is set), so blitting them needs no per-pixel conversion.
+    Scaled / rotated images and circle stamps are made on demand and kept
+    in a cache of at most cacheSize entries, least recently used go first.
+    '''
+
+    def __init__(self, directory=None, cacheSize=None):
+        self.directory = optional(directory, RESOURCE_DIRECTORY)
+        self.cacheSize = optional(cacheSize, RESOURCE_CACHE_SIZE)
+        self.files = None  # lower case name -> path, see scan
         self.resources = {}
+        self.cache = OrderedDict()  # key -> derived surface
+        self.hits = 0
+        self.misses = 0
+
+    def scan(self):
+        ''' index image files of the directory, once '''
+        if self.files != None:
+            return self.files
+        self.files = {}
+        if os.path.isdir(self.directory):
+            for filename in sorted(os.listdir(self.directory)):
+                name, extension = os.path.splitext(filename)
+                if extension.lower() in RESOURCE_EXTENSIONS:
+                    self.files.setdefault(
+                        name.lower(), os.path.join(self.directory, filename))
+        return self.files
+
+    @staticmethod
+    def convert(surface):
+        ''' surface in the display format, kept as is without a display '''
+        if pygame.display.get_surface() == None:
+            return surface
+        if surface.get_flags() & pygame.SRCALPHA:
+            return surface.convert_alpha()
+        return surface.convert()
 
     def loadImage(self, name, **args):
         '''
+        load an image now instead of on first use
         param:
-        directory - folder the image file is in(default: "resources")
+        directory - folder the image file is in(default: the pack directory)
         filename - image filename(default: combine name & extension)
         extension - image file format(default: "png")
         '''
-        directory = args.get("directory", "resources")
-        extension = args.get("extension", "png")
-        filename = args.get("filename", name + "." + extension)
-        self.resources[name] = pygame.image.load(
-            os.path.join(directory, filename))
-
-    def getImage(self, name):
-        return self.resources.get(name)
+        if len(args) == 0 and name.lower() in self.scan():
+            path = self.files[name.lower()]
+        else:
+            directory = args.get("directory", self.directory)
+            extension = args.get("extension", "png")
+            filename = args.get("filename", name + "." + extension)
+            path = os.path.join(directory, filename)
+        self.resources[name] = self.convert(pygame.image.load(path))
+        return self.resources[name]
+
+    def getImage(self, name, scale=1, angle=0):
+        '''
+        image by name, loaded on first use; None if there is no such image.
+        scale, angle - zoom factor and degrees counterclockwise, variants
+        are cached
+        '''
+        image = self.resources.get(name)
+        if image == None:
+            if name.lower() not in self.scan():
+                return None
+            image = self.loadImage(name)
+        if scale == 1 and angle == 0:
+            return image
+        return self.cached(("image", name, scale, angle),
+                           lambda: pygame.transform.rotozoom(
+                               image, angle, scale))
+
+    def getStamp(self, radius, color, width=0):
+        '''
+        surface holding pygame.draw.circle(..., radius, width) centred at
+        (radius + 1, radius + 1), transparent elsewhere
+        '''
+        def draw():
+            size = 2 * radius + 3
+            surface = pygame.Surface((size, size), pygame.SRCALPHA)
+            pygame.draw.circle(surface, color, (radius + 1, radius + 1),
+                               radius, width)
+            return self.convert(surface)
+        return self.cached(("stamp", radius, tuple(color), width), draw)
+
+    def cached(self, key, make):
+        surface = self.cache.get(key)
+        if surface != None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = make()
+        self.cache[key] = surface
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return surface
 
 
 class LayerTag():
@@ -51,10 +167,32 @@ class LayerTag():
     UI = 32
 
 
+def mergeRects(rects):
+    ''' merge overlapping rects until no two of them collide '''
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        if rect.width <= 0 or rect.height <= 0:
+            continue
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
 class LayerManager():
-    def __init__(self, rect=None):
-        if rect == None:
-            self.rect = ((SCREEN_WIDTH, SCREEN_HEIGHT))
+    '''
+    Layers of surfaces composed onto the screen.
+    dirtyRects - only compose areas reported by markDirty (this frame and
+    the previous one), renderLayers then returns the rects to pass to
+    pygame.display.update. Static layers are only redrawn under those
+    rects, or fully after invalidate().
+    '''
+
+    def __init__(self, rect=None, dirtyRects=False):
+        self.rect = optional(rect, (SCREEN_WIDTH, SCREEN_HEIGHT))
         self.layers = {}
         self.renderedLayers = {}
         self.maxOrder = 8
@@ -65,6 +203,25 @@ class LayerManager():
             LayerTag.EFFECT,
             LayerTag.UI
         ]
+        self.dirtyRects = dirtyRects
+        self.drawn = defaultdict(list)  # (tag, slot) -> rects of this frame
+        self.lastDrawn = defaultdict(list)  # ... of the previous frame
+        self.fullRedraw = True
+
+    def slotOf(self, orderInLayer):
+        orderInLayer = int(orderInLayer)
+        orderInLayer += self.maxOrder // 2
+        if orderInLayer < 0:
+            orderInLayer = 0
+        elif orderInLayer >= self.maxOrder:
+            orderInLayer = self.maxOrder-1
+        return orderInLayer
+
+    def newSurface(self):
+        ''' transparent surface of the layer size '''
+        surface = pygame.Surface(self.rect).convert_alpha()
+        surface.fill(0)
+        return surface
 
     def getSurface(self, layerTag, orderInLayer=0, flushed=False):
         '''
@@ -72,39 +229,73 @@ class LayerManager():
         if the order is out of range(-maxOrder/2, maxOrder/2),
         it will be reset to nearest bound
         flushed - flush the returned surface
+        (with dirtyRects, only what was marked dirty last frame)
         '''
         layer = self.layers.get(layerTag)
         result = None
-        orderInLayer = int(orderInLayer)
-        orderInLayer += self.maxOrder // 2
-        if orderInLayer < 0:
-            orderInLayer = 0
-        elif orderInLayer >= self.maxOrder:
-            orderInLayer = self.maxOrder-1
+        orderInLayer = self.slotOf(orderInLayer)
         if layer != None:
             if layer[orderInLayer] != None:
                 result = layer[orderInLayer]
             else:
-                surface = pygame.Surface(self.rect).convert_alpha()
+                surface = self.newSurface()
                 layer[orderInLayer] = surface
                 result = surface
         else:
-            self.renderedLayers[layerTag] = pygame.Surface(
-                self.rect).convert_alpha()
+            self.renderedLayers[layerTag] = self.newSurface()
             self.layers[layerTag] = [None] * self.maxOrder
-            surface = pygame.Surface(self.rect).convert_alpha()
+            surface = self.newSurface()
             self.layers[layerTag][orderInLayer] = surface
             result = surface
         if flushed == True:
-            result.fill(0)
+            if self.dirtyRects:
+                for rect in self.lastDrawn[(layerTag, orderInLayer)]:
+                    result.fill(0, rect)
+            else:
+                result.fill(0)
         return result
 
-    def tryRenderLayer(self, layerTag, target=None):
+    def setSurface(self, layerTag, surface, orderInLayer=0):
+        '''
+        use a surface owned by someone else (e.g. a renderer) as a slot,
+        saves copying it into a layer surface every frame
+        '''
+        self.getSurface(layerTag, orderInLayer)
+        self.layers[layerTag][self.slotOf(orderInLayer)] = surface
+        self.invalidate()
+
+    def markDirty(self, layerTag, rect, orderInLayer=0):
+        ''' report an area of a slot that was drawn this frame '''
+        if rect != None:
+            self.drawn[(layerTag, self.slotOf(orderInLayer))].append(rect)
+
+    def invalidate(self):
+        ''' compose the whole screen next time (e.g. static layer changed) '''
+        self.fullRedraw = True
+
+    def collectDirtyRects(self):
+        '''
+        areas to compose this frame: drawn now or drawn last frame,
+        moves this frame's rects to the previous frame
+        '''
+        rects = []
+        for key in set(self.drawn.keys()) | set(self.lastDrawn.keys()):
+            rects.extend(self.drawn[key])
+            rects.extend(self.lastDrawn[key])
+        self.lastDrawn = self.drawn
+        self.drawn = defaultdict(list)
+        if self.fullRedraw:
+            self.fullRedraw = False
+            return [pygame.Rect((0, 0), self.rect)]
+        return mergeRects(rects)
+
+    def tryRenderLayer(self, layerTag, target=None, rects=None):
         '''
         try to pile up surfaces in speficied layer
         return None if no such layer exists
         param:
         target - specify a target surface to render on(additively)
+        rects - only pile up these areas (whole surfaces if None)
         '''
         if layerTag in self.layers.keys():
             if target == None:
@@ -114,7 +305,11 @@ class LayerManager():
                 if surface == None:
                     continue
 
-                target.blit(surface, (0, 0))
+                if rects == None:
+                    target.blit(surface, (0, 0))
+                else:
+                    for rect in rects:
+                        target.blit(surface, rect, rect)
             return target
         else:
             return None
@@ -127,25 +322,36 @@ class LayerManager():
         param:
         layerList - list of layer tags(use default if not provided)
         flushed - if true, target will be flushed before rendering
+        return the list of rects of target that changed
         '''
         if layerList == None:
             layerList = self.layerOrder
+        rects = None
+        if self.dirtyRects:
+            rects = self.collectDirtyRects()
         if flushed:
-            target.fill(0)
+            if rects == None:
+                target.fill(0)
+            else:
+                for rect in rects:
+                    target.fill(0, rect)
         for tag in layerList:
-            self.tryRenderLayer(tag, target)
+            self.tryRenderLayer(tag, target, rects)
+        if rects == None:
+            return [target.get_rect()]
+        return rects
 
 
 class RingSkill(PlayerSkillBase):
+    cooldownPeriod = 115
+
     def __init__(self, player):
         # TODO use identity to manage skills, or get rid of it
         identity = "RingSkill"
         super(RingSkill, self).__init__(identity, player)
         self.skillPeriod = 50
-        self.cooldownTimer = 0
-        self.cooldownPeriod = 115
 
-        self.renderTimer = 0
+        self.shown = None  # SkillTimer of the ring drawn after a use
         self.renderPeriod = 120
 
         self.innerRad = 20
@@ -154,48 +360,27 @@ class RingSkill(PlayerSkillBase):
 
         self.color = (255, 255, 0, 50)  # YELLOW
 
-    def step(self):
-        ''' override '''
-        if self.cooldownTimer > 0:
-            self.cooldownTimer -= 1
-
     def renderSkill(self, surface):
-        if self.renderTimer > 0:
+        if self.player.timers.running(self.shown):
             radius = int(self.outerRad)
             width = int(self.outerRad - self.innerRad)
-            color = None
             pos = self.usedPoint
             pos = (int(pos[0]), int(pos[1]))
-            pygame.draw.circle(
+            return pygame.draw.circle(
                 surface,
                 self.color,
                 pos,
                 radius,
                 width
             )
-            self.renderTimer -= 1
-
-    def isActive(self):
-        return self.cooldownTimer == 0
 
     def useSkillOn(self, manager):
-        if self.cooldownTimer > 0:
-            return Result.SKILL_UNAVAILABLE
-        else:
-            self.usedPoint = self.player.core.pos.toTuple()
-            manager.backward(self._getPeriod)
-            self.cooldownTimer = self.cooldownPeriod
-            self.renderTimer = self.renderPeriod
+        self.usedPoint = self.player.core.pos.toTuple()
+        manager.effects.ring(self.usedPoint, self.innerRad, self.outerRad,
+                             self.skillPeriod, manhattan=True)
+        self.shown = self.player.timers.schedule(self.renderPeriod)
         return Result.SUCCEED
 
-    def _getPeriod(self, key):
-        pos = self.usedPoint
-        dist = abs(pos[0]-key[0])+abs(pos[1]-key[1])
-        if dist < self.outerRad and dist > self.innerRad:
-            return self.skillPeriod
-        else:
-            return 0
-
 
 class UserEvent():
     PRINTER = pygame.USEREVENT + 1
@@ -230,6 +415,10 @@ class GameController():
 
             for direction, skillBuilder in commands.items():
                 self.player.loadSkill(direction, skillBuilder(self.player))
+            self.player.timeToLive = PLAYER_PARTICLE_TIME_TO_LIVE
+            if PLAYER_SPAWN_RATE > 0:
+                self.player.emitter = ParticleEmitter(self.player,
+                                                      PLAYER_SPAWN_RATE)
 
         def spawnParticles(self):
             particles = ParticleGroup()
@@ -244,7 +433,11 @@ class GameController():
 
         def getForce(self, particle):
             ''' override '''
-            return Vec2d(self.force)-particle.vel*self.friction
+            return Vec2d(self.force).scaledAdd(particle.vel, -self.friction)
+
+        def getForceBatch(self, positions, velocities, masses):
+            ''' override, vectorized getForce '''
+            return np.array(self.force, dtype=float) - velocities*self.friction
 
         def parseEvent(self, event):
             res = 0  # succeed
@@ -253,51 +446,85 @@ class GameController():
                     if event.type == pygame.KEYDOWN:
                         self.keyDown = event.key
                         self.force = self.mapMove[event.key]
-                        print("PLAYER {0} received DOWN MOVE event, response: {1}".format(
+                        self.log("PLAYER {0} received DOWN MOVE event, response: {1}".format(
                             self.identity, self.force))
                     else:  # KEYUP
                         if self.keyDown == event.key:
                             self.keyDown = None
                             self.force = (0, 0)
-                        print("PLAYER {0} received UP MOVE event, response: {1}".format(
+                        self.log("PLAYER {0} received UP MOVE event, response: {1}".format(
                             self.identity, self.force))
                 elif event.key in self.mapAttack.keys():
                     if event.type == pygame.KEYDOWN and self.attDown == None:
                         self.attDown = event.key
                         res = self.player.command(self.mapAttack[event.key])
-                        print("PLAYER {0} received DOWN ATT event, response: {1}".format(
+                        self.log("PLAYER {0} received DOWN ATT event, response: {1}".format(
                             self.identity, res))
                     else:  # KEYUP
                         if self.attDown == event.key:
                             self.attDown = None
-                        print("PLAYER {0} received UP ATT event, response: {1}".format(
+                        self.log("PLAYER {0} received UP ATT event, response: {1}".format(
                             self.identity, self.force))
             elif event.type == UserEvent.PRINTER:
                 self.player.detailPrinter()
             return res
 
-        def renderPlayer(self, surface):
-            pos = self.player.core.pos.toTuple()
+        def log(self, message):
+            if self.owner.verbose:
+                print(message)
+
+        def renderPlayer(self, surface, pos=None):
+            ''' pos - where to draw the core, its position by default '''
+            pos = optional(pos, self.player.core.pos.toTuple())
             image = self.owner.resources.getImage("player")
-            blitCentering(surface, image, pos)
+            return blitCentering(surface, image, pos)
 
         def renderSkills(self, surface):
+            ''' return rects drawn by the skills '''
+            rects = []
             for skill in self.player.getSkills():
-                skill.renderSkill(surface)
+                rects.append(skill.renderSkill(surface))
+            return rects
 
-    def __init__(self, screen):
+    def __init__(self, screen=None, workers=None):
+        '''
+        screen - surface to render on. Without one the controller is
+        headless: it only simulates, no surface or image is created.
+        workers - threads stepping particles, PARALLEL_WORKERS by default
+        '''
         self.screen = screen
-        self.layers = LayerManager()
-
-        self.resources = ResourcePack()
-        self.resources.loadImage("player")
+        self.verbose = True  # print received events
+        self.profiler = FrameProfiler()
+        self.showProfile = False
+        self.font = None
+        self.frame = 0  # frames simulated
+        self.recorder = None  # gets input and frames, see replay.py
+        # keep positions of the previous frame to render between frames
+        self.interpolate = False
+        self.previous = None  # see capturePositions
 
         self.FPS = CONTROLLER_UPDATE_FPS
         self.worldRect = (WORLD_WIDTH, WORLD_HEIGHT)
         self.interval = (WIDTH_INTERVAL, HEIGHT_INTERVAL)
 
-        self.manager = ParticleManager(self.worldRect, self.interval)
-        self.renderer = ParticleRenderer(self.manager)
+        integrator = None
+        if PARTICLE_INTEGRATOR != None:
+            integrator = INTEGRATORS[PARTICLE_INTEGRATOR]()
+        self.manager = ParticleManager(self.worldRect, self.interval,
+                                       columnar=COLUMNAR_PARTICLES,
+                                       workers=optional(workers,
+                                                        PARALLEL_WORKERS),
+                                       integrator=integrator,
+                                       historyStride=PARTICLE_HISTORY_STRIDE)
+        self.manager.profiler = self.profiler
+        if PARTICLE_INTERACTIONS:
+            self.manager.interactions = InteractionEngine()
+
+        self.layers = None
+        self.resources = None
+        self.renderer = None
+        if screen != None:
+            self.setupRendering()
 
         self.AID = "playerA"
         self.BID = "playerB"
@@ -348,9 +575,32 @@ class GameController():
             data.spawnParticles()
         self.manager.commitParticles()
 
+    def setupRendering(self):
+        self.layers = LayerManager(dirtyRects=DIRTY_RECTS)
+
+        self.resources = ResourcePack()
+
+        self.renderer = ParticleRenderer(self.manager,
+                                         batch=BATCH_RENDERING)
+
+        # static background, drawn once
+        self.layers.getSurface(
+            LayerTag.BACKGROUND,
+        ).fill((200, 200, 200))  # WHITE BACKGROUND
+        self.layers.setSurface(LayerTag.GAMEOBJECT, self.renderer.pixels)
+
+    def isHeadless(self):
+        return self.screen == None
+
     def dispatchEvent(self, event):
         ''' dispatch pygame event '''
-        if event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            self.showProfile = not self.showProfile
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+            self.toggleTrace()
+        elif event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+            if self.recorder != None:
+                self.recorder.recordEvent(self.frame, event)
             for data in self.players.values():
                 data.parseEvent(event)
         elif event.type == UserEvent.PRINTER:
@@ -359,34 +609,164 @@ class GameController():
             for data in self.players.values():
                 data.parseEvent(event)
 
+    def toggleTrace(self):
+        if self.profiler.isTracing():
+            self.profiler.stopTrace(PROFILE_TRACE_PATH)
+            print("trace written to", PROFILE_TRACE_PATH)
+        else:
+            self.profiler.startTrace()
+            print("tracing...")
+
     def update(self):
-        ''' called from pygame cycle '''
-        for data in self.players.values():
-            data.player.step()
+        '''
+        called from pygame cycle
+        return rects of the screen that changed (for pygame.display.update)
+        '''
+        self.profiler.beginFrame()
+        self.simulate()
+        rects = self.render()
+        self.countFrame()
+        self.profiler.endFrame()
+        return rects
+
+    def countFrame(self):
+        ''' frame counters of the profiler '''
+        self.profiler.count("particles", len(self.manager.frame.group))
+        self.profiler.count("active containers",
+                            len(self.manager.frame.history.keyFrames))
+        self.profiler.count("history bytes",
+                            self.manager.frame.history.bytes)
+
+    def simulate(self):
+        ''' advance the game by one frame, no rendering '''
+        if self.interpolate:
+            self.previous = self.capturePositions()
+        # skills used since the last frame, before the players move
+        self.manager.applyEffects()
+        with self.profiler.stage("players"):
+            for data in self.players.values():
+                data.player.step()
         self.manager.step()
+        self.frame += 1
+        if self.recorder != None:
+            self.recorder.recordFrame(self)
+
+    def particlePositions(self):
+        group = self.manager.frame.group
+        if self.manager.frame.columnar:
+            return group.columns()[0]
+        return np.array([p.pos.toTuple() for p in group],
+                        dtype=float).reshape(-1, 2)
+
+    def capturePositions(self):
+        ''' (manager layout, particle positions, identity -> core position) '''
+        return (self.manager.layout, self.particlePositions().copy(),
+                {identity: data.player.core.pos.toTuple()
+                 for identity, data in self.players.items()})
+
+    def interpolatedPositions(self, alpha):
+        '''
+        particle and core positions alpha of the way from the previous
+        frame to the current one. Particles are None when there is nothing
+        to blend: no previous frame, or rows changed since (commit, rewind).
+        '''
+        cores = {identity: data.player.core.pos.toTuple()
+                 for identity, data in self.players.items()}
+        if self.previous == None or alpha >= 1:
+            return None, cores
+        layout, positions, previousCores = self.previous
+        for identity, pos in previousCores.items():
+            if identity in cores:
+                cores[identity] = tuple(
+                    a + (b - a)*alpha for a, b in zip(pos, cores[identity]))
+        current = self.particlePositions()
+        if layout != self.manager.layout or len(current) != len(positions):
+            return None, cores
+        return positions + (current - positions)*alpha, cores
+
+    def checksum(self):
+        ''' crc32 of particle and player states, to compare runs '''
+        group = self.manager.frame.group
+        if self.manager.frame.columnar:
+            pos, vel = group.columns()[:2]
+        else:
+            pos = np.array([p.pos.toTuple() for p in group], dtype=float)
+            vel = np.array([p.vel.toTuple() for p in group], dtype=float)
+        cores = np.array([data.player.core.pos.toTuple() +
+                          data.player.core.vel.toTuple()
+                          for data in self.players.values()], dtype=float)
+        crc = zlib.crc32(np.ascontiguousarray(pos).tobytes())
+        crc = zlib.crc32(np.ascontiguousarray(vel).tobytes(), crc)
+        return zlib.crc32(cores.tobytes(), crc)
+
+    def sharedObjects(self):
+        ''' deepcopy memo of objects a state refers to but does not own '''
+        shared = [self, self.profiler, self.manager, self.manager.grid,
+                  self.manager.frame.stepper]
+        return {id(obj): obj for obj in shared if obj != None}
+
+    def saveState(self):
+        '''
+        copy of the simulation state: frame, a snapshot of the particle
+        manager and a copy of the players (skills, timers, input state)
+        '''
+        return (self.frame, ManagerSnapshot.capture(self.manager),
+                copy.deepcopy(self.players, self.sharedObjects()))
+
+    def loadState(self, state):
+        ''' go back to a state from saveState, which stays reusable '''
+        self.frame, snapshot, players = state
+        self.players = copy.deepcopy(players, self.sharedObjects())
+        snapshot.restore(self.manager,
+                         [data.player for data in self.players.values()])
+        self.previous = None
+        if self.renderer != None:
+            self.layers.invalidate()
+
+    def render(self, alpha=1):
+        '''
+        render the current state to the screen, or with interpolate set,
+        the state alpha of the way from the previous frame to this one
+        return rects of the screen that changed, none when headless
+        '''
+        if self.isHeadless():
+            return []
+
+        positions, cores = self.interpolatedPositions(alpha)
+        with self.profiler.stage("render.particles"):
+            self.renderer.render(positions)
+            for rect in self.renderer.paintedRects:
+                self.layers.markDirty(LayerTag.GAMEOBJECT, rect)
+
+        with self.profiler.stage("render.players"):
+            surface = self.layers.getSurface(
+                LayerTag.PLAYER,
+                flushed=True
+            )
+            for identity, data in self.players.items():
+                self.layers.markDirty(LayerTag.PLAYER, data.renderPlayer(
+                    surface, cores[identity]))
 
-        self.layers.getSurface(
-            LayerTag.BACKGROUND,
-        ).fill((200, 200, 200))  # WHITE BACKGROUND
-
-        surface = self.renderer.render()
-        self.layers.getSurface(
-            LayerTag.GAMEOBJECT,
-            flushed=True
-        ).blit(surface, (0, 0))
-
-        surface = self.layers.getSurface(
-            LayerTag.PLAYER,
-            flushed=True
-        )
-        for data in self.players.values():
-            data.renderPlayer(surface)
-
-        surface = self.layers.getSurface(
-            LayerTag.EFFECT,
-            flushed=True
-        )
-        for data in self.players.values():
-            data.renderSkills(surface)
-
-        self.layers.renderLayers(self.screen, flushed=True)
+            surface = self.layers.getSurface(
+                LayerTag.EFFECT,
+                flushed=True
+            )
+            for data in self.players.values():
+                for rect in data.renderSkills(surface):
+                    self.layers.markDirty(LayerTag.EFFECT, rect)
+
+        if self.showProfile or LayerTag.UI in self.layers.layers:
+            self.renderProfile()
+
+        with self.profiler.stage("compose"):
+            return self.layers.renderLayers(self.screen, flushed=True)
+
+    def renderProfile(self):
+        ''' profiler overlay on the UI layer '''
+        surface = self.layers.getSurface(LayerTag.UI, flushed=True)
+        if not self.showProfile:
+            return
+        if self.font == None:
+            self.font = pygame.font.Font(None, 18)
+        rect = self.profiler.renderOverlay(surface, self.font)
+        self.layers.markDirty(LayerTag.UI, rect)
@@ -1,13 +1,21 @@
 from collections import defaultdict
+import heapq
 from sys import exit
 
 import pygame
 from pygame.locals import *
 
-from math import sin, cos, tan, atan
+from math import sin, cos, tan, atan, pi
 from math import sqrt
 
+import numpy as np
+
 from utils import *
+from profiler import *
+from parallel import *
+from interact import *
+from integrate import *
+from timefield import *
 
 SCREEN_HEIGHT = 480
 SCREEN_WIDTH = 640
@@ -27,53 +35,328 @@ class ParticleManager():
 
     def __init__(self,
                  worldRect=(640, 480),
-                 interval=(10, 10)
+                 interval=(10, 10),
+                 columnar=False,
+                 historyBudget=None,
+                 workers=0,
+                 integrator=None,
+                 historyStride=None
                  ):
-        self.frame = ParticleFrameManager()
+        '''
+        columnar - keep particles in a ParticleStore (see ParticleFrameManager)
+        historyBudget - bytes of particle history to keep at most
+        workers - threads stepping columnar particles by tiles (see
+        TileStepper), 0 to step on the calling thread only
+        integrator - steps particles, see integrate.py (explicit Euler
+        by default)
+        historyStride - frames between samples of history, see FrameHistory
+        '''
         self.rangeX, self.rangeY = worldRect
         self.interX, self.interY = interval
-        for i in range(0, self.rangeX, self.interX):
-            for j in range(0, self.rangeY, self.interY):
-                self.frame.createContainer((i, j))
+        self.grid = CellGrid(worldRect, interval)
+        self.frame = ParticleFrameManager(columnar=columnar,
+                                          historyBudget=historyBudget,
+                                          grid=self.grid,
+                                          historyStride=historyStride)
+        for key in self.grid.keys():
+            self.frame.createContainer(key)
+        if columnar and workers > 0:
+            self.frame.stepper = TileStepper(self.grid, workers)
+        self.frame.integrator = integrator
         self.frame.getKey = self.getKey
+        self.frame.getKeyBatch = self.getKeyBatch
         self.particlesBuffer = []
 
-        self.statistics = defaultdict(int)
+        self.statistics = defaultdict(int)  # identity -> particle count
+        self.aggregates = None  # identity -> aggregates, see aggregatesOf
+        self.cellCounts = None  # identity -> counts, see cellCountsOf
+        # bumped whenever live rows are added, dropped or reordered
+        self.layout = 0
+        # particle-vs-particle interactions, e.g. an InteractionEngine
+        self.interactions = None
+        # rewinds queued by skills for the next frame, see applyEffects
+        self.effects = TimeField(self.grid)
+        self.profiler = NullProfiler()
 
     def addParticlesToBuffer(self, particles):
         self.particlesBuffer.extend(particles)
 
     def commitParticles(self):
+        ''' add the buffered particles, born now, and forget history '''
+        for particle in self.particlesBuffer:
+            particle.born = self.now()
         self.frame.flushAndAddParticles(self.particlesBuffer)
+        self.countParticles(self.particlesBuffer)
         self.particlesBuffer = []
+        self.layout += 1
 
     def updateStatistics(self):
+        '''
+        recount particles of every owner. Counts are kept up to date as
+        particles are committed or rewound, this is only a full resync.
+        '''
         self.statistics.clear()
-        for particle in self.frame.group:
-            self.statistics[particle.owner.identity] += 1
+        self.countParticles(self.frame.group)
+
+    def countParticles(self, group, sign=1):
+        ''' add (sign 1) or remove (sign -1) a group from the counts '''
+        self.aggregates = None
+        self.cellCounts = None
+        if isinstance(group, ParticleStore):
+            counts = np.bincount(group.columns()[4])
+            for index in np.flatnonzero(counts).tolist():
+                owner = group.owners[index]
+                self.statistics[owner.identity] += sign * int(counts[index])
+            return
+        for particle in group:
+            self.statistics[particle.owner.identity] += sign
 
     def particleCountOf(self, owner):
         ''' now we can get ask for number of particles! '''
         return self.statistics[owner.identity]
 
+    def aggregatesOf(self, owner):
+        '''
+        aggregates of the particles of owner: {"count", "centroid",
+        "bbox" ((min x, min y), (max x, max y)), "kineticEnergy"},
+        None when it has no particle. Computed for all owners at once,
+        at most once per frame: one O(N) pass over every particle.
+        '''
+        if self.aggregates == None:
+            self.aggregates = self.computeAggregates()
+        return self.aggregates.get(owner.identity)
+
+    def ownerColumns(self):
+        ''' pos, vel, mass, owner index arrays and owner list of particles '''
+        group = self.frame.group
+        if self.frame.columnar:
+            pos, vel, acc, mass, ownerIndex, born = group.columns()
+            return pos, vel, mass, ownerIndex, group.owners.owners
+        table = OwnerTable()
+        ownerIndex = np.array([table.indexOf(p.owner) for p in group],
+                              dtype=np.int64)
+        pos = np.array([p.pos.toTuple() for p in group], dtype=float)
+        vel = np.array([p.vel.toTuple() for p in group], dtype=float)
+        mass = np.array([p.mass for p in group], dtype=float)
+        return pos.reshape(-1, 2), vel.reshape(-1, 2), mass, ownerIndex, \
+            table.owners
+
+    def computeAggregates(self):
+        ''' aggregatesOf for every owner identity, O(N) in particles '''
+        pos, vel, mass, ownerIndex, owners = self.ownerColumns()
+        # owners sharing an identity are aggregated together
+        slots = {}
+        slot = np.array([slots.setdefault(o.identity, len(slots))
+                         for o in owners], dtype=np.int64)
+        owner = slot[ownerIndex]
+        size = len(slots)
+        count = np.bincount(owner, minlength=size)
+        sumX = np.bincount(owner, pos[:, 0], minlength=size)
+        sumY = np.bincount(owner, pos[:, 1], minlength=size)
+        energy = np.bincount(
+            owner, 0.5 * mass * (vel[:, 0]**2 + vel[:, 1]**2), minlength=size)
+        low = np.full((size, 2), np.inf)
+        high = np.full((size, 2), -np.inf)
+        np.minimum.at(low, owner, pos)
+        np.maximum.at(high, owner, pos)
+        aggregates = {}
+        for identity, i in slots.items():
+            if count[i] == 0:
+                continue
+            aggregates[identity] = {
+                "count": int(count[i]),
+                "centroid": (float(sumX[i] / count[i]),
+                             float(sumY[i] / count[i])),
+                "bbox": (tuple(low[i].tolist()), tuple(high[i].tolist())),
+                "kineticEnergy": float(energy[i])
+            }
+        return aggregates
+
+    def cellCountsOf(self, owner):
+        '''
+        particles of owner in every grid cell, an array of grid.count.
+        Like aggregatesOf, computed for all owners in one O(N) pass at most
+        once per frame; the array is shared, don't modify it.
+        '''
+        if self.cellCounts == None:
+            self.cellCounts = self.computeCellCounts()
+        counts = self.cellCounts.get(owner.identity)
+        if counts is None:
+            return np.zeros(self.grid.count, dtype=np.int64)
+        return counts
+
+    def computeCellCounts(self):
+        ''' cellCountsOf for every owner identity, O(N) in particles '''
+        pos, vel, mass, ownerIndex, owners = self.ownerColumns()
+        slots = {}
+        slot = np.array([slots.setdefault(o.identity, len(slots))
+                         for o in owners], dtype=np.int64)
+        cells = self.grid.indexBatch(pos)
+        inside = cells >= 0
+        counts = np.bincount(
+            slot[ownerIndex[inside]] * self.grid.count + cells[inside],
+            minlength=len(slots) * self.grid.count)
+        counts = counts.reshape(len(slots), self.grid.count)
+        return {identity: counts[i] for identity, i in slots.items()}
+
+    def now(self):
+        ''' current frame, the clock of particle lifetimes '''
+        return self.frame.history.frame
+
+    def spawn(self, owner, positions, velocities=None, masses=None):
+        '''
+        add particles of owner at (n, 2) positions, with zero velocity and
+        DEFAULT_MASS unless given. Unlike commitParticles the history is
+        kept, so this is cheap enough to call every frame.
+        '''
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        count = len(positions)
+        if count == 0:
+            return
+        velocities = np.zeros((count, 2)) if velocities is None \
+            else np.asarray(velocities, dtype=float)
+        masses = np.full(count, float(ParticleState.DEFAULT_MASS)) \
+            if masses is None else np.asarray(masses, dtype=float)
+        if self.frame.columnar:
+            self.frame.group.appendBatch(owner, positions, velocities,
+                                         masses, self.now())
+        else:
+            self.frame.spawn(ParticleState(
+                owner=owner,
+                mass=float(mass),
+                pos=Vec2d(pos),
+                vel=Vec2d(vel),
+                born=self.now()
+            ) for pos, vel, mass in zip(positions.tolist(),
+                                        velocities.tolist(),
+                                        masses.tolist()))
+        self.statistics[owner.identity] += count
+        self.aggregates = None
+        self.cellCounts = None
+        self.layout += 1
+
+    def expiredRows(self):
+        '''
+        rows of live particles past the timeToLive of their owner or
+        outside the world
+        '''
+        now = self.now()
+        group = self.frame.group
+        if isinstance(group, ParticleStore):
+            pos, vel, acc, mass, ownerIndex, born = group.columns()
+            timeToLive = np.array(
+                [np.inf if getattr(owner, "timeToLive", None) == None
+                 else owner.timeToLive for owner in group.owners.owners] +
+                [np.inf])
+            expired = now - born >= timeToLive[ownerIndex]
+            inside = (pos[:, 0] >= 0) & (pos[:, 0] < self.rangeX) & \
+                (pos[:, 1] >= 0) & (pos[:, 1] < self.rangeY)
+            return np.flatnonzero(expired | ~inside)
+        rows = []
+        for i, particle in enumerate(group):
+            timeToLive = getattr(particle.owner, "timeToLive", None)
+            pos = particle.pos
+            if (timeToLive != None and now - particle.born >= timeToLive) \
+                    or not (0 <= pos.x < self.rangeX and
+                            0 <= pos.y < self.rangeY):
+                rows.append(i)
+        return np.array(rows, dtype=np.intp)
+
+    def despawnExpired(self):
+        ''' remove expired particles (see expiredRows), return how many '''
+        rows = self.expiredRows()
+        if len(rows) == 0:
+            return 0
+        self.countParticles(self.frame.despawn(rows), -1)
+        self.layout += 1
+        return len(rows)
+
     def step(self):
-        ''' delegate for frame '''
-        self.frame.step()
-        self.updateStatistics()
+        '''
+        apply queued effects, despawn expired particles, let particles
+        interact (see interactions), then delegate for frame
+        '''
+        self.applyEffects()
+        with self.profiler.stage("manager.despawn"):
+            self.despawnExpired()
+        if self.interactions != None:
+            with self.profiler.stage("manager.interact"):
+                self.interactions.apply(self)
+        with self.profiler.stage("manager.step"):
+            self.frame.step()
+        self.aggregates = None
+        self.cellCounts = None
 
     def backward(self, getPeriod):
         '''
         delegate for frame
         getPeriod(key) should return a period of int/float
         '''
-        self.frame.backward(getPeriod)
-        self.updateStatistics()
+        with self.profiler.stage("manager.backward"):
+            removed, restored = self.frame.backward(getPeriod)
+        self.layout += 1
+        with self.profiler.stage("statistics"):
+            self.countParticles(removed, -1)
+            self.countParticles(restored, 1)
+
+    def backwardCells(self, cells, period):
+        '''
+        step the given cells backward by period,
+        cells being grid indices (e.g. from a grid region query)
+        '''
+        self.backward(dict.fromkeys(self.grid.keysOf(cells), period))
+
+    def backwardField(self, field):
+        '''
+        step every cell backward by its depth in field (a TimeField of
+        grid) in one pass
+        '''
+        with self.profiler.stage("manager.backward"):
+            removed, restored = self.frame.backwardField(field.depth)
+        self.layout += 1
+        with self.profiler.stage("statistics"):
+            self.countParticles(removed, -1)
+            self.countParticles(restored, 1)
+
+    def queueBackward(self, periods):
+        '''
+        queue a rewind of key -> period (frames) for the next
+        applyEffects, rewinds queued for the same cell add up
+        '''
+        for key, period in periods.items():
+            index = self.grid.indexOf(key)
+            if index >= 0:
+                self.effects.add([index], period)
+
+    def queueBackwardCells(self, cells, period):
+        ''' queueBackward for grid indices, see backwardCells '''
+        self.effects.add(cells, period)
+
+    def applyEffects(self):
+        '''
+        rewind the queued effects (shapes drawn on effects, see TimeField)
+        in one pass, return how many cells were queued.
+        Rewinding a container by a then b is rewinding it by a + b, so
+        skills used in the same frame cost one pass over the particles.
+        '''
+        if not self.effects.any():
+            return 0
+        cells = len(self.effects.cells())
+        self.backwardField(self.effects)
+        self.effects.clear()
+        return cells
 
     def getKey(self, particle):
         pos = particle.pos
         return (self.interX*int(pos.x / self.interX),
                 self.interY*int(pos.y / self.interY))
 
+    def getKeyBatch(self, positions):
+        ''' getKey for a (n, 2) position array, returns key x & key y arrays '''
+        keyX = self.interX*np.trunc(positions[:, 0] / self.interX)
+        keyY = self.interY*np.trunc(positions[:, 1] / self.interY)
+        return keyX.astype(np.int64), keyY.astype(np.int64)
+
     def detailPrinter(self):
         print("manager: ", self.statistics)
         for i in range(0, self.rangeX, self.interX):
@@ -84,6 +367,20 @@ class ParticleManager():
 
     def simplePrinter(self):
         print("manager: ", self.statistics)
+        print("history: ", self.frame.history.memoryReport())
+
+
+def circleStamp(radius):
+    '''
+    pixel offsets covered by pygame.draw.circle(..., radius, 0),
+    as two int arrays (dx, dy)
+    '''
+    size = 2 * radius + 3
+    surface = pygame.Surface((size, size))
+    pygame.draw.circle(surface, (255, 255, 255), (radius+1, radius+1),
+                       radius, 0)
+    dx, dy = np.nonzero(pygame.surfarray.array2d(surface))
+    return dx - (radius+1), dy - (radius+1)
 
 
 class ParticleRenderer():
@@ -91,9 +388,11 @@ class ParticleRenderer():
     Particle renderer, renders particles to pygame surface.
     Renders based on screen coordinate.
     Need to translate coordinate in manager to screen
+    batch - render all particles in one vectorized pass (see renderBatch)
     '''
+    RADIUS = 3
 
-    def __init__(self, manager):
+    def __init__(self, manager, batch=False):
         self.pixels = pygame.Surface(
             (SCREEN_WIDTH, SCREEN_HEIGHT)).convert_alpha()
         # self.pixels = pygame.PixelArray(self.pixels)
@@ -101,38 +400,194 @@ class ParticleRenderer():
         self.scaleX = SCREEN_WIDTH / self.manager.rangeX
         self.scaleY = SCREEN_HEIGHT / self.manager.rangeY
 
+        self.batch = batch
+        self.stampX, self.stampY = circleStamp(self.RADIUS)
+        # pixels painted in the last batch frame, cleared in the next one
+        self.paintedX = np.zeros(0, dtype=np.intp)
+        self.paintedY = np.zeros(0, dtype=np.intp)
+        # bounding rect of every owner's particles in the last frame
+        self.paintedRects = []
+        if batch:
+            self.pixels.fill((255, 255, 255, 0))
+
     def fromWorldToScreen(self, vec):
         return (vec.x*self.scaleX, vec.y*self.scaleY)
 
-    def render(self):
+    def render(self, positions=None):
+        '''
+        positions - (n, 2) array drawn instead of the particle positions
+        (e.g. interpolated between two frames), one row per particle
+        '''
+        if self.batch:
+            return self.renderBatch(positions)
         self.pixels.fill((255, 255, 255, 0))
-        for particle in self.manager.frame.group:
-            pos = particle.pos.toTuple()
+        rects = {}
+        for i, particle in enumerate(self.manager.frame.group):
+            pos = particle.pos.toTuple() if positions is None \
+                else positions[i]
             pos = (int(pos[0]), int(pos[1]))
             radius = int(3)
-            pygame.draw.circle(
+            rect = pygame.draw.circle(
                 self.pixels,
                 particle.owner.getColor(particle),
                 pos,
                 radius,
                 0)  # radius
+            owner = id(particle.owner)
+            rects[owner] = rects[owner].union(rect) if owner in rects \
+                else rect
             # self.pixels[pos] = particle.owner.getColor(particle)
+        self.paintedRects = list(rects.values())
         # return self.pixels.surface
         return self.pixels
 
+    def collectParticles(self):
+        '''
+        positions as a (n, 2) array, palette index of every particle
+        and the palette of mapped surface colors (owners asked once)
+        '''
+        group = self.manager.frame.group
+        if isinstance(group, ParticleStore):
+            positions, _, _, _, owner, _ = group.columns()
+            owners = group.owners
+            firsts = {}
+            for index in np.flatnonzero(np.bincount(owner)).tolist():
+                firsts[index] = int(np.argmax(owner == index))
+        else:
+            positions = np.array([particle.pos.toTuple()
+                                  for particle in group], dtype=float)
+            owners = OwnerTable()
+            owner = np.array([owners.indexOf(particle.owner)
+                              for particle in group], dtype=np.intp)
+            firsts = {}
+            for i, index in enumerate(owner.tolist()):
+                firsts.setdefault(index, i)
+        palette = np.zeros(max(len(owners), 1), dtype=np.uint32)
+        visible = np.zeros(len(palette), dtype=bool)
+        for index, first in firsts.items():
+            color = owners[index].getColor(group[first])
+            if color != None:
+                palette[index] = self.pixels.map_rgb(color) & 0xFFFFFFFF
+                visible[index] = True
+        return positions.reshape(-1, 2), owner, palette, visible
+
+    def renderBatch(self, positions=None):
+        '''
+        splat one precomputed circle stamp per particle straight into the
+        pixel array of the surface. Only pixels painted in the previous
+        frame are cleared, so the cost follows the particle count.
+        '''
+        current, owner, palette, visible = self.collectParticles()
+        if positions is None:
+            positions = current
+        width, height = self.pixels.get_size()
+        count = len(self.stampX)
+        shown = visible[owner]
+        positions, owner = positions[shown], owner[shown]
+        xs = (positions[:, 0].astype(np.intp)[:, None] + self.stampX).ravel()
+        ys = (positions[:, 1].astype(np.intp)[:, None] + self.stampY).ravel()
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        xs, ys = xs[inside], ys[inside]
+        colors = np.repeat(palette[owner], count)[inside]
+
+        pixels = pygame.surfarray.pixels2d(self.pixels)
+        pixels[self.paintedX, self.paintedY] = \
+            self.pixels.map_rgb((255, 255, 255, 0)) & 0xFFFFFFFF
+        pixels[xs, ys] = colors
+        del pixels  # unlock the surface
+        self.paintedX, self.paintedY = xs, ys
+        self.paintedRects = self.ownerRects(positions, owner)
+        return self.pixels
+
+    def ownerRects(self, positions, owner):
+        ''' bounding rect of the stamps of every owner's particles '''
+        rects = []
+        screen = self.pixels.get_rect()
+        for index in np.flatnonzero(np.bincount(owner)).tolist():
+            points = positions[owner == index].astype(np.intp)
+            left, top = points.min(axis=0) + \
+                (self.stampX.min(), self.stampY.min())
+            right, bottom = points.max(axis=0) + \
+                (self.stampX.max(), self.stampY.max())
+            rect = pygame.Rect(int(left), int(top),
+                               int(right - left) + 1, int(bottom - top) + 1)
+            rects.append(rect.clip(screen))
+        return rects
+
+
+class SkillTimer():
+    ''' frames [start, end) of a SkillTimers clock, see schedule '''
+
+    def __init__(self, start, end, callback=None):
+        self.start = start
+        self.end = end
+        self.callback = callback
+        self.cancelled = False
+
+
+class SkillTimers():
+    '''
+    Frame clock of the skills of a player, for cooldowns and durations.
+    A timer is running until the clock reaches its end, nothing counts it
+    down; timers with a callback wait in a heap ordered by end, and
+    advance() only visits those that end, so skills cost nothing on the
+    frames they wait.
+    '''
+
+    def __init__(self):
+        self.now = 0
+        self.heap = []  # (end, order, timer) of timers with a callback
+        self.order = 0  # timers ending on the same frame fire in order
+
+    def schedule(self, frames, callback=None):
+        ''' timer running for frames, callback() is called when it ends '''
+        timer = SkillTimer(self.now, self.now + frames, callback)
+        if callback != None:
+            heapq.heappush(self.heap, (timer.end, self.order, timer))
+            self.order += 1
+        return timer
+
+    def cancel(self, timer):
+        ''' stop timer, its callback is not called '''
+        if timer != None:
+            timer.cancelled = True
+
+    def running(self, timer):
+        return timer != None and not timer.cancelled and \
+            self.now < timer.end
+
+    def remaining(self, timer):
+        ''' frames until timer ends, 0 when it is not running '''
+        return timer.end - self.now if self.running(timer) else 0
+
+    def advance(self, frames=1):
+        ''' move the clock, call the callbacks of timers ending '''
+        self.now += frames
+        while len(self.heap) > 0 and self.heap[0][0] <= self.now:
+            end, order, timer = heapq.heappop(self.heap)
+            if not timer.cancelled:
+                timer.callback()
+
 
 class PlayerSkillBase():
+    '''
+    A skill of a player. Player.command uses it when it is not cooling
+    down, then cools it down for cooldownPeriod frames. Skills change
+    particles through the queued effects of the manager
+    (ParticleManager.queueBackward), applied once per frame.
+    '''
+    cooldownPeriod = 0
+
     def __init__(self, identity, player):
         self.identity = identity
         self.player = player
-
-    def step(self):
-        pass
+        self.cooldown = None  # SkillTimer of the last use
 
     def isActive(self):
-        return True
+        return not self.player.timers.running(self.cooldown)
 
     def renderSkill(self, surface):
+        ''' return the rect drawn, None if nothing was drawn '''
         pass
 
     def getPlayer(self):
@@ -145,6 +600,43 @@ class PlayerSkillBase():
         return 0
 
 
+class ParticleEmitter():
+    '''
+    Spawns particles of owner at a steady rate (particles per frame,
+    fractions add up over frames). They leave the emitting point at speed
+    in directions a golden angle apart, with masses spread over the given
+    range, so emission is deterministic and evenly spread.
+    '''
+    GOLDEN_ANGLE = pi * (3 - sqrt(5))
+    GOLDEN_RATIO = (sqrt(5) - 1) / 2
+
+    def __init__(self, owner, rate=1, speed=1, masses=(0.8, 1.2)):
+        self.owner = owner
+        self.rate = rate
+        self.speed = speed
+        self.masses = masses
+        self.credit = 0  # particles due but not spawned yet
+        self.emitted = 0
+
+    def emit(self, manager, pos):
+        ''' spawn the particles due this frame at pos, return how many '''
+        self.credit += self.rate
+        count = int(self.credit)
+        if count <= 0:
+            return 0
+        self.credit -= count
+        index = np.arange(self.emitted, self.emitted + count)
+        angles = index * self.GOLDEN_ANGLE
+        velocities = self.speed * np.stack((np.cos(angles), np.sin(angles)),
+                                           axis=1)
+        low, high = self.masses
+        masses = low + (high - low) * (index * self.GOLDEN_RATIO % 1)
+        manager.spawn(self.owner, np.tile(pos, (count, 1)), velocities,
+                      masses)
+        self.emitted += count
+        return count
+
+
 class Player(ParticleOwnerBase):
     def __init__(self, identity, manager, owner, color, loc):
         '''
@@ -169,16 +661,25 @@ class Player(ParticleOwnerBase):
             pos=Vec2d(loc))
 
         self.skills = {}  # PlayerSkillBase()
+        self.timers = SkillTimers()  # cooldowns and durations of skills
+        self.emitter = None  # ParticleEmitter spawning at the core
 
     def getForce(self, particle):
         ''' override '''
-        vec = self.core.pos - particle.pos
-        dist = vec.length()
+        force = self.core.pos - particle.pos
+        dist = force.length()
         coef = self.forceCoef * \
             atan(dist / self.radius - self.gravity * particle.mass)
-        force = vec * coef
-        force = force - particle.vel*self.friction
-        return force
+        force *= coef
+        return force.scaledAdd(particle.vel, -self.friction)
+
+    def getForceBatch(self, positions, velocities, masses):
+        ''' override, vectorized getForce '''
+        vec = np.array(self.core.pos.toTuple(), dtype=float) - positions
+        dist = np.sqrt(vec[:, 0]**2 + vec[:, 1]**2)
+        coef = self.forceCoef * \
+            np.arctan(dist / self.radius - self.gravity * masses)
+        return vec * coef[:, None] - velocities * self.friction
 
     def getColor(self, particle):
         ''' override '''
@@ -187,8 +688,9 @@ class Player(ParticleOwnerBase):
     def step(self):
         ''' do physical calculations '''
         self.core = self.core.physicalStepCopy()
-        for skill in self.skills.values():
-            skill.step()
+        self.timers.advance()
+        if self.emitter != None:
+            self.emitter.emit(self.manager, self.core.pos.toTuple())
 
     def loadSkill(self, direction, skill):
         self.skills[direction] = skill
@@ -201,11 +703,15 @@ class Player(ParticleOwnerBase):
         do something when events like keyboard inputs take place
         mainly for using skills
         '''
-        # TODO: implement CD time (necessary!)
         skill = self.skills.get(direction)
         if skill == None:
             return Result.INVALID_DIRECTION
-        return skill.useSkillOn(self.manager)
+        if not skill.isActive():
+            return Result.SKILL_UNAVAILABLE
+        res = skill.useSkillOn(self.manager)
+        if res == Result.SUCCEED and skill.cooldownPeriod > 0:
+            skill.cooldown = self.timers.schedule(skill.cooldownPeriod)
+        return res
 
     def detailPrinter(self):
         print("player ", self.identity, " core:", self.core)
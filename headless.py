@@ -0,0 +1,123 @@
+'''
+Headless simulation: runs the game without a display.
+Players, skills and particles are stepped at the fixed controller
+timestep, input comes from a scripted stream instead of the keyboard.
+
+usage: python headless.py [script|-] [frames] [runs] [workers]
+'''
+import sys
+import time
+from collections import defaultdict
+
+import pygame
+
+from utils import *
+from control import *
+
+
+class InputScript():
+    '''
+    Scripted input stream: key events tagged with the frame they happen in.
+    Text form has one event per line, "<frame> <down|up> <key>",
+    key being a pygame key name without "K_" (e.g. "10 down RIGHT").
+    Lines starting with "#" are ignored.
+    '''
+    TYPES = {"down": pygame.KEYDOWN, "up": pygame.KEYUP}
+
+    def __init__(self):
+        self.events = defaultdict(list)  # frame -> [(type, key)]
+
+    def add(self, frame, eventType, key):
+        self.events[frame].append((eventType, key))
+
+    def press(self, frame, key, duration=1):
+        ''' key down at frame, up duration frames later '''
+        self.add(frame, pygame.KEYDOWN, key)
+        self.add(frame + duration, pygame.KEYUP, key)
+
+    def eventsAt(self, frame):
+        return [pygame.event.Event(eventType, key=key)
+                for eventType, key in self.events.get(frame, [])]
+
+    def length(self):
+        ''' frame after the last event '''
+        return max(self.events.keys(), default=-1) + 1
+
+    @classmethod
+    def parse(cls, text):
+        script = cls()
+        for line in text.splitlines():
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            frame, eventType, key = line.split()
+            script.add(int(frame), cls.TYPES[eventType],
+                       getattr(pygame, "K_" + key))
+        return script
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls.parse(file.read())
+
+
+class HeadlessRunner():
+    '''
+    Drives a headless GameController at a fixed timestep.
+    Nothing depends on wall-clock time, so equal scripts give equal runs.
+    '''
+
+    def __init__(self, script=None, controller=None):
+        self.script = optional(script, InputScript())
+        self.controller = optional(controller, GameController())
+        self.controller.verbose = False
+        self.frame = 0
+        self.timestep = 1 / self.controller.FPS  # simulated seconds
+
+    def step(self):
+        for event in self.script.eventsAt(self.frame):
+            self.controller.dispatchEvent(event)
+        self.controller.simulate()
+        self.frame += 1
+
+    def run(self, frames):
+        for i in range(frames):
+            self.step()
+        return self.summary()
+
+    def summary(self):
+        manager = self.controller.manager
+        players = {}
+        for identity, data in self.controller.players.items():
+            players[identity] = {
+                "particles": manager.particleCountOf(data.player),
+                "core": data.player.core.pos.toTuple()
+            }
+        return {
+            "frame": self.frame,
+            "time": self.frame * self.timestep,
+            "players": players
+        }
+
+
+def main():
+    script = InputScript()
+    if len(sys.argv) > 1 and sys.argv[1] != "-":
+        script = InputScript.load(sys.argv[1])
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else \
+        max(script.length(), CONTROLLER_UPDATE_FPS * 60)
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    start = time.perf_counter()
+    for i in range(runs):
+        runner = HeadlessRunner(script, GameController(workers=workers))
+        summary = runner.run(frames)
+    elapsed = time.perf_counter() - start
+    print(summary)
+    print("{0} runs x {1} frames in {2:.2f}s, {3:.0f} frames/s".format(
+        runs, frames, elapsed, runs * frames / elapsed))
+
+
+if __name__ == "__main__":
+    main()
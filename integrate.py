@@ -0,0 +1,79 @@
+'''
+Integrators stepping particle positions and velocities, to be set as
+ParticleFrameManager.integrator (ParticleManager(integrator=...)).
+An integrator works on whole arrays: integrate(pos, vel, acc, accel,
+step) returns the new (pos, vel, acc) of (n, 2) arrays, accel(pos, vel)
+giving the acceleration of the particles at any trial state (a call of
+the owner forces). acc holds the acceleration found by the last step.
+Without an integrator particles are stepped by explicit Euler, as
+ParticleState.physicalStepCopy does.
+'''
+import numpy as np
+
+from utils import *
+
+
+class ExplicitEuler():
+    '''
+    the default scheme: position moves with the old velocity.
+    Damping stronger than mass / step makes velocities flip sign.
+    '''
+    evaluations = 1  # calls of accel per step
+
+    def integrate(self, pos, vel, acc, accel, step):
+        acc = accel(pos, vel)
+        return pos + vel * step, vel + acc * step, acc
+
+
+class SemiImplicitEuler():
+    ''' symplectic Euler: position moves with the new velocity '''
+    evaluations = 1
+
+    def integrate(self, pos, vel, acc, accel, step):
+        acc = accel(pos, vel)
+        vel = vel + acc * step
+        return pos + vel * step, vel, acc
+
+
+class VelocityVerlet():
+    '''
+    velocity Verlet. Forces depend on velocity (friction), so the
+    acceleration of the last step cannot be reused: with the friction of
+    Player it makes velocities grow without bound. The acceleration at
+    the start is evaluated again, the one at the end at the half step
+    velocity.
+    '''
+    evaluations = 2
+
+    def integrate(self, pos, vel, acc, accel, step):
+        acc = accel(pos, vel)
+        pos = pos + vel * step + acc * (0.5 * step * step)
+        nextAcc = accel(pos, vel + acc * (0.5 * step))
+        return pos, vel + (acc + nextAcc) * (0.5 * step), nextAcc
+
+
+class RungeKutta4():
+    ''' classic 4th order Runge-Kutta on positions and velocities '''
+    evaluations = 4
+
+    def integrate(self, pos, vel, acc, accel, step):
+        half = step / 2
+        acc1 = accel(pos, vel)
+        vel2 = vel + acc1 * half
+        acc2 = accel(pos + vel * half, vel2)
+        vel3 = vel + acc2 * half
+        acc3 = accel(pos + vel2 * half, vel3)
+        vel4 = vel + acc3 * step
+        acc4 = accel(pos + vel3 * step, vel4)
+        pos = pos + (vel + 2 * vel2 + 2 * vel3 + vel4) * (step / 6)
+        vel = vel + (acc1 + 2 * acc2 + 2 * acc3 + acc4) * (step / 6)
+        return pos, vel, acc1
+
+
+# name -> integrator class, for settings and benchmarks
+INTEGRATORS = {
+    "euler": ExplicitEuler,
+    "semiImplicit": SemiImplicitEuler,
+    "verlet": VelocityVerlet,
+    "rk4": RungeKutta4,
+}
@@ -0,0 +1,298 @@
+'''
+Interactions between particles of different owners: repulsion,
+annihilation and capture.
+Neighbours are found with cell-linked lists on the CellGrid of the
+manager, its cells split as long as they stay wider than the interaction
+radius: live particles are sorted by cell, and each particle is only
+paired with the particles of its own cell and of 4 neighbouring cells
+(the other 4 see it in turn), so every pair is visited once and the cost
+grows with the number of particles, not its square. The interaction
+radius is at most one cell of the manager grid. Pairs are generated and
+handled as whole arrays, in chunks that bound the memory used.
+Owners sharing an identity (a Player and its PlayerData) are one side,
+particles without owner take no part.
+'''
+import numpy as np
+
+from utils import *
+
+# neighbour distance, at most the cell size of the grid
+INTERACTION_RADIUS = 5
+# velocity change at contact between two particles of unit mass,
+# falling linearly to 0 at INTERACTION_RADIUS
+INTERACTION_REPULSION = 0.2
+# particles of different owners closer than this destroy each other
+INTERACTION_ANNIHILATION = 1
+# a particle joins an owner with this many neighbours more than its own
+INTERACTION_CAPTURE = 4
+# candidate pairs generated at once
+INTERACTION_CHUNK = 1 << 18
+
+# neighbouring cells visited from a cell (dx, dy), besides the cell itself
+HALF_STENCIL = ((1, -1), (1, 0), (1, 1), (0, 1))
+
+
+def expandRanges(begin, count):
+    '''
+    (owner, index) arrays: for every i, count[i] entries
+    (i, begin[i]), (i, begin[i] + 1), ...
+    '''
+    total = int(count.sum())
+    owner = np.repeat(np.arange(len(count)), count)
+    offset = np.arange(total) - np.repeat(np.cumsum(count) - count, count)
+    return owner, np.repeat(begin, count) + offset
+
+
+def searchGrid(grid, radius):
+    '''
+    grid whose cells split those of grid, as small as they can be while
+    still at least radius wide: fewer candidate pairs to test
+    '''
+    if radius > min(grid.interX, grid.interY):
+        raise ValueError("interaction radius is larger than a cell")
+    reach = max(1, int(np.ceil(radius)))
+    splitX = max(1, grid.interX // reach)
+    splitY = max(1, grid.interY // reach)
+    if splitX == 1 and splitY == 1:
+        return grid
+    return CellGrid((grid.rangeX, grid.rangeY),
+                    (grid.interX // splitX, grid.interY // splitY))
+
+
+class NeighborList():
+    '''
+    Cell-linked lists of a (n, 2) position array on a CellGrid:
+    order - rows sorted by cell (rows outside the grid left out),
+    starts, counts - where the rows of every cell are in order.
+    '''
+
+    def __init__(self, grid, positions):
+        self.grid = grid
+        self.positions = positions
+        cells = grid.indexBatch(positions)
+        inside = np.flatnonzero(cells >= 0)
+        self.order = inside[np.argsort(cells[inside], kind="stable")]
+        self.cells = cells[self.order]
+        self.counts = np.bincount(self.cells, minlength=grid.count)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def candidates(self):
+        '''
+        (begin, count) arrays for every neighbouring cell visited:
+        the sorted positions a sorted particle is paired with
+        '''
+        cells = self.cells
+        ix, iy = np.divmod(cells, self.grid.rows)
+        # later particles of the same cell
+        position = np.arange(len(cells))
+        ranges = [(position + 1,
+                   self.starts[cells] + self.counts[cells] - position - 1)]
+        for dx, dy in HALF_STENCIL:
+            nx, ny = ix + dx, iy + dy
+            valid = (nx < self.grid.cols) & (ny >= 0) & (ny < self.grid.rows)
+            cell = np.where(valid, nx * self.grid.rows + ny, 0)
+            ranges.append((self.starts[cell],
+                           np.where(valid, self.counts[cell], 0)))
+        return ranges
+
+    def pairs(self, radius, chunk=None):
+        '''
+        yield (i, j, delta, dist) arrays of row pairs closer than radius,
+        every pair once; delta is positions[j] - positions[i]
+        '''
+        if radius > min(self.grid.interX, self.grid.interY):
+            raise ValueError("interaction radius is larger than a cell")
+        chunk = optional(chunk, INTERACTION_CHUNK)
+        ranges = self.candidates()
+        total = np.cumsum(sum(count for begin, count in ranges))
+        # coordinates in cell order, gathered from 1d arrays
+        x = self.positions[self.order, 0]
+        y = self.positions[self.order, 1]
+        start = 0
+        while start < len(total):
+            done = total[start - 1] if start > 0 else 0
+            stop = max(start + 1, int(np.searchsorted(
+                total, done + chunk, side="right")))
+            first, second = [], []
+            for begin, count in ranges:
+                owner, other = expandRanges(begin[start:stop],
+                                            count[start:stop])
+                first.append(owner + start)
+                second.append(other)
+            p = np.concatenate(first)
+            q = np.concatenate(second)
+            dx = x[q] - x[p]
+            dy = y[q] - y[p]
+            close = np.flatnonzero(dx * dx + dy * dy < radius * radius)
+            p, q = p[close], q[close]
+            delta = np.column_stack((dx[close], dy[close]))
+            dist = np.hypot(delta[:, 0], delta[:, 1])
+            yield self.order[p], self.order[q], delta, dist
+            start = stop
+
+
+class InteractionEngine():
+    '''
+    Pairwise interactions of live particles, to be set as
+    ParticleManager.interactions; apply(manager) runs before every step.
+    All of them are decided on the state at the start of the frame:
+    - annihilation: particles of different owners closer than
+    annihilation destroy each other in pairs (0 to disable)
+    - capture: a particle with capture neighbours more of another owner
+    than of its own joins that owner (0 to disable)
+    - repulsion: hostile neighbours push each other apart, changing
+    velocities by repulsion * (1 - dist / radius) / mass
+    '''
+
+    def __init__(self, radius=None, repulsion=None, annihilation=None,
+                 capture=None, chunk=None):
+        self.radius = optional(radius, INTERACTION_RADIUS)
+        self.repulsion = optional(repulsion, INTERACTION_REPULSION)
+        self.annihilation = optional(annihilation, INTERACTION_ANNIHILATION)
+        self.capture = optional(capture, INTERACTION_CAPTURE)
+        self.chunk = chunk
+        # totals since creation
+        self.annihilated = 0
+        self.captured = 0
+
+    def sides(self, ownerIndex, owners):
+        '''
+        side of every particle (owners sharing an identity are one side,
+        -1 without owner) and an owner index standing for every side
+        '''
+        sides = {}
+        side = np.array([-1 if owner == None
+                         else sides.setdefault(owner.identity, len(sides))
+                         for owner in owners] + [-1], dtype=np.int64)
+        particleSide = side[ownerIndex]
+        # particles of a side mostly belong to the same owner object
+        representative = np.zeros(len(sides), dtype=np.int64)
+        representative[particleSide[particleSide >= 0]] = \
+            ownerIndex[particleSide >= 0]
+        return particleSide, representative, len(sides)
+
+    def annihilating(self, n, contacts):
+        '''
+        rows destroyed by the (i, j, dist) hostile contacts: two particles
+        that are the nearest contact of each other, so one particle
+        never takes several with it
+        '''
+        if len(contacts) == 0:
+            return np.zeros(0, dtype=np.intp)
+        i = np.concatenate([c[0] for c in contacts] + [c[1] for c in contacts])
+        j = np.concatenate([c[1] for c in contacts] + [c[0] for c in contacts])
+        dist = np.concatenate([c[2] for c in contacts] * 2)
+        if len(i) == 0:
+            return i
+        order = np.lexsort((j, dist, i))
+        i, j = i[order], j[order]
+        first = np.concatenate(([True], i[1:] != i[:-1]))
+        nearest = np.full(n, -1, dtype=np.int64)
+        nearest[i[first]] = j[first]
+        rows = i[first]
+        return rows[nearest[nearest[rows]] == rows]
+
+    def compute(self, grid, pos, mass, side, sides):
+        '''
+        the kernel: (velocity changes, despawned mask, captured rows,
+        their new side) of particles at pos
+        '''
+        n = len(mass)
+        kick = np.zeros((n, 2))
+        dead = np.zeros(n, dtype=bool)
+        if sides < 2:
+            return kick, dead, np.zeros(0, dtype=np.intp), \
+                np.zeros(0, dtype=np.int64)
+        grid = searchGrid(grid, self.radius)
+        pairs = list(NeighborList(grid, pos).pairs(self.radius, self.chunk))
+        contacts = []
+        for i, j, delta, dist in pairs:
+            hostile = (side[i] != side[j]) & (side[i] >= 0) & (side[j] >= 0)
+            close = hostile & (dist < self.annihilation)
+            contacts.append((i[close], j[close], dist[close]))
+        dead[self.annihilating(n, contacts)] = True
+
+        neighbors = np.zeros(n * sides, dtype=np.int64)
+        for i, j, delta, dist in pairs:
+            alive = ~(dead[i] | dead[j])
+            i, j, delta, dist = i[alive], j[alive], delta[alive], dist[alive]
+            if self.capture > 0:
+                valid = (side[i] >= 0) & (side[j] >= 0)
+                neighbors += np.bincount(
+                    np.concatenate((i[valid] * sides + side[j[valid]],
+                                    j[valid] * sides + side[i[valid]])),
+                    minlength=n * sides)
+            hostile = (side[i] != side[j]) & (side[i] >= 0) & \
+                (side[j] >= 0) & (dist > 0)
+            if self.repulsion > 0 and hostile.any():
+                i, j, delta, dist = i[hostile], j[hostile], \
+                    delta[hostile], dist[hostile]
+                push = delta * (self.repulsion *
+                                (1 / dist - 1 / self.radius))[:, None]
+                for axis in range(2):
+                    kick[:, axis] += np.bincount(j, push[:, axis],
+                                                 minlength=n)
+                    kick[:, axis] -= np.bincount(i, push[:, axis],
+                                                 minlength=n)
+        kick /= mass[:, None]
+
+        captured = np.zeros(0, dtype=np.intp)
+        newSide = np.zeros(0, dtype=np.int64)
+        if self.capture > 0:
+            neighbors = neighbors.reshape(n, sides)
+            rows = np.flatnonzero((side >= 0) & ~dead)
+            own = neighbors[rows, side[rows]]
+            neighbors[rows, side[rows]] = -1
+            best = np.argmax(neighbors[rows], axis=1)
+            gain = neighbors[rows, best] - own
+            taken = gain >= self.capture
+            captured, newSide = rows[taken], best[taken]
+        return kick, dead, captured, newSide
+
+    def apply(self, manager):
+        ''' interact the live particles of manager, return despawned count '''
+        frame = manager.frame
+        pos, vel, mass, ownerIndex, owners = manager.ownerColumns()
+        side, representative, sides = self.sides(ownerIndex, owners)
+        kick, dead, captured, newSide = self.compute(
+            manager.grid, pos, mass, side, sides)
+        newOwner = representative[newSide]
+        group = frame.group
+        if frame.columnar:
+            group.columns()[1][:] += kick
+            if len(captured) > 0:
+                manager.countParticles(group.take(captured), -1)
+                group.owner[captured] = newOwner
+                manager.countParticles(group.take(captured))
+        else:
+            # history holds the live states, replace them instead
+            owner = [owners[index] for index in ownerIndex.tolist()]
+            for row, index in zip(captured.tolist(), newOwner.tolist()):
+                owner[row] = owners[index]
+            changed = np.flatnonzero(kick.any(axis=1))
+            changed = np.union1d(changed, captured)
+            if len(captured) > 0:
+                manager.countParticles(
+                    ParticleGroup(group[row] for row in captured.tolist()),
+                    -1)
+            newVel = vel + kick
+            for row in changed.tolist():
+                particle = group[row]
+                group[row] = ParticleState(
+                    owner=owner[row],
+                    mass=particle.mass,
+                    pos=particle.pos,
+                    vel=Vec2d(newVel[row].tolist()),
+                    acc=particle.acc,
+                    born=particle.born
+                )
+            if len(captured) > 0:
+                manager.countParticles(
+                    ParticleGroup(group[row] for row in captured.tolist()))
+        self.captured += len(captured)
+        rows = np.flatnonzero(dead)
+        if len(rows) > 0:
+            manager.countParticles(frame.despawn(rows), -1)
+            manager.layout += 1
+        self.annihilated += len(rows)
+        return len(rows)
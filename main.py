@@ -1,9 +1,13 @@
+import sys
+
 import pygame
 from pygame.locals import *
 
 from utils import *
 from game import *
 from control import *
+from replay import *
+from pacing import *
 
 
 def main():
@@ -12,24 +16,27 @@ def main():
     # set title
     pygame.display.set_caption("time")
     controller = GameController(screen)
-    FPS = controller.FPS
-    clock = pygame.time.Clock()
-    frame_count = 0
+    recorder = None
+    if len(sys.argv) > 1:
+        # python main.py <file>: record the match as a replay
+        recorder = ReplayRecorder(controller)
+    scheduler = FrameScheduler(controller)
     prev_time = pygame.time.get_ticks()
     while True:
         for event in pygame.event.get():
             if event.type == QUIT:
+                if recorder != None:
+                    recorder.save(sys.argv[1])
+                    print("replay saved to", sys.argv[1])
                 exit()
             controller.dispatchEvent(event)
-        controller.update()
-        pygame.display.update()
-        frame_count += 1
+        pygame.display.update(scheduler.tick())
         curr_time = pygame.time.get_ticks()
-        if (curr_time - prev_time > 3000):
-            print(frame_count*1000 / (curr_time-prev_time), " FPS")
+        if PROFILE_CONSOLE_REPORT and curr_time - prev_time > 3000:
+            print(controller.profiler.summary())
+            print(scheduler.summary())
             prev_time = curr_time
-            frame_count = 0
-        clock.tick(FPS)
+        scheduler.wait()
 
 
 if __name__ == "__main__":
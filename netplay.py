@@ -0,0 +1,489 @@
+'''
+Lock-step networked play: every peer runs the whole deterministic
+simulation and only key input is exchanged, tagged with the frame it
+applies to. Local input is applied inputDelay frames late, which hides
+most of the latency. Remote input that has not arrived yet is predicted
+(no new key event, so held keys stay held) and the game goes on; when the
+real input differs, the state saved before the first predicted frame is
+loaded and the frames since are simulated again (rollback). A peer more
+than maxRollback frames ahead of the input it has waits instead.
+Peers send each other state checksums of confirmed frames and report
+the first frame where they disagree. Packets hold inputs that have not
+been acknowledged yet and, once per checksum interval, a checksum, so the
+traffic does not depend on the number of particles.
+
+Peers meet on a relay server which forwards their packets over UDP.
+
+usage:
+    python netplay.py server [port]
+    python netplay.py join <A|B> [host] [port] [input delay]
+    python netplay.py loopback [frames]   (server and two scripted peers)
+'''
+import asyncio
+import random
+import struct
+import sys
+import time
+
+import pygame
+from pygame.locals import *
+
+from utils import *
+from control import *
+from headless import *
+from pacing import *
+from replay import *
+
+NET_PORT = 47400
+# frames local input is held back before it is applied
+NET_INPUT_DELAY = 2
+# frames a peer may simulate on predicted input before it waits
+NET_MAX_ROLLBACK = 8
+# frames between two exchanged state checksums
+NET_CHECKSUM_INTERVAL = 20
+# seconds between join requests until the server starts the match
+NET_HELLO_INTERVAL = 0.25
+
+NET_HELLO = 1
+NET_START = 2
+NET_INPUT = 3
+
+
+def packVarint(value):
+    ''' unsigned int as LEB128: 7 bits per byte, high bit for more '''
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def unpackVarint(data, offset):
+    ''' (value, offset after it) of the varint at offset '''
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class LockstepSession():
+    '''
+    Lock-step state of one peer, independent of the transport: step() at
+    the simulation rate, feed received packets to receive(), send(bytes)
+    delivers packets to the other peer.
+    Players are given slots in the order of controller.players, slot is
+    the one played here. Key events are sent as one byte: index of the
+    key among the player's keys, high bit set for key up.
+    A packet is the type byte then varints: ack, first - ack (zigzag),
+    frames << 1 | 1 when a checksum follows (its frame as a varint and
+    the crc); then every frame's event count and events.
+    '''
+    CRC = struct.Struct("<I")
+
+    def __init__(self, controller, slot, send, inputDelay=None,
+                 maxRollback=None, checksumInterval=None):
+        self.controller = controller
+        self.slot = slot
+        self.remote = 1 - slot
+        self.send = send
+        self.inputDelay = optional(inputDelay, NET_INPUT_DELAY)
+        self.maxRollback = optional(maxRollback, NET_MAX_ROLLBACK)
+        self.checksumInterval = optional(checksumInterval,
+                                         NET_CHECKSUM_INTERVAL)
+        self.keys = [list(data.mapMove) + list(data.mapAttack)
+                     for data in controller.players.values()]
+
+        # slot -> frame -> ((type, key), ...), frames known in a row
+        self.inputs = [{}, {}]
+        self.known = [0, 0]
+        for frame in range(self.inputDelay):
+            self.inputs[slot][frame] = ()
+        self.known[slot] = self.inputDelay
+        self.pending = []  # local events for the next input frame
+        self.peerAck = 0  # local frames the peer has received
+
+        self.saved = None  # (frame, state) before the first predicted frame
+        self.mispredicted = None  # first frame whose prediction was wrong
+        self.checksums = {}  # frame -> crc of the local state
+        self.remoteChecksums = {}
+        self.checkSent = None  # frame of the last checksum sent
+        self.sent = None  # content of the last packet, see sync
+        self.desync = None
+
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.stalls = 0
+        self.bytesSent = 0
+        self.packetsSent = 0
+
+    def localEvent(self, event):
+        '''
+        take a key event of this peer, return False for events the
+        controller handles itself. Keys of other players are dropped.
+        '''
+        if event.type != KEYDOWN and event.type != KEYUP:
+            return False
+        if event.key in (K_F3, K_F4):
+            return False
+        if event.key in self.keys[self.slot]:
+            self.pending.append((event.type, event.key))
+        return True
+
+    def step(self):
+        ''' one tick: schedule local input, simulate a frame unless too far
+        ahead of remote input; return whether a frame was simulated '''
+        frame = self.controller.frame
+        if self.known[self.slot] == frame + self.inputDelay:
+            self.inputs[self.slot][self.known[self.slot]] = \
+                tuple(self.pending)
+            self.pending = []
+            self.known[self.slot] += 1
+        if self.mispredicted != None:
+            self.rollback()
+        advanced = frame - self.known[self.remote] < self.maxRollback
+        if advanced:
+            self.simulateFrame()
+        else:
+            self.stalls += 1
+        self.sendInputs()
+        self.prune()
+        return advanced
+
+    def sync(self):
+        '''
+        apply late remote input and send, without a new frame. Unlike
+        step() nothing is sent when the packet would repeat the last one,
+        so it may be called more often than the simulation rate.
+        '''
+        if self.mispredicted != None:
+            self.rollback()
+        self.sendInputs(repeat=False)
+
+    def simulateFrame(self):
+        frame = self.controller.frame
+        if frame >= self.known[self.remote] and self.saved == None:
+            self.saved = (frame, self.controller.saveState())
+        for inputs in self.inputs:
+            for eventType, key in inputs.get(frame, ()):
+                self.controller.dispatchEvent(
+                    pygame.event.Event(eventType, key=key))
+        self.controller.simulate()
+        if self.controller.frame % self.checksumInterval == 0:
+            self.checksums[self.controller.frame] = self.controller.checksum()
+
+    def rollback(self):
+        ''' load the saved state and simulate again with the real input '''
+        target = self.controller.frame
+        start, state = self.saved
+        with self.controller.profiler.stage("net.rollback"):
+            self.controller.loadState(state)
+            self.saved = None
+            self.mispredicted = None
+            while self.controller.frame < target:
+                self.simulateFrame()
+        self.rollbacks += 1
+        self.resimulated += target - start
+
+    def confirmed(self):
+        ''' frames simulated with the right input of every player '''
+        frame = min(self.controller.frame, self.known[self.remote])
+        if self.mispredicted != None:
+            frame = min(frame, self.mispredicted)
+        return frame
+
+    def encode(self, slot, eventType, key):
+        return self.keys[slot].index(key) | (0x80 if eventType == KEYUP else 0)
+
+    def decode(self, slot, byte):
+        return (KEYUP if byte & 0x80 else KEYDOWN, self.keys[slot][byte & 0x7F])
+
+    def sendInputs(self, repeat=True):
+        confirmed = self.confirmed()
+        checkFrame = max((frame for frame in self.checksums
+                          if frame <= confirmed), default=None)
+        if checkFrame == self.checkSent:
+            checkFrame = None  # each checksum is sent once
+        ack = self.known[self.remote]
+        first = self.peerAck
+        last = self.known[self.slot]
+        if not repeat and checkFrame == None and \
+                self.sent == (ack, first, last):
+            return
+        self.sent = (ack, first, last)
+        offset = first - ack
+        chunks = [bytes([NET_INPUT]), packVarint(ack),
+                  packVarint(offset << 1 if offset >= 0
+                             else -offset << 1 | 1),
+                  packVarint((last - first) << 1 | (checkFrame != None))]
+        if checkFrame != None:
+            self.checkSent = checkFrame
+            chunks += [packVarint(checkFrame),
+                       self.CRC.pack(self.checksums[checkFrame])]
+        for frame in range(first, last):
+            events = self.inputs[self.slot][frame]
+            chunks.append(bytes([len(events)] +
+                                [self.encode(self.slot, *event)
+                                 for event in events]))
+        data = b"".join(chunks)
+        self.bytesSent += len(data)
+        self.packetsSent += 1
+        self.send(data)
+
+    def receive(self, data):
+        if len(data) < 4 or data[0] != NET_INPUT:
+            return
+        ack, offset = unpackVarint(data, 1)
+        first, offset = unpackVarint(data, offset)
+        first = ack - (first >> 1) if first & 1 else ack + (first >> 1)
+        count, offset = unpackVarint(data, offset)
+        checkFrame = None
+        if count & 1:
+            checkFrame, offset = unpackVarint(data, offset)
+            crc, = self.CRC.unpack_from(data, offset)
+            offset += self.CRC.size
+        count >>= 1
+        self.peerAck = max(self.peerAck, ack)
+        for frame in range(first, first + count):
+            size = data[offset]
+            if frame == self.known[self.remote]:
+                events = tuple(self.decode(self.remote, byte)
+                               for byte in data[offset + 1:offset + 1 + size])
+                self.inputs[self.remote][frame] = events
+                self.known[self.remote] += 1
+                if len(events) > 0 and frame < self.controller.frame:
+                    self.mispredicted = min(
+                        optional(self.mispredicted, frame), frame)
+            offset += 1 + size
+        if self.mispredicted == None and \
+                self.known[self.remote] >= self.controller.frame:
+            self.saved = None  # every simulated frame is confirmed
+        if checkFrame != None:
+            self.remoteChecksums[checkFrame] = crc
+        self.checkDesync()
+
+    def checkDesync(self):
+        confirmed = self.confirmed()
+        for frame in [frame for frame in self.remoteChecksums
+                      if frame <= confirmed and frame in self.checksums]:
+            if self.remoteChecksums.pop(frame) != self.checksums[frame] \
+                    and self.desync == None:
+                self.desync = frame
+
+    def prune(self):
+        ''' forget input and checksums no longer needed '''
+        keep = min(self.peerAck, self.confirmed())
+        if self.saved != None:
+            keep = min(keep, self.saved[0])
+        for inputs in self.inputs:
+            for frame in [frame for frame in inputs if frame < keep]:
+                del inputs[frame]
+        oldest = self.confirmed() - 2 * self.checksumInterval
+        for frame in [frame for frame in self.checksums if frame < oldest]:
+            del self.checksums[frame]
+
+    def bandwidth(self):
+        ''' bytes sent per second of game time '''
+        seconds = self.controller.frame / self.controller.FPS
+        return self.bytesSent / seconds if seconds > 0 else 0
+
+    def summary(self):
+        return ("frame: {0} confirmed: {1} rollbacks: {2} ({3} frames) "
+                "stalls: {4} sent: {5:.0f} B/s desync: {6}").format(
+            self.controller.frame, self.confirmed(), self.rollbacks,
+            self.resimulated, self.stalls, self.bandwidth(), self.desync)
+
+
+class RelayServer(asyncio.DatagramProtocol):
+    '''
+    Meeting point of two peers: once both slots have joined it starts the
+    match (sends the seed to both), then forwards packets between them.
+    '''
+    HELLO = struct.Struct("<BB")  # type, slot
+    START = struct.Struct("<BI")  # type, seed
+
+    def __init__(self, seed=None):
+        self.seed = optional(seed, random.randrange(2**32))
+        self.peers = {}  # slot -> address
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) == 0:
+            return
+        if data[0] == NET_HELLO:
+            kind, slot = self.HELLO.unpack_from(data)
+            self.peers[slot] = addr
+            if len(self.peers) == 2:
+                start = self.START.pack(NET_START, self.seed)
+                for peer in self.peers.values():
+                    self.transport.sendto(start, peer)
+        elif data[0] == NET_INPUT:
+            for peer in self.peers.values():
+                if peer != addr:
+                    self.transport.sendto(data, peer)
+
+
+class NetPeer(asyncio.DatagramProtocol):
+    ''' UDP endpoint of a peer, packets go to session once it is set '''
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.transport = None
+        self.session = None
+        self.started = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def hello(self):
+        self.transport.sendto(RelayServer.HELLO.pack(NET_HELLO, self.slot))
+
+    def datagram_received(self, data, addr):
+        if len(data) == 0:
+            return
+        if data[0] == NET_START:
+            if not self.started.done():
+                kind, seed = RelayServer.START.unpack_from(data)
+                self.started.set_result(seed)
+        elif self.session != None:
+            self.session.receive(data)
+
+    def send(self, data):
+        self.transport.sendto(data)
+
+
+async def startServer(host="127.0.0.1", port=None, seed=None):
+    ''' relay server on host:port (a free port for 0), returns it and its port '''
+    transport, server = await asyncio.get_running_loop() \
+        .create_datagram_endpoint(lambda: RelayServer(seed),
+                                  local_addr=(host, optional(port, NET_PORT)))
+    return server, transport.get_extra_info("sockname")[1]
+
+
+async def join(slot, host="127.0.0.1", port=None):
+    ''' join the server as slot, wait for the match, return peer and seed '''
+    transport, peer = await asyncio.get_running_loop() \
+        .create_datagram_endpoint(lambda: NetPeer(slot),
+                                  remote_addr=(host, optional(port, NET_PORT)))
+    while not peer.started.done():
+        peer.hello()
+        await asyncio.wait([peer.started], timeout=NET_HELLO_INTERVAL)
+    return peer, peer.started.result()
+
+
+async def playScript(peer, seed, script, frames, inputDelay=None,
+                     controller=None):
+    '''
+    headless peer: the script gives local key events by frame, frames are
+    simulated as fast as remote input allows. Returns the session.
+    '''
+    seedEverything(seed)
+    controller = optional(controller, GameController())
+    controller.verbose = False
+    session = LockstepSession(controller, peer.slot, peer.send, inputDelay)
+    peer.session = session
+    fed = 0
+    while session.confirmed() < frames:
+        while fed <= controller.frame:
+            for event in script.eventsAt(fed):
+                session.localEvent(event)
+            fed += 1
+        if controller.frame < frames and session.step():
+            await asyncio.sleep(0)
+        else:
+            session.sync()
+            await asyncio.sleep(0.001)
+    # let the last inputs and checksums reach the other peer
+    for i in range(10):
+        session.sync()
+        await asyncio.sleep(0.005)
+    return session
+
+
+async def loopback(scripts, frames, inputDelay=None):
+    ''' server and two scripted peers in this process, over UDP '''
+    server, port = await startServer(port=0, seed=1)
+    peers = await asyncio.gather(*(join(slot, port=port)
+                                   for slot in range(2)))
+    sessions = await asyncio.gather(*(
+        playScript(peer, seed, script, frames, inputDelay)
+        for (peer, seed), script in zip(peers, scripts)))
+    for peer, seed in peers:
+        peer.transport.close()
+    server.transport.close()
+    return sessions
+
+
+async def playGame(slot, host, port, inputDelay):
+    pygame.init()
+    screen = pygame.display.set_mode((640, 480), 0, 32)
+    pygame.display.set_caption("time - waiting for the other player")
+    peer, seed = await join(slot, host, port)
+    pygame.display.set_caption("time - player " + "AB"[slot])
+    seedEverything(seed)
+    controller = GameController(screen)
+    session = LockstepSession(controller, slot, peer.send, inputDelay)
+    peer.session = session
+    scheduler = FrameScheduler(controller, simulate=session.step)
+    prev_time = pygame.time.get_ticks()
+    while True:
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                return
+            if not session.localEvent(event):
+                controller.dispatchEvent(event)
+        pygame.display.update(scheduler.tick())
+        curr_time = pygame.time.get_ticks()
+        if (curr_time - prev_time > 3000):
+            print(session.summary())
+            prev_time = curr_time
+        await asyncio.sleep(scheduler.idle())
+
+
+async def serve(port):
+    server, port = await startServer("0.0.0.0", port)
+    print("relay server on port", port)
+    await asyncio.Event().wait()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    if sys.argv[1] == "server":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        asyncio.run(serve(port))
+    elif sys.argv[1] == "join":
+        slot = "AB".index(sys.argv[2].upper())
+        host = sys.argv[3] if len(sys.argv) > 3 else "127.0.0.1"
+        port = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        delay = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        asyncio.run(playGame(slot, host, port, delay))
+    elif sys.argv[1] == "loopback":
+        frames = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+        scripts = [InputScript(), InputScript()]
+        for frame in range(0, frames, 45):
+            scripts[0].press(frame + 3, K_RIGHT if frame % 2 else K_LEFT, 12)
+            scripts[0].press(frame + 20, K_BACKSLASH)
+            scripts[1].press(frame + 9, K_w, 15)
+            scripts[1].press(frame + 30, K_SPACE)
+        start = time.perf_counter()
+        sessions = asyncio.run(loopback(scripts, frames))
+        elapsed = time.perf_counter() - start
+        for session in sessions:
+            print(session.summary())
+        print("{0} frames in {1:.2f}s, same state: {2}".format(
+            frames, elapsed, len(set(session.controller.checksum()
+                                     for session in sessions)) == 1))
+
+
+if __name__ == "__main__":
+    main()
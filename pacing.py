@@ -0,0 +1,130 @@
+'''
+Frame pacing: the simulation advances in fixed steps of 1 / FPS seconds
+whatever the render rate: steps are run whenever their deadline has
+passed. Frames are rendered at their own rate, between the last two
+steps (how far the clock is past the last step), so motion stays smooth
+when the two rates differ. A frame that would not be drawn before the next step
+is due waits until after that step, a few times in a row at most: when
+drawing gets expensive the render rate drops, the game does not slow down.
+'''
+import time
+
+from utils import *
+
+# frames rendered per second at most
+PACING_RENDER_FPS = 60
+# simulation steps run in one tick to catch up, time beyond is dropped
+PACING_MAX_STEPS = 5
+# times in a row a due frame may be put off, even under load
+PACING_MAX_RENDER_SKIP = 4
+# weight of the last sample in the running render cost estimate
+PACING_COST_SMOOTHING = 0.2
+
+
+class FrameScheduler():
+    '''
+    Runs a GameController: tick() simulates the steps that are due and
+    renders a frame when one is due, wait() sleeps until the next of them.
+    renderRate - frames per second, PACING_RENDER_FPS by default
+    interpolate - draw between simulation steps (sets
+    controller.interpolate), else frames show the last step
+    clock, sleep - time source in seconds and how to wait, time.perf_counter
+    and time.sleep by default
+    simulate - runs one step, controller.simulate by default
+    '''
+
+    def __init__(self, controller, renderRate=None, maxSteps=None,
+                 maxRenderSkip=None, interpolate=True, clock=None, sleep=None,
+                 simulate=None):
+        self.controller = controller
+        self.simulate = optional(simulate, controller.simulate)
+        self.step = 1 / controller.FPS
+        self.renderInterval = 1 / optional(renderRate, PACING_RENDER_FPS)
+        self.maxSteps = optional(maxSteps, PACING_MAX_STEPS)
+        self.maxRenderSkip = optional(maxRenderSkip, PACING_MAX_RENDER_SKIP)
+        self.clock = optional(clock, time.perf_counter)
+        self.sleep = optional(sleep, time.sleep)
+        controller.interpolate = interpolate
+
+        self.nextStep = None  # clock when the next step is due
+        self.nextRender = None
+        self.deferred = False  # a due frame waits for the next step
+        self.skipped = 0  # times in a row the due frame was put off
+        self.renderCost = 0  # running estimate, in seconds
+
+        self.steps = 0
+        self.renders = 0
+        self.skips = 0  # due frames put off to after a step
+        self.dropped = 0  # seconds of simulation given up, see maxSteps
+
+    def smooth(self, estimate, sample):
+        return estimate + (sample - estimate)*PACING_COST_SMOOTHING
+
+    def tick(self):
+        '''
+        simulate what is due, then render if a frame is due
+        return rects of the screen that changed
+        '''
+        profiler = self.controller.profiler
+        now = self.clock()
+        if self.nextStep == None:
+            self.nextStep = now + self.step
+            self.nextRender = now
+        profiler.beginFrame()
+        steps = 0
+        while now >= self.nextStep and steps < self.maxSteps:
+            self.simulate()
+            self.nextStep += self.step
+            steps += 1
+        if now >= self.nextStep:
+            # too far behind to catch up: let the game slow down instead
+            behind = (now - self.nextStep) // self.step + 1
+            self.dropped += behind * self.step
+            self.nextStep += behind * self.step
+        self.steps += steps
+        if steps > 0:
+            self.deferred = False
+
+        rects = []
+        now = self.clock()
+        if now >= self.nextRender and not self.deferred:
+            if self.renderCost > self.nextStep - now and \
+                    self.skipped < self.maxRenderSkip:
+                self.deferred = True
+                self.skipped += 1
+                self.skips += 1
+            else:
+                rects = self.controller.render(self.alpha(now))
+                self.renderCost = self.smooth(self.renderCost,
+                                              self.clock() - now)
+                self.nextRender += self.renderInterval
+                if self.nextRender <= now:
+                    # late: keep the rate, not the phase
+                    self.nextRender = now + self.renderInterval
+                self.skipped = 0
+                self.renders += 1
+        self.controller.countFrame()
+        profiler.count("steps per tick", steps)
+        profiler.endFrame()
+        return rects
+
+    def alpha(self, now):
+        ''' how far the time now is between the last step and the next '''
+        return min(1, max(0, 1 - (self.nextStep - now) / self.step))
+
+    def idle(self):
+        ''' seconds until a step or a frame is due '''
+        now = self.clock()
+        if self.nextStep == None:
+            return 0
+        wait = self.nextStep - now
+        if not self.deferred:
+            wait = min(wait, self.nextRender - now)
+        return max(0, wait)
+
+    def wait(self):
+        self.sleep(self.idle())
+
+    def summary(self):
+        return "steps: {0} frames: {1} put off: {2} dropped: {3:.3f}s".format(
+            self.steps, self.renders, self.skips, self.dropped)
@@ -0,0 +1,91 @@
+'''
+Parallel stepping of columnar particles by spatial tiles.
+The cell grid is cut into tiles of whole cell columns. Every frame each
+particle goes to the tile under it and the tiles are stepped by a thread
+pool: NumPy releases the GIL inside its kernels, so tiles use several
+cores. Forces and integration only depend on the particle itself and its
+owner, so the result is bit for bit the one of ParticleStore.physicalStep
+whatever the tiling; a particle crossing a tile border simply belongs to
+the other tile next frame.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import *
+
+# below this many particles per tile, stepping serially is faster
+PARALLEL_MIN_TILE_PARTICLES = 4096
+
+
+class TileStepper():
+    '''
+    Steps a ParticleStore tile by tile on a pool of worker threads,
+    to be set as ParticleFrameManager.stepper.
+    workers - threads, cpu count by default; tiles - defaults to workers.
+    On a single core threads only add overhead, so it steps serially
+    whatever workers is.
+    '''
+
+    def __init__(self, grid, workers=None, tiles=None, minTileParticles=None):
+        self.grid = grid
+        self.cores = os.cpu_count() or 1
+        self.workers = optional(workers, self.cores)
+        self.tiles = max(1, min(grid.cols, optional(tiles, self.workers)))
+        self.minTileParticles = optional(minTileParticles,
+                                         PARALLEL_MIN_TILE_PARTICLES)
+        self.pool = None
+
+    def tileOf(self, positions):
+        ''' tile of every row of a (n, 2) position array '''
+        ix = np.trunc(np.nan_to_num(positions[:, 0]) / self.grid.interX)
+        ix = np.clip(ix, 0, self.grid.cols - 1).astype(np.int64)
+        return ix * self.tiles // self.grid.cols
+
+    def partition(self, store):
+        '''
+        rows of the store in each tile, as sorted int arrays.
+        Tiles are merged with their neighbours until they hold at least
+        minTileParticles, empty ones are left out.
+        '''
+        tile = self.tileOf(store.columns()[0])
+        order = np.argsort(tile, kind="stable")
+        sizes = np.bincount(tile, minlength=self.tiles)
+        parts = []
+        start = 0
+        stop = 0
+        for size in sizes.tolist():
+            stop += size
+            if stop - start >= self.minTileParticles:
+                parts.append(np.sort(order[start:stop]))
+                start = stop
+        if stop > start:
+            if len(parts) > 0:
+                parts[-1] = np.sort(np.concatenate((parts[-1],
+                                                    order[start:stop])))
+            else:
+                parts.append(np.sort(order[start:stop]))
+        return parts
+
+    def physicalStep(self, store, step=1, integrator=None):
+        if min(self.workers, self.cores) <= 1 \
+                or len(store) < 2 * self.minTileParticles:
+            store.physicalStep(step, integrator)
+            return
+        parts = self.partition(store)
+        if len(parts) == 1:
+            store.physicalStep(step, integrator)
+            return
+        if self.pool == None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        futures = [self.pool.submit(store.physicalStepRows, rows, step,
+                                    integrator)
+                   for rows in parts]
+        for future in futures:
+            future.result()
+
+    def close(self):
+        if self.pool != None:
+            self.pool.shutdown()
+            self.pool = None
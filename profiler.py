@@ -0,0 +1,180 @@
+'''
+Frame profiler: per-stage timers with rolling percentiles, per-frame
+counters and an optional trace in Chrome's trace event format
+(load it in chrome://tracing or https://ui.perfetto.dev).
+'''
+import json
+import sys
+import time
+from collections import deque, OrderedDict
+
+
+class NullProfiler():
+    ''' does nothing, for code running without a profiler '''
+
+    class NullStage():
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+    STAGE = NullStage()
+
+    def stage(self, name):
+        return self.STAGE
+
+    def count(self, name, value):
+        pass
+
+
+class StageTimer():
+    ''' context manager timing one stage of the current frame '''
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.addTime(self.name, self.start, time.perf_counter())
+        return False
+
+
+class FrameProfiler():
+    '''
+    Times stages of a frame and keeps the last window frames.
+    beginFrame() / endFrame() delimit a frame ("frame" stage),
+    stage(name) times a part of it, count(name, value) records a counter.
+    Besides given counters, net allocated memory blocks are counted.
+    '''
+    FRAME = "frame"
+    PERCENTILES = (50, 95, 99)
+    MAX_TRACE_EVENTS = 1000000
+
+    def __init__(self, window=240):
+        self.window = window
+        self.times = OrderedDict()  # stage -> deque of ms per frame
+        self.counters = OrderedDict()  # name -> deque of values
+        self.current = {}  # stage -> ms spent in the current frame
+        self.frameStarts = deque(maxlen=window)
+        self.frameStart = None
+        self.blocks = 0
+        self.frames = 0
+        self.trace = None  # list of trace events while tracing
+        self.origin = time.perf_counter()
+
+    def beginFrame(self):
+        self.frameStart = time.perf_counter()
+        self.frameStarts.append(self.frameStart)
+        self.current = {}
+        self.blocks = sys.getallocatedblocks()
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def addTime(self, name, start, stop):
+        self.current[name] = self.current.get(name, 0) + \
+            (stop - start) * 1000
+        if self.trace != None and len(self.trace) < self.MAX_TRACE_EVENTS:
+            self.trace.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (stop - start) * 1e6,
+                "pid": 0,
+                "tid": 0
+            })
+
+    def count(self, name, value):
+        if name not in self.counters:
+            self.counters[name] = deque(maxlen=self.window)
+        self.counters[name].append(value)
+
+    def endFrame(self):
+        if self.frameStart == None:
+            return
+        self.addTime(self.FRAME, self.frameStart, time.perf_counter())
+        self.count("allocated blocks", sys.getallocatedblocks() - self.blocks)
+        for name, value in self.current.items():
+            if name not in self.times:
+                self.times[name] = deque(maxlen=self.window)
+            self.times[name].append(value)
+        self.frameStart = None
+        self.frames += 1
+
+    def fps(self):
+        if len(self.frameStarts) < 2:
+            return 0
+        span = self.frameStarts[-1] - self.frameStarts[0]
+        return (len(self.frameStarts) - 1) / span if span > 0 else 0
+
+    @staticmethod
+    def percentile(values, q):
+        values = sorted(values)
+        if len(values) == 0:
+            return 0
+        index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+        return values[index]
+
+    def report(self):
+        '''
+        {"fps", "stages": {stage: {"p50", "p95", "p99", "mean"}} (ms),
+        "counters": {name: last value}}
+        '''
+        stages = OrderedDict()
+        for name, values in self.times.items():
+            stats = OrderedDict()
+            for q in self.PERCENTILES:
+                stats["p{0}".format(q)] = self.percentile(values, q)
+            stats["mean"] = sum(values) / len(values)
+            stages[name] = stats
+        counters = OrderedDict(
+            (name, values[-1]) for name, values in self.counters.items())
+        return {"fps": self.fps(), "stages": stages, "counters": counters}
+
+    def summaryLines(self):
+        report = self.report()
+        lines = ["{0:.1f} FPS over {1} frames".format(
+            report["fps"], len(self.frameStarts))]
+        for name, stats in report["stages"].items():
+            lines.append("{0:<18} p50 {1:6.2f}  p95 {2:6.2f}  p99 {3:6.2f} ms"
+                         .format(name, stats["p50"], stats["p95"],
+                                 stats["p99"]))
+        for name, value in report["counters"].items():
+            lines.append("{0:<18} {1}".format(name, value))
+        return lines
+
+    def summary(self):
+        return "\n".join(self.summaryLines())
+
+    def startTrace(self):
+        self.trace = []
+
+    def isTracing(self):
+        return self.trace != None
+
+    def stopTrace(self, path):
+        ''' write the trace recorded since startTrace to path '''
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.trace,
+                       "displayTimeUnit": "ms"}, file)
+        self.trace = None
+
+    def renderOverlay(self, surface, font, pos=(4, 4)):
+        '''
+        draw the summary on surface with a pygame font,
+        return the rect drawn
+        '''
+        x, y = pos
+        rect = None
+        for line in self.summaryLines():
+            text = font.render(line, True, (0, 0, 0), (255, 255, 255))
+            drawn = surface.blit(text, (x, y))
+            rect = drawn if rect == None else rect.union(drawn)
+            y += text.get_height()
+        return rect
@@ -0,0 +1,203 @@
+'''
+Replays: a match is recorded as its key input per frame plus a seed,
+saved in a compact binary file and played back headlessly.
+Playback keeps periodic keyframes (saved controller states) so seeking
+to a frame only simulates from the nearest keyframe before it.
+Recordings also hold state checksums every few frames: playback reports
+the first frame where it diverges from the recorded match.
+
+usage: python replay.py <replay> [frame to seek to]
+'''
+import random
+import struct
+import sys
+import time
+
+import numpy as np
+import pygame
+
+from utils import *
+from control import *
+from headless import *
+
+REPLAY_MAGIC = b"PTRP"
+REPLAY_VERSION = 1
+# frames between two recorded checksums
+REPLAY_CHECKSUM_INTERVAL = 40
+# frames between two keyframes kept during playback
+REPLAY_KEYFRAME_INTERVAL = 200
+
+
+class Replay():
+    '''
+    Recorded match: seed, fps, number of frames, key events
+    (an InputScript) and checksums (frame -> crc of the state once that
+    many frames were simulated).
+    Binary layout, little endian: header, events, checksums.
+    '''
+    HEADER = struct.Struct("<4sHIHIIHI")
+    EVENT = struct.Struct("<IBI")  # frame, 0 down / 1 up, key
+    CHECKSUM = struct.Struct("<II")  # frame, crc32
+    TYPES = [pygame.KEYDOWN, pygame.KEYUP]
+
+    def __init__(self, seed=0, fps=CONTROLLER_UPDATE_FPS):
+        self.seed = seed
+        self.fps = fps
+        self.frames = 0
+        self.script = InputScript()
+        self.checksums = {}
+        self.checksumInterval = REPLAY_CHECKSUM_INTERVAL
+
+    def events(self):
+        ''' (frame, type, key) in playing order '''
+        for frame in sorted(self.script.events):
+            for eventType, key in self.script.events[frame]:
+                yield frame, eventType, key
+
+    def toBytes(self):
+        events = list(self.events())
+        chunks = [self.HEADER.pack(
+            REPLAY_MAGIC, REPLAY_VERSION, self.seed, self.fps, self.frames,
+            len(events), self.checksumInterval, len(self.checksums))]
+        for frame, eventType, key in events:
+            chunks.append(self.EVENT.pack(
+                frame, self.TYPES.index(eventType), key))
+        for frame in sorted(self.checksums):
+            chunks.append(self.CHECKSUM.pack(frame, self.checksums[frame]))
+        return b"".join(chunks)
+
+    @classmethod
+    def fromBytes(cls, data):
+        magic, version, seed, fps, frames, events, interval, checksums = \
+            cls.HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("not a replay file")
+        if version != REPLAY_VERSION:
+            raise ValueError("unsupported replay version {0}".format(version))
+        replay = cls(seed, fps)
+        replay.frames = frames
+        replay.checksumInterval = interval
+        offset = cls.HEADER.size
+        for frame, eventType, key in cls.EVENT.iter_unpack(
+                data[offset:offset + events * cls.EVENT.size]):
+            replay.script.add(frame, cls.TYPES[eventType], key)
+        offset += events * cls.EVENT.size
+        for frame, crc in cls.CHECKSUM.iter_unpack(
+                data[offset:offset + checksums * cls.CHECKSUM.size]):
+            replay.checksums[frame] = crc
+        return replay
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.toBytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            return cls.fromBytes(file.read())
+
+
+def seedEverything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+class ReplayRecorder():
+    '''
+    Records a controller from its current frame on: set as
+    controller.recorder, it gets every key event the players receive
+    and every simulated frame.
+    '''
+
+    def __init__(self, controller, seed=None):
+        self.replay = Replay(optional(seed, random.randrange(2**32)),
+                             controller.FPS)
+        self.start = controller.frame
+        seedEverything(self.replay.seed)
+        controller.recorder = self
+
+    def recordEvent(self, frame, event):
+        self.replay.script.add(frame - self.start, event.type, event.key)
+
+    def recordFrame(self, controller):
+        frame = controller.frame - self.start
+        self.replay.frames = frame
+        if frame % self.replay.checksumInterval == 0:
+            self.replay.checksums[frame] = controller.checksum()
+
+    def save(self, path):
+        self.replay.save(path)
+
+
+class ReplayPlayer():
+    '''
+    Plays a replay on a headless controller, as fast as it can.
+    Every keyframeInterval frames the controller state is kept, seek()
+    goes back to the closest one before the target and plays from there.
+    desync is the first checksum frame that does not match, if any.
+    '''
+
+    def __init__(self, replay, keyframeInterval=None, controller=None):
+        self.replay = replay
+        self.keyframeInterval = optional(keyframeInterval,
+                                         REPLAY_KEYFRAME_INTERVAL)
+        seedEverything(replay.seed)
+        self.runner = HeadlessRunner(replay.script, controller)
+        self.keyframes = {0: self.runner.controller.saveState()}
+        self.desync = None
+
+    def frame(self):
+        return self.runner.frame
+
+    def step(self):
+        self.runner.step()
+        frame = self.runner.frame
+        crc = self.replay.checksums.get(frame)
+        if crc != None and self.desync == None and \
+                crc != self.runner.controller.checksum():
+            self.desync = frame
+        if frame % self.keyframeInterval == 0 and \
+                frame not in self.keyframes:
+            self.keyframes[frame] = self.runner.controller.saveState()
+
+    def play(self, frames=None):
+        ''' play frames more frames, to the end of the replay by default '''
+        stop = self.replay.frames if frames == None \
+            else self.runner.frame + frames
+        while self.runner.frame < stop:
+            self.step()
+        return self.runner.summary()
+
+    def seek(self, frame):
+        ''' get to the state after simulating frame frames '''
+        start = max(key for key in self.keyframes if key <= frame)
+        if not (start <= self.runner.frame <= frame):
+            self.runner.controller.loadState(self.keyframes[start])
+            self.runner.frame = start
+        return self.play(frame - self.runner.frame)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    replay = Replay.load(sys.argv[1])
+    player = ReplayPlayer(replay)
+    start = time.perf_counter()
+    if len(sys.argv) > 2:
+        summary = player.seek(int(sys.argv[2]))
+    else:
+        summary = player.play()
+    elapsed = time.perf_counter() - start
+    print(summary)
+    print("{0} frames in {1:.2f}s, {2:.0f} frames/s".format(
+        player.frame(), elapsed, player.frame() / max(elapsed, 1e-9)))
+    if player.desync != None:
+        print("DESYNC: state differs from the recording at frame",
+              player.desync)
+    else:
+        print("checksums match the recording")
+
+
+if __name__ == "__main__":
+    main()
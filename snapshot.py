@@ -0,0 +1,291 @@
+'''
+Binary snapshots of a ParticleManager: live particles, the shared frame
+history with the timelines of rewound containers, and player cores.
+Owners are written by identity and resolved again when restoring.
+The file is a header followed by 8-byte aligned packed arrays, so a
+snapshot read from bytes or a memory mapped file is used in place:
+history groups stay views on the buffer, only live particles are copied.
+Snapshots are taken between frames (nothing pending in the history).
+'''
+import mmap
+import struct
+import sys
+
+import numpy as np
+
+from utils import *
+
+SNAPSHOT_MAGIC = b"PTSN"
+SNAPSHOT_VERSION = 1
+# header flag: the snapshot holds the frame history
+SNAPSHOT_HISTORY = 1
+
+
+def padding(size):
+    return -size % 8
+
+
+class ManagerSnapshot():
+    '''
+    Packed state of a ParticleManager.
+    names - identities of the owner table (None for particles without
+    owner), followed by identities of players; columns - particle rows,
+    live particles first; frames - entry index of every frame kept in
+    history, oldest first, and samples the frame of each; groups - (entry,
+    key x, key y, start, count) rows of the history; segments - (key x,
+    key y, local start, lag) timelines of rewound containers; cores -
+    player cores.
+    '''
+    HEADER = struct.Struct("<4sHHqIIQQIIII")
+    GROUP = np.dtype([("entry", "<u4"), ("keyX", "<i8"), ("keyY", "<i8"),
+                      ("start", "<u8"), ("count", "<u8")])
+    SEGMENT = np.dtype([("keyX", "<i8"), ("keyY", "<i8"),
+                        ("localStart", "<f8"), ("lag", "<f8")])
+    CORE = np.dtype([("player", "<u4"), ("owner", "<u4"), ("pos", "<f8", 2),
+                     ("vel", "<f8", 2), ("acc", "<f8", 2), ("mass", "<f8")])
+    COLUMNS = (("pos", "<f8", 2), ("vel", "<f8", 2), ("acc", "<f8", 2),
+               ("mass", "<f8", 1), ("owner", "<i4", 1), ("born", "<i8", 1))
+    NO_NAME = 0xFFFF
+
+    def __init__(self):
+        self.flags = 0
+        self.frame = 0
+        self.names = []
+        self.owners = 0  # the first names are the owner table
+        self.live = 0
+        self.columns = [np.zeros((0, 2)), np.zeros((0, 2)), np.zeros((0, 2)),
+                        np.zeros(0), np.zeros(0, dtype=np.int32),
+                        np.zeros(0, dtype=np.int64)]
+        self.frames = np.zeros(0, dtype="<u4")
+        self.samples = np.zeros(0, dtype="<i8")
+        self.groups = np.zeros(0, dtype=self.GROUP)
+        self.segments = np.zeros(0, dtype=self.SEGMENT)
+        self.cores = np.zeros(0, dtype=self.CORE)
+
+    @classmethod
+    def capture(cls, manager, players=(), history=True):
+        '''
+        snapshot of manager and the cores of players,
+        history=False keeps live particles and cores only
+        '''
+        frame = manager.frame
+        snapshot = cls()
+        snapshot.frame = frame.history.frame
+        owners = frame.owners if frame.columnar else OwnerTable()
+        stores = [cls.asStore(frame.group, owners)]
+        if history:
+            snapshot.flags |= SNAPSHOT_HISTORY
+            entryIndex = {}
+            frames = []
+            groups = []
+            start = len(stores[0])
+            for entry, size in frame.history.entries:
+                if id(entry) not in entryIndex:
+                    entryIndex[id(entry)] = len(entryIndex)
+                    for key, group in entry.items():
+                        store = cls.asStore(group, owners)
+                        groups.append((entryIndex[id(entry)],) +
+                                      cls.checkKey(key) + (start, len(store)))
+                        stores.append(store)
+                        start += len(store)
+                frames.append(entryIndex[id(entry)])
+            snapshot.frames = np.array(frames, dtype="<u4")
+            snapshot.samples = np.array(frame.history.samples, dtype="<i8")
+            snapshot.groups = np.array(groups, dtype=cls.GROUP)
+            segments = [cls.checkKey(key) + segment
+                        for key, container in frame.rewound.items()
+                        for segment in container.segments]
+            snapshot.segments = np.array(segments, dtype=cls.SEGMENT)
+        snapshot.live = len(stores[0])
+        snapshot.columns = [np.concatenate([store.columns()[i]
+                                            for store in stores])
+                            for i in range(len(cls.COLUMNS))]
+        snapshot.names = [None if owner == None else owner.identity
+                          for owner in owners.owners]
+        snapshot.owners = len(snapshot.names)
+        cores = []
+        for player in players:
+            core = player.core
+            snapshot.names.extend([player.identity, core.owner.identity])
+            cores.append((len(snapshot.names) - 2, len(snapshot.names) - 1,
+                          core.pos.toTuple(), core.vel.toTuple(),
+                          core.acc.toTuple(), core.mass))
+        snapshot.cores = np.array(cores, dtype=cls.CORE)
+        return snapshot
+
+    @staticmethod
+    def asStore(group, owners):
+        if isinstance(group, ParticleStore) and group.owners is owners:
+            return group
+        store = ParticleStore(owners=owners)
+        store.extend(group)
+        return store
+
+    @staticmethod
+    def checkKey(key):
+        if len(key) != 2 or not all(isinstance(k, int) for k in key):
+            raise ValueError("only (int, int) container keys are supported")
+        return tuple(key)
+
+    def toBytes(self):
+        names = b""
+        for name in self.names:
+            if name == None:
+                names += struct.pack("<H", self.NO_NAME)
+            else:
+                encoded = str(name).encode("utf-8")
+                names += struct.pack("<H", len(encoded)) + encoded
+        names += bytes(padding(len(names)))
+        chunks = [self.HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.flags, self.frame,
+            len(self.names), self.owners, len(self.columns[3]), self.live,
+            len(self.frames), len(self.groups), len(self.segments),
+            len(self.cores)), bytes(padding(self.HEADER.size)), names]
+        arrays = [self.frames, self.samples, self.groups, self.segments,
+                  self.cores]
+        arrays += [np.ascontiguousarray(column, dtype=dtype)
+                   for column, (name, dtype, width) in
+                   zip(self.columns, self.COLUMNS)]
+        for array in arrays:
+            data = array.tobytes()
+            chunks.append(data)
+            chunks.append(bytes(padding(len(data))))
+        return b"".join(chunks)
+
+    @classmethod
+    def fromBuffer(cls, buffer):
+        '''
+        read a snapshot from bytes, a memoryview or an mmap,
+        its arrays are views on the buffer (read only for bytes)
+        '''
+        buffer = memoryview(buffer)
+        snapshot = cls()
+        (magic, version, snapshot.flags, snapshot.frame, names,
+         snapshot.owners, rows, snapshot.live, frames, groups, segments,
+         cores) = cls.HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a particle snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("unsupported snapshot version {0}".format(
+                version))
+        offset = cls.HEADER.size + padding(cls.HEADER.size)
+        start = offset
+        for i in range(names):
+            size, = struct.unpack_from("<H", buffer, offset)
+            offset += 2
+            if size == cls.NO_NAME:
+                snapshot.names.append(None)
+            else:
+                snapshot.names.append(
+                    bytes(buffer[offset:offset + size]).decode("utf-8"))
+                offset += size
+        offset += padding(offset - start)
+
+        def read(dtype, count, shape=()):
+            nonlocal offset
+            dtype = np.dtype(dtype)
+            array = np.frombuffer(buffer, dtype,
+                                  count * int(np.prod(shape)), offset)
+            offset += array.nbytes + padding(array.nbytes)
+            return array.reshape((count,) + shape)
+
+        snapshot.frames = read("<u4", frames)
+        snapshot.samples = read("<i8", frames)
+        snapshot.groups = read(cls.GROUP, groups)
+        snapshot.segments = read(cls.SEGMENT, segments)
+        snapshot.cores = read(cls.CORE, cores)
+        snapshot.columns = [read(dtype, rows, (width,) if width > 1 else ())
+                            for name, dtype, width in cls.COLUMNS]
+        return snapshot
+
+    def resolveOwners(self, players=(), owners=()):
+        '''
+        identity -> owner, from players and owners. Core owners are left
+        out: they may share the identity of their player (PlayerData does).
+        '''
+        known = {}
+        for owner in owners:
+            known[owner.identity] = owner
+        for player in players:
+            known[player.identity] = player
+        return known
+
+    def restore(self, manager, players=(), owners=()):
+        '''
+        load the snapshot into manager and the cores of players.
+        Owners are found by identity among players and owners, an unknown
+        identity raises KeyError; a core keeps the owner of the player's
+        current core.
+        '''
+        frame = manager.frame
+        known = self.resolveOwners(players, owners)
+        manager.effects.clear()  # queued after the snapshot was taken
+        table = OwnerTable()
+        remap = np.array([table.indexOf(None if name == None
+                                        else known[name])
+                          for name in self.names[:self.owners]],
+                         dtype=np.int32)
+        pos, vel, acc, mass, owner, born = self.columns
+        if not np.array_equal(remap, np.arange(len(remap))):
+            owner = remap[owner]
+        store = ParticleStore(0, table)
+        store.pos, store.vel, store.acc, store.mass, store.owner, \
+            store.born = pos, vel, acc, mass, owner, born
+        store.size = len(mass)
+
+        def group(start, stop):
+            rows = store.slice(start, stop)
+            if frame.columnar:
+                return rows
+            return ParticleGroup(view.toState() for view in rows)
+
+        frame.owners = table
+        if frame.columnar:
+            frame.group = store.slice(0, self.live).copy()
+        else:
+            frame.group = group(0, self.live)
+        history = frame.history
+        history.pending = {}
+        history.frame = self.frame
+        history.clear()
+        if self.flags & SNAPSHOT_HISTORY and len(self.frames) > 0:
+            history.evict()  # the empty sample clear() leaves
+            entries = [{} for i in range(int(self.frames.max(initial=0)) + 1)]
+            for row in self.groups.tolist():
+                index, keyX, keyY, start, count = row
+                entries[index][(keyX, keyY)] = group(start, start + count)
+            for index, sample in zip(self.frames.tolist(),
+                                     self.samples.tolist()):
+                entry = entries[index]
+                size = sys.getsizeof(entry) + \
+                    sum(groupBytes(group) for group in entry.values())
+                history.append(entry, sample, size)
+        for container in frame.rewound.values():
+            container.segments = []
+        frame.rewound.clear()
+        for keyX, keyY, localStart, lag in self.segments.tolist():
+            container = frame.containers[(keyX, keyY)]
+            container.segments.append((localStart, lag))
+            frame.rewound[(keyX, keyY)] = container
+        for core in self.cores:
+            player = known[self.names[core["player"]]]
+            player.core = ParticleState(
+                owner=player.core.owner,
+                pos=Vec2d(core["pos"].tolist()),
+                vel=Vec2d(core["vel"].tolist()),
+                acc=Vec2d(core["acc"].tolist()),
+                mass=float(core["mass"])
+            )
+        manager.layout += 1
+        manager.updateStatistics()
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.toBytes())
+
+    @classmethod
+    def load(cls, path):
+        ''' map the file and read the snapshot from it, without copying '''
+        with open(path, "rb") as file:
+            return cls.fromBuffer(
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
@@ -4,6 +4,12 @@ from pygame.locals import *
 from utils import *
 from game import *
 from control import *
+from headless import *
+from profiler import *
+from replay import *
+from snapshot import *
+from pacing import *
+from netplay import *
 
 
 class OwnerTester(ParticleOwnerBase):
@@ -36,6 +42,19 @@ def testVec2d():
     print(a.dist(b), a.distManhattan(b))
     print("b is inside A(r=2): ", b.isInsideCircle(a, 2))
     print("b is inside A(r=3): ", b.isInsideCircle(a, 3))
+    c = Vec2d(1, 2)
+    c += b
+    c *= 2
+    c.scaledAdd(a, -0.5)
+    print("in place: ", c, "unchanged: ", a, b)
+    pool = Vec2dPool(1)
+    e, f = pool.take(1, 1), pool.take(2, 2)
+    pool.reset()
+    print("pool reuses vectors: ", pool.take() is e, len(pool.vectors))
+    try:
+        a + 1
+    except TypeError:
+        print("vec + number raises TypeError")
 
 
 def genParticle():
@@ -86,6 +105,467 @@ def testParticleGroup():
         print(ele)
 
 
+def testParticleStore():
+    print("===testParticleStore===")
+    group = ParticleGroup()
+    state = genParticle()
+    for i in range(3):
+        group.append(state)
+        state = state.physicalStepCopy()
+    store = ParticleStore()
+    store.extend(group)
+    print("stored {0} particles, first: {1}".format(len(store), store[0]))
+    steppedGroup = group.physicalStepCopy()
+    store.physicalStep()
+    print("stepped in place:")
+    for view, state in zip(store, steppedGroup):
+        print(view)
+        print("matches ParticleState step: ",
+              view.pos.toTuple() == state.pos.toTuple() and
+              view.vel.toTuple() == state.vel.toTuple())
+    snapshot = store.copy()
+    store.physicalStep()
+    print("snapshot untouched by next step: ",
+          snapshot[0].pos.toTuple() != store[0].pos.toTuple())
+
+
+def testForceBatch():
+    print("===testForceBatch===")
+    player = Player("tester", None, None, (255, 0, 0), (3, 4))
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((1, 0)))
+    group = ParticleGroup()
+    for i in range(4):
+        group.append(ParticleState(owner=player, mass=1 + i / 10,
+                                   vel=Vec2d((i, -i)), pos=Vec2d((i, 2*i))))
+    store = ParticleStore()
+    store.extend(group)
+    pos, vel, acc, mass, _, _ = store.columns()
+    for tester in (player, owner):
+        forces = tester.getForceBatch(pos, vel, mass)
+        for particle, force in zip(group, forces):
+            single = tester.getForce(particle).toTuple()
+            print(single, tuple(force.tolist()), np.allclose(single, force))
+
+
+def testParticleLifetime():
+    print("===testParticleLifetime===")
+    store = ParticleStore()
+    owner = OwnerTester("tester")
+    store.appendBatch(owner, [(i, 0) for i in range(10)],
+                      np.zeros((10, 2)), np.ones(10))
+    capacity = len(store.mass)
+    store.remove(np.array([1, 8, 3]))
+    print("removed by swapping in the tail: ",
+          store.columns()[0][:, 0].tolist(), "capacity kept: ",
+          len(store.mass) == capacity)
+    for columnar in (False, True):
+        manager = ParticleManager(columnar=columnar)
+        player = Player("emitter", manager, owner, (255, 0, 0), (320, 240))
+        player.timeToLive = 50
+        player.emitter = ParticleEmitter(player, rate=2.5, speed=0.5)
+        manager.spawn(owner, [(-5, 10)])  # outside the world
+        buffers = []
+        for i in range(200):
+            player.step()
+            manager.step()
+            if i >= 100 and columnar:
+                buffers.append(id(manager.frame.group.pos))
+        counts = {identity: count for identity, count
+                  in manager.statistics.items() if count != 0}
+        manager.updateStatistics()
+        ages = [manager.now() - particle.born
+                for particle in manager.frame.group]
+        print("columnar: ", columnar, "live: ", len(manager.frame.group),
+              "counts kept up: ", counts == dict(manager.statistics),
+              "oldest: ", max(ages), "outside dropped: ",
+              manager.particleCountOf(owner) == 0)
+        if columnar:
+            print("no reallocation at steady state: ", len(set(buffers)) == 1)
+
+
+def testInteractions():
+    print("===testInteractions===")
+    grid = CellGrid((100, 80), (10, 10))
+    rand = np.random.RandomState(3)
+    positions = rand.uniform((0, 0), (100, 80), (400, 2))
+    found = set()
+    for i, j, delta, dist in NeighborList(
+            searchGrid(grid, 4), positions).pairs(4, chunk=300):
+        found.update(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+    brute = set((a, b) for a in range(400) for b in range(a + 1, 400)
+                if np.hypot(*(positions[a] - positions[b])) < 4)
+    print("neighbour pairs: ", len(found), "same as brute force: ",
+          found == brute)
+    results = []
+    for columnar in (False, True):
+        manager = ParticleManager((100, 80), (10, 10), columnar=columnar)
+        red, blue = OwnerTester("red"), OwnerTester("blue")
+        manager.spawn(red, [(20, 20), (20.5, 20), (50, 50), (60, 60),
+                            (61, 60), (60, 61)])
+        manager.spawn(blue, [(22, 20), (52, 50), (60.5, 60.5), (80, 10)])
+        engine = InteractionEngine(radius=4, repulsion=1, capture=2)
+        manager.interactions = engine
+        despawned = engine.apply(manager)
+        counts = dict(manager.statistics)
+        manager.updateStatistics()
+        particles = sorted((particle.owner.identity, particle.pos.toTuple(),
+                            particle.vel.toTuple())
+                           for particle in manager.frame.group)
+        results.append(particles)
+        print("columnar: ", columnar, "annihilated: ", despawned,
+              "captured: ", engine.captured,
+              "counts kept up: ", counts == dict(manager.statistics))
+        for particle in particles:
+            print(particle)
+    print("same in both modes: ", results[0] == results[1])
+
+
+def testSparseStepping():
+    print("===testSparseStepping===")
+    manager = ParticleManager()
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.5, 0)))
+    manager.addParticlesToBuffer(
+        [ParticleState(owner=owner, pos=Vec2d((15, 15))) for i in range(3)])
+    manager.commitParticles()
+    for i in range(5):
+        manager.step()
+    frame = manager.frame
+    print("containers: {0}, active: {1}, frame: {2}".format(
+        len(frame.containers), len(list(frame.activeContainers())),
+        frame.history.frame))
+    manager.backward(lambda key: 5)
+    print("after rewinding all cells by 5: ",
+          [p.pos.toTuple() for p in frame.group])
+
+
+def testCellGrid():
+    print("===testCellGrid===")
+    grid = CellGrid((50, 40), (10, 10))
+    print("cells: ", grid.count, "index of (20, 30): ", grid.indexOf((20, 30)),
+          "key of 11: ", grid.keyOf(11))
+    print("positions to cells: ", grid.indexBatch(
+        np.array([[0.5, 0.5], [49.9, 39.9], [-10.5, 3], [55, 3]])).tolist())
+    print("rect: ", grid.keysOf(grid.queryRect((5, 5), (25, 20))))
+    print("circle: ", grid.keysOf(grid.queryCircle((20, 20), 12)))
+    annulus = grid.queryAnnulus((20, 20), 5, 15, manhattan=True)
+    reference = [key for key in grid.keys()
+                 if 5 < abs(20 - key[0]) + abs(20 - key[1]) < 15]
+    print("annulus: ", grid.keysOf(annulus), grid.keysOf(annulus) == reference)
+
+
+def testTileStepper():
+    print("===testTileStepper===")
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.5, -0.25)))
+    managers = [ParticleManager(worldRect=(64, 64), interval=(4, 4),
+                                columnar=True, workers=workers)
+                for workers in (0, 3)]
+    managers[1].frame.stepper.minTileParticles = 10
+    managers[1].frame.stepper.cores = 3
+    for manager in managers:
+        manager.addParticlesToBuffer(
+            [ParticleState(owner=owner, mass=1 + i / 100,
+                           pos=Vec2d((i % 64, i // 2 % 64)))
+             for i in range(200)])
+        manager.commitParticles()
+        for i in range(10):
+            manager.step()
+    stepper = managers[1].frame.stepper
+    print("tiles: ", [len(rows) for rows in
+                      stepper.partition(managers[1].frame.group)])
+    columns = [manager.frame.group.columns() for manager in managers]
+    print("identical to serial: ", all(np.array_equal(a, b)
+                                       for a, b in zip(*columns)))
+    stepper.close()
+    single = TileStepper(managers[1].grid, workers=3, minTileParticles=10)
+    single.cores = 1
+    single.physicalStep(managers[1].frame.group)
+    print("single core steps serially: ", single.pool == None)
+
+
+class SpringTester(ParticleOwnerBase):
+    ''' damped spring pulling particles to (0, 0) '''
+
+    def __init__(self, identity, stiffness, friction):
+        super(SpringTester, self).__init__(identity)
+        self.stiffness = stiffness
+        self.friction = friction
+
+    def getForce(self, particle):
+        return (particle.pos * -self.stiffness).scaledAdd(
+            particle.vel, -self.friction)
+
+
+def testIntegrators():
+    print("===testIntegrators===")
+    owner = SpringTester("spring", 0.5, 1.2)
+    # exact solution from x = 10, v = 0, mass 1: underdamped
+    decay = owner.friction / 2
+    omega = sqrt(owner.stiffness - decay**2)
+    steps = 5
+    exact = 10 * np.exp(-decay * steps) * \
+        (np.cos(omega * steps) + decay / omega * np.sin(omega * steps))
+    for name in sorted(INTEGRATORS):
+        results = []
+        for columnar in (False, True):
+            manager = ParticleManager(worldRect=(64, 64), interval=(4, 4),
+                                      columnar=columnar,
+                                      integrator=INTEGRATORS[name]())
+            manager.frame.group.extend([ParticleState(
+                owner=owner, pos=Vec2d((10, 0)))])
+            for i in range(steps):
+                manager.frame.step()
+            results.append(manager.frame.group[0].pos.x)
+        print(name, "error: ", abs(results[1] - exact),
+              "same in both modes: ", results[0] == results[1])
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.5, -0.25)))
+    managers = [ParticleManager(worldRect=(64, 64), interval=(4, 4),
+                                columnar=True, workers=workers,
+                                integrator=RungeKutta4())
+                for workers in (0, 3)]
+    managers[1].frame.stepper.minTileParticles = 10
+    managers[1].frame.stepper.cores = 3
+    for manager in managers:
+        manager.spawn(owner, [(i % 64, i // 2 % 64) for i in range(200)],
+                      [(i % 7 - 3, i % 5 - 2) for i in range(200)])
+        for i in range(10):
+            manager.step()
+    columns = [manager.frame.group.columns() for manager in managers]
+    print("rk4 by tiles identical to serial: ",
+          all(np.array_equal(a, b) for a, b in zip(*columns)))
+    managers[1].frame.stepper.close()
+
+
+def testFrameHistory():
+    print("===testFrameHistory===")
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.1, 0)))
+    particles = [ParticleState(owner=owner, pos=Vec2d((i, i)))
+                 for i in range(0, 40, 2)]
+    for columnar in (False, True):
+        manager = ParticleManager(worldRect=(64, 64), interval=(4, 4),
+                                  columnar=columnar, historyBudget=20000)
+        manager.addParticlesToBuffer(particles)
+        manager.commitParticles()
+        for i in range(30):
+            manager.step()
+        print("columnar: ", columnar, manager.frame.history.memoryReport())
+        manager.backward(lambda key: 100)
+        print("rewound past the budget, particles left: ",
+              len(manager.frame.group))
+    history = FrameHistory(maxFrames=10)
+    history.pending = {(0, 0): [ParticleState(owner=owner)]}
+    history.commit(1)
+    once = history.bytes
+    history.pending = {(0, 0): [ParticleState(owner=owner)]}
+    history.commit(4)
+    kept = [history.bytes]
+    while len(history.entries) > 0:
+        history.evict()
+        kept.append(history.bytes)
+    print("entry kept 4 frames counted once: ", kept[0] == 2 * once,
+          "freed with its last copy: ", kept)
+
+
+def testHistoryStride():
+    print("===testHistoryStride===")
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.1, 0.05)))
+    for columnar in (False, True):
+        managers = [ParticleManager(worldRect=(64, 64), interval=(64, 64),
+                                    columnar=columnar, historyStride=stride)
+                    for stride in (1, 4)]
+        for manager in managers:
+            manager.addParticlesToBuffer(
+                [ParticleState(owner=owner, pos=Vec2d((i, 2 * i)),
+                               vel=Vec2d((0.2, 0))) for i in range(10)])
+            manager.commitParticles()
+            for i in range(15):
+                manager.step()
+        exact, sampled = [manager.frame.history for manager in managers]
+        print("columnar: ", columnar, "samples: ", list(sampled.samples),
+              "bytes: ", exact.bytes, "->", sampled.bytes)
+
+        def positions(history, frame):
+            return np.array(sorted(particle.pos.toTuple() for particle
+                                   in history.groupAt(frame, (0, 0))))
+        print("sampled frame exact: ",
+              (positions(exact, 9) == positions(sampled, 9)).all(),
+              "frames in between off by: ",
+              [round(float(np.abs(positions(exact, frame) -
+                                  positions(sampled, frame)).max()), 3)
+               for frame in (10, 11, 12.5)])
+        for manager in managers:
+            manager.backward(lambda key: 2.5)
+        print("rewound 2.5 frames: ",
+              [sorted(particle.pos.x for particle in manager.frame.group)[:2]
+               for manager in managers])
+
+
+def testSkillTimers():
+    print("===testSkillTimers===")
+    timers = SkillTimers()
+    fired = []
+    timers.schedule(3, lambda: fired.append("late"))
+    timers.schedule(1, lambda: fired.append("early"))
+    cancelled = timers.schedule(2, lambda: fired.append("cancelled"))
+    timers.cancel(cancelled)
+    cooldown = timers.schedule(2)
+    for i in range(3):
+        timers.advance()
+        print("frame: ", timers.now, "fired: ", fired,
+              "cooldown left: ", timers.remaining(cooldown))
+
+    manager = ParticleManager(worldRect=(200, 200), interval=(10, 10),
+                              columnar=True)
+    player = Player("tester", manager, OwnerTester("core"), (255, 0, 0),
+                    (100, 100))
+    player.loadSkill(1, RingSkill(player))
+    results = [player.command(1), player.command(1), player.command(2)]
+    print("used, cooling down, no skill: ", results == [
+        Result.SUCCEED, Result.SKILL_UNAVAILABLE, Result.INVALID_DIRECTION],
+        "queued cells: ", len(manager.effects.cells()))
+    for i in range(RingSkill.cooldownPeriod):
+        player.step()
+    print("ready again after cooldown: ", player.command(1) == Result.SUCCEED)
+
+    # skills used in one frame rewind in one pass, as they would one by one
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.1, 0)))
+    managers = [ParticleManager(worldRect=(100, 100), interval=(10, 10),
+                                columnar=True) for i in range(2)]
+    for manager in managers:
+        manager.addParticlesToBuffer(
+            [ParticleState(owner=owner, pos=Vec2d((i, i)),
+                           vel=Vec2d((0.5, 0))) for i in range(90)])
+        manager.commitParticles()
+        for i in range(20):
+            manager.step()
+    rings = [range(0, 40), range(20, 60)]
+    for cells in rings:
+        managers[0].backwardCells(np.array(cells), 5)
+        managers[1].queueBackwardCells(np.array(cells), 5)
+    print("rewound keys in one pass: ", managers[1].applyEffects())
+    print("same particles: ",
+          sorted(managers[0].frame.group.columns()[0][:, 0].tolist()) ==
+          sorted(managers[1].frame.group.columns()[0][:, 0].tolist()),
+          dict(managers[0].statistics) == dict(managers[1].statistics))
+
+
+def testTimeField():
+    print("===testTimeField===")
+    grid = CellGrid((40, 40), (10, 10))
+    print("cone: ", grid.keysOf(grid.queryCone((0, 0), (1, 0), pi / 2, 25)),
+          "line: ", grid.keysOf(grid.querySegment((0, 10), (30, 10), 1)))
+    field = TimeField(grid).disk((20, 20), 11, 2).line((0, 0), (30, 0), 2, 3)
+    other = TimeField(grid).ring((20, 20), 5, 11, 1)
+    print("composed: ", field.merge(other).depth.T.tolist())
+
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.1, 0.1)))
+    for columnar in (False, True):
+        managers = [ParticleManager(worldRect=(100, 100), interval=(10, 10),
+                                    columnar=columnar) for i in range(2)]
+        for manager in managers:
+            manager.addParticlesToBuffer(
+                [ParticleState(owner=owner, pos=Vec2d((i % 10 * 5, i // 2)),
+                               vel=Vec2d((0.5, 0.2))) for i in range(100)])
+            manager.commitParticles()
+            for i in range(20):
+                manager.step()
+        history = managers[1].frame.history
+        print("cells with history: ", {
+            managers[1].grid.keyOf(cell): int(history.cellFrames[cell])
+            for cell in np.flatnonzero(history.cellFrames)} ==
+            dict(history.keyFrames))
+        field = TimeField(managers[0].grid)
+        field.cone((0, 0), (1, 1), pi / 3, 60, 4).disk((30, 30), 25, 3)
+        managers[0].backward({managers[0].grid.keyOf(cell):
+                              int(field.depth.flat[cell])
+                              for cell in field.cells()})
+        managers[1].backwardField(field)
+
+        def positions(manager):
+            return sorted(particle.pos.toTuple()
+                          for particle in manager.frame.group)
+        print("columnar: ", columnar, "rewound cells: ", len(field.cells()),
+              "same as per key: ", positions(managers[0]) ==
+              positions(managers[1]) and
+              dict(managers[0].statistics) == dict(managers[1].statistics))
+
+        # fractional periods are queued and rewound as they are
+        managers[0].backward({(10, 10): 2.5, (60, 60): 1.5})
+        managers[1].queueBackward({(10, 10): 2.5})
+        managers[1].queueBackwardCells(
+            [managers[1].grid.indexOf((60, 60))], 1.5)
+        print("queued: ", sorted(managers[1].effects.depth.flat[
+            managers[1].effects.cells()].tolist()))
+        managers[1].applyEffects()
+        print("fractional lags: ",
+              [managers[1].frame.containers[key].lag()
+               for key in ((10, 10), (60, 60))],
+              "same as backward: ", positions(managers[0]) ==
+              positions(managers[1]))
+
+
+def testLazyRewind():
+    print("===testLazyRewind===")
+    manager = ParticleManager(worldRect=(40, 40), interval=(10, 10))
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.5, 0)))
+    manager.addParticlesToBuffer(
+        [ParticleState(owner=owner, pos=Vec2d((i, 5))) for i in range(0, 40, 5)])
+    manager.commitParticles()
+    for i in range(3):
+        manager.step()
+    before = list(manager.frame.group)
+    removed, restored = manager.frame.backward({(0, 0): 2})
+    kept = [p for p in manager.frame.group if p in before]
+    print("removed: ", len(removed), "restored: ", len(restored),
+          "kept untouched: ", len(kept))
+    print("rewound cell: ", [p.pos.toTuple() for p in restored])
+
+    # particles outside every container are dropped even if no cell rewinds
+    for columnar in (False, True):
+        for getPeriod in ({}, lambda key: 0):
+            manager = ParticleManager(worldRect=(40, 40), interval=(10, 10),
+                                      columnar=columnar)
+            manager.addParticlesToBuffer(
+                [ParticleState(owner=owner, pos=Vec2d((5, 5))),
+                 ParticleState(owner=owner, pos=Vec2d((-15, 5)))])
+            manager.commitParticles()
+            manager.backward(getPeriod)
+            print("columnar: ", columnar, "nothing rewound, left: ",
+                  [p.pos.toTuple() for p in manager.frame.group],
+                  dict(manager.statistics))
+
+
+def testColumnarFrameManager():
+    print("===testColumnarFrameManager===")
+    managers = [ParticleManager(worldRect=(8, 8), interval=(2, 2),
+                                columnar=columnar)
+                for columnar in (False, True)]
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.5, 0.25)))
+    for manager in managers:
+        particles = ParticleGroup()
+        for i in range(0, 8, 2):
+            particles.append(ParticleState(owner=owner, pos=Vec2d((i, 1))))
+        manager.addParticlesToBuffer(particles)
+        manager.commitParticles()
+        for i in range(3):
+            manager.step()
+        manager.backward(lambda key: 2 if key[0] < 4 else 0)
+    groups = [sorted(p.pos.toTuple() for p in manager.frame.group)
+              for manager in managers]
+    print("object path: ", groups[0])
+    print("columnar path: ", groups[1])
+    print("identical: ", groups[0] == groups[1])
+
+
 def testParticleContainer():
     print("===testParticleContainer===")
     container = ParticleContainer(3)
@@ -198,6 +678,247 @@ def testParticleManager():
     return manager
 
 
+def testOwnerStatistics():
+    print("===testOwnerStatistics===")
+    owners = [OwnerTester("a"), OwnerTester("b")]
+    owners[0].setForce(Vec2d((0.5, 0)))
+    for columnar in (False, True):
+        manager = ParticleManager(worldRect=(20, 20), interval=(5, 5),
+                                  columnar=columnar)
+        manager.addParticlesToBuffer(
+            [ParticleState(owner=owners[i % 2], pos=Vec2d((2 * i, i)))
+             for i in range(10)])
+        manager.commitParticles()
+        print("columnar: ", columnar, "after commit: ",
+              dict(manager.statistics))
+        for i in range(4):
+            manager.step()
+        manager.backward(lambda key: 2 if key[0] < 10 else 0)
+        print("after rewind: ", dict(manager.statistics))
+        print("a: ", manager.aggregatesOf(owners[0]))
+        print("cells of b: ",
+              np.flatnonzero(manager.cellCountsOf(owners[1])).tolist())
+        print("cell counts cached for the frame: ",
+              manager.cellCountsOf(owners[1]) is
+              manager.cellCountsOf(owners[1]),
+              "sum to the count: ",
+              [int(manager.cellCountsOf(owner).sum()) ==
+               manager.particleCountOf(owner) for owner in owners])
+
+
+def testManagerSnapshot():
+    print("===testManagerSnapshot===")
+    owner = OwnerTester("tester")
+    owner.setForce(Vec2d((0.5, 0.25)))
+    player = Player("player", None, OwnerTester("core"), (255, 0, 0), (3, 3))
+    for columnar in (False, True):
+        managers = [ParticleManager(worldRect=(20, 20), interval=(5, 5),
+                                    columnar=columnar) for i in range(2)]
+        managers[0].addParticlesToBuffer(
+            [ParticleState(owner=owner, pos=Vec2d((i, i))) for i in range(20)])
+        managers[0].commitParticles()
+        for i in range(5):
+            managers[0].step()
+        managers[0].backward({(5, 5): 2})
+        data = ManagerSnapshot.capture(managers[0], [player]).toBytes()
+        ManagerSnapshot.fromBuffer(data).restore(managers[1], [player],
+                                                 [owner])
+        for manager in managers:
+            manager.step()
+            manager.backward({(10, 10): 3})
+        groups = [sorted(p.pos.toTuple() for p in manager.frame.group)
+                  for manager in managers]
+        print("columnar: ", columnar, "bytes: ", len(data),
+              "restored identically: ", groups[0] == groups[1],
+              dict(managers[1].statistics))
+
+
+def testHeadlessRunner():
+    print("===testHeadlessRunner===")
+    script = InputScript.parse("""
+        # player A moves right and attacks, player B moves up
+        5 down RIGHT
+        30 up RIGHT
+        40 down BACKSLASH
+        41 up BACKSLASH
+        50 down w
+    """)
+    summaries = [HeadlessRunner(script).run(120) for i in range(2)]
+    print(summaries[0])
+    print("deterministic: ", summaries[0] == summaries[1])
+
+
+def testReplay():
+    print("===testReplay===")
+    script = InputScript.parse("""
+        5 down RIGHT
+        30 up RIGHT
+        40 down BACKSLASH
+        41 up BACKSLASH
+    """)
+    runner = HeadlessRunner(script)
+    recorder = ReplayRecorder(runner.controller, seed=1)
+    recorded = runner.run(120)
+    checksum = runner.controller.checksum()
+    data = recorder.replay.toBytes()
+    print("replay of {0} frames in {1} bytes".format(
+        recorder.replay.frames, len(data)))
+    player = ReplayPlayer(Replay.fromBytes(data), keyframeInterval=50)
+    print("played back identically: ", player.play() == recorded,
+          "desync: ", player.desync)
+    player.seek(60)
+    player.seek(120)
+    print("seek back and forth: ",
+          player.runner.controller.checksum() == checksum,
+          "keyframes: ", sorted(player.keyframes))
+
+
+def runLockstep(scripts, frames, latency, tamper=None):
+    ''' two sessions linked in process, packets take latency ticks '''
+    inFlight = []
+    sessions = []
+    for slot in range(2):
+        def send(data, to=1 - slot):
+            inFlight.append((tick + latency, to, data))
+        controller = GameController()
+        controller.verbose = False
+        sessions.append(LockstepSession(controller, slot, send))
+    fed = [0, 0]
+    tick = 0
+    while any(session.confirmed() < frames for session in sessions):
+        for slot, session in enumerate(sessions):
+            while fed[slot] <= session.controller.frame:
+                for event in scripts[slot].eventsAt(fed[slot]):
+                    session.localEvent(event)
+                fed[slot] += 1
+            if session.controller.frame < frames:
+                session.step()
+            else:
+                session.sync()
+        if tamper != None and tamper(sessions[1]):
+            tamper = None
+        tick += 1
+        for packet in [packet for packet in inFlight if packet[0] <= tick]:
+            inFlight.remove(packet)
+            sessions[packet[1]].receive(packet[2])
+    return sessions
+
+
+def testLockstepSession():
+    print("===testLockstepSession===")
+    scripts = [InputScript(), InputScript()]
+    for frame in range(0, 200, 45):
+        scripts[0].press(frame + 3, pygame.K_RIGHT, 12)
+        scripts[0].press(frame + 20, pygame.K_BACKSLASH)
+        scripts[1].press(frame + 9, pygame.K_w, 15)
+        scripts[1].press(frame + 30, pygame.K_SPACE)
+    merged = InputScript()
+    for script in scripts:
+        for frame, eventType, key in [(frame, eventType, key)
+                                      for frame in sorted(script.events)
+                                      for eventType, key in
+                                      script.events[frame]]:
+            merged.add(frame + NET_INPUT_DELAY, eventType, key)
+    local = HeadlessRunner(merged)
+    local.run(200)
+    sessions = runLockstep(scripts, 200, latency=5)
+    for session in sessions:
+        print(session.summary())
+    print("peers agree: ", sessions[0].controller.checksum() ==
+          sessions[1].controller.checksum(),
+          "same as one local game: ",
+          sessions[0].controller.checksum() == local.controller.checksum())
+    print("bandwidth under 1 KB/s: ",
+          all(session.bandwidth() < 1024 for session in sessions))
+
+    def tamper(session):
+        if session.controller.frame < 100:
+            return False
+        session.controller.players["playerB"].friction = 0.5
+        if session.saved != None:  # survive a rollback too
+            session.saved[1][2]["playerB"].friction = 0.5
+        return True
+    sessions = runLockstep(scripts, 200, latency=5, tamper=tamper)
+    print("desync detected at: ", sessions[0].desync, sessions[1].desync)
+    sessions = asyncio.run(loopback(scripts, 100))
+    print("loopback server over UDP, peers agree: ",
+          sessions[0].controller.checksum() ==
+          sessions[1].controller.checksum())
+
+
+def testFrameProfiler():
+    print("===testFrameProfiler===")
+    profiler = FrameProfiler(window=10)
+    profiler.startTrace()
+    for i in range(20):
+        profiler.beginFrame()
+        with profiler.stage("work"):
+            sum(range(1000))
+        profiler.count("items", i)
+        profiler.endFrame()
+    print(profiler.summary())
+    print("trace events: ", len(profiler.trace))
+    print("null profiler: ", NullProfiler().stage("work") != None)
+
+
+def testParticleRenderer():
+    print("===testParticleRenderer===")
+    pygame.display.set_mode((640, 480), 0, 32)
+    player = Player("tester", None, None, (255, 0, 0), (0, 0))
+    frames = []
+    for batch in (False, True):
+        manager = ParticleManager(columnar=batch)
+        manager.addParticlesToBuffer(
+            [ParticleState(owner=player, pos=Vec2d((i * 7.5, i * 3.2)))
+             for i in range(-2, 100)])
+        manager.commitParticles()
+        renderer = ParticleRenderer(manager, batch=batch)
+        renderer.render()
+        manager.step()
+        frames.append(pygame.surfarray.array2d(renderer.render()))
+    print("batch frame identical to draw.circle frame: ",
+          (frames[0] == frames[1]).all())
+
+
+def testResourcePack():
+    print("===testResourcePack===")
+    pygame.display.set_mode((640, 480), 0, 32)
+    pack = ResourcePack(cacheSize=2)
+    print("found: ", sorted(pack.scan()), "loaded: ", list(pack.resources))
+    image = pack.getImage("player")
+    print("lazy loaded, any case: ", image != None, list(pack.resources))
+    print("display format: ",
+          image.get_bitsize() == pygame.display.get_surface().get_bitsize())
+    print("missing image: ", pack.getImage("nothing"))
+    big = pack.getImage("player", scale=2)
+    print("scaled: ", big.get_size(),
+          "cached: ", pack.getImage("player", scale=2) is big)
+    pack.getImage("player", angle=90)
+    pack.getStamp(3, (255, 0, 0))
+    print("evicted least recently used: ",
+          ("image", "player", 2, 0) not in pack.cache, len(pack.cache),
+          "hits: ", pack.hits, "misses: ", pack.misses)
+
+
+def testLayerManager():
+    print("===testLayerManager===")
+    pygame.display.set_mode((640, 480), 0, 32)
+    screens = []
+    for dirty in (False, True):
+        layers = LayerManager(dirtyRects=dirty)
+        layers.getSurface(LayerTag.BACKGROUND).fill((200, 200, 200))
+        screen = pygame.Surface((640, 480))
+        for i in range(3):
+            surface = layers.getSurface(LayerTag.PLAYER, flushed=True)
+            rect = pygame.draw.circle(surface, (255, 0, 0),
+                                      (100 + 50*i, 100), 20)
+            layers.markDirty(LayerTag.PLAYER, rect)
+            rects = layers.renderLayers(screen)
+        print("dirty rects: ", dirty, rects)
+        screens.append(pygame.surfarray.array3d(screen))
+    print("same picture: ", (screens[0] == screens[1]).all())
+
+
 def testGameController():
     print("===testGameController===")
 
@@ -212,20 +933,89 @@ def testGameController():
             if event.type == QUIT:
                 exit()
             controller.dispatchEvent(event)
-        controller.update()
-        pygame.display.update()
+        pygame.display.update(controller.update())
         clock.tick(FPS)
 
 
+class FakeClock():
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def testFrameScheduler():
+    print("===testFrameScheduler===")
+    screen = pygame.display.set_mode((640, 480), 0, 32)
+    for renderTime in (0.002, 0.030):
+        clock = FakeClock()
+        controller = GameController(screen)
+        controller.verbose = False
+        scheduler = FrameScheduler(controller, clock=clock,
+                                   sleep=clock.advance)
+        render = controller.render
+
+        def slowRender(alpha):
+            clock.advance(renderTime)
+            return render(alpha)
+        controller.render = slowRender
+        while clock.now < 2:
+            scheduler.tick()
+            scheduler.wait()
+        print("render {0}ms: ".format(renderTime * 1000), scheduler.summary(),
+              "simulated frames: ", controller.frame)
+    controller.previous = controller.capturePositions()
+    controller.simulate()
+    current = controller.particlePositions()
+    print("interpolation ends: ",
+          (controller.interpolatedPositions(0)[0] ==
+           controller.previous[1]).all(),
+          controller.interpolatedPositions(1)[0] is None)
+    half = controller.interpolatedPositions(0.5)[0]
+    print("half way: ", np.allclose(half * 2,
+                                    controller.previous[1] + current))
+    controller.manager.commitParticles()
+    print("no blending after rows change: ",
+          controller.interpolatedPositions(0.5)[0] is None)
+
+
 def testMain():
     testVec2d()
     testParticleState()
     testParticleGroup()
+    testParticleStore()
+    testForceBatch()
     testParticleContainer()
     testParticleFrameManager()
     testParticleManager()
+    testOwnerStatistics()
+    testParticleLifetime()
+    testInteractions()
+    testManagerSnapshot()
+    testSparseStepping()
+    testCellGrid()
+    testTileStepper()
+    testIntegrators()
+    testFrameHistory()
+    testHistoryStride()
+    testSkillTimers()
+    testTimeField()
+    testColumnarFrameManager()
+    testLazyRewind()
+    testHeadlessRunner()
+    testReplay()
+    testLockstepSession()
+    testFrameProfiler()
 
     pygame.init()
+    testParticleRenderer()
+    testResourcePack()
+    testLayerManager()
+    testFrameScheduler()
     testGameController()
 
     return
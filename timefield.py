@@ -0,0 +1,62 @@
+'''
+Time fields: how far back in time each cell of a CellGrid goes, as a
+(cols, rows) float array of rewind depths in frames (fractions are
+extrapolated from history samples, see FrameHistory). Skills rasterize
+shapes into a field (ring, disk, cone, line) and fields add up, so any
+number of effects cost one rewind pass, ParticleFrameManager.backwardField,
+where cells are found with array operations instead of asking a getPeriod
+callback about every container.
+'''
+import numpy as np
+
+from utils import *
+
+
+class TimeField():
+    '''
+    Rewind depth of every cell of grid. depth is indexed [ix, iy], its
+    flat view by the cell index of grid (ix * rows + iy). Shapes test the
+    key (corner) of cells, like the region queries of CellGrid.
+    '''
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.depth = np.zeros((grid.cols, grid.rows))
+
+    def add(self, cells, depth):
+        ''' add depth to the cells (grid indices, repeats add up) '''
+        np.add.at(self.depth.reshape(-1), np.asarray(cells, dtype=np.int64),
+                  depth)
+        return self
+
+    def merge(self, other):
+        ''' add the depths of another field of the same grid '''
+        self.depth += other.depth
+        return self
+
+    def ring(self, center, inner, outer, depth, manhattan=False):
+        return self.add(self.grid.queryAnnulus(center, inner, outer,
+                                               manhattan), depth)
+
+    def disk(self, center, radius, depth, manhattan=False):
+        return self.add(self.grid.queryCircle(center, radius, manhattan),
+                        depth)
+
+    def cone(self, apex, direction, angle, radius, depth, manhattan=False):
+        ''' angle - full opening in radians, around direction '''
+        return self.add(self.grid.queryCone(apex, direction, angle, radius,
+                                            manhattan), depth)
+
+    def line(self, start, end, width, depth):
+        ''' a stroke of width from start to end, round at both ends '''
+        return self.add(self.grid.querySegment(start, end, width / 2), depth)
+
+    def cells(self):
+        ''' grid indices of cells with a depth '''
+        return np.flatnonzero(self.depth)
+
+    def any(self):
+        return bool(self.depth.any())
+
+    def clear(self):
+        self.depth[:] = 0
@@ -1,11 +1,24 @@
+import bisect
+import copy
+import itertools
+import sys
+from collections import defaultdict, deque
 from math import sin, cos, tan, sqrt
 
+import numpy as np
+
 # size of buffer in one container
 CONTAINER_MAX_LENGTH = 200
 # time slice between two entries in buffer
 # time slice down, accuracy up, cost of space up
 # should be between 0 and 1
 CONTAINER_TIME_SLICE = 1
+# frames between two samples kept in history, frames in between are
+# reconstructed: stride up, memory down, accuracy of rewinds down
+HISTORY_STRIDE = 1
+# bytes of history kept at most, None for no limit
+# (history is also bounded by CONTAINER_MAX_LENGTH frames)
+CONTAINER_HISTORY_BUDGET = None
 
 
 def prettyStrDict(dictionary):
@@ -21,8 +34,19 @@ def optional(val, default):
 
 
 class Vec2d():
-    def __init__(self, pos=(0, 0)):
-        if len(pos) == 2:
+    '''
+    2d vector. Operators return new vectors; the in-place ones
+    (+=, -=, *=, /=, scaledAdd, set) change the vector itself, so only use
+    them on vectors nothing else holds (e.g. the result of an operator).
+    Vec2d(x, y) is the same as Vec2d((x, y)) without packing a tuple.
+    '''
+    __slots__ = ("x", "y")
+
+    def __init__(self, pos=(0, 0), y=None):
+        if y != None:
+            self.x = pos
+            self.y = y
+        elif len(pos) == 2:
             self.x = pos[0]
             self.y = pos[1]
         else:
@@ -30,35 +54,70 @@ class Vec2d():
 
     def __add__(self, other):
         if isinstance(other, Vec2d):
-            return Vec2d((self.x+other.x, self.y+other.y))
-        else:
-            print("error: unsupported vec sum with ", other)
+            return newVec2d(self.x+other.x, self.y+other.y)
+        return NotImplemented
 
     def __sub__(self, other):
         if isinstance(other, Vec2d):
-            return Vec2d((self.x-other.x, self.y-other.y))
-        else:
-            print("error: unsupported vec sub with ", other)
+            return newVec2d(self.x-other.x, self.y-other.y)
+        return NotImplemented
 
     def __mul__(self, other):
         if isinstance(other, Vec2d):
             return self.x*other.x + self.y*other.y
-        elif isinstance(other, int) or isinstance(other, float):
-            return Vec2d((self.x*other, self.y*other))
-        else:
-            print("error: unsupported vec mul with ", other)
+        elif isinstance(other, (int, float)):
+            return newVec2d(self.x*other, self.y*other)
+        return NotImplemented
 
     def __truediv__(self, other):
-        if isinstance(other, int) or isinstance(other, float):
-            return Vec2d((self.x / other, self.y / other))
-        else:
-            print("error: unsupported vec div with ", other)
+        if isinstance(other, (int, float)):
+            return newVec2d(self.x / other, self.y / other)
+        return NotImplemented
+
+    def __iadd__(self, other):
+        if isinstance(other, Vec2d):
+            self.x += other.x
+            self.y += other.y
+            return self
+        return NotImplemented
+
+    def __isub__(self, other):
+        if isinstance(other, Vec2d):
+            self.x -= other.x
+            self.y -= other.y
+            return self
+        return NotImplemented
+
+    def __imul__(self, other):
+        if isinstance(other, (int, float)):
+            self.x *= other
+            self.y *= other
+            return self
+        return NotImplemented
+
+    def __itruediv__(self, other):
+        if isinstance(other, (int, float)):
+            self.x /= other
+            self.y /= other
+            return self
+        return NotImplemented
+
+    def scaledAdd(self, other, scale):
+        ''' self += other * scale in place, returns self '''
+        self.x += other.x * scale
+        self.y += other.y * scale
+        return self
+
+    def set(self, x, y):
+        self.x = x
+        self.y = y
+        return self
 
     def __str__(self):
         return "Vec2d({0},{1})".format(self.x, self.y)
 
     def copy(self):
-        return Vec2d(self.toTuple())
+        return newVec2d(self.x, self.y)
 
     def toInt(self):
         self.x = int(self.x)
@@ -68,7 +127,7 @@ class Vec2d():
         return (self.x, self.y)
 
     def length(self):
-        return sqrt(self.x**2 + self.y**2)
+        return sqrt(self.x*self.x + self.y*self.y)
 
     def dist(self, other):
         return (self - other).length()
@@ -87,9 +146,42 @@ class Vec2d():
         return x1 <= self.x and self.x <= x2 and y1 <= self.x and self.y <= y2
 
 
+def newVec2d(x, y, new=object.__new__):
+    ''' fastest way to build a Vec2d, skips __init__ '''
+    vec = new(Vec2d)
+    vec.x = x
+    vec.y = y
+    return vec
+
+
+class Vec2dPool():
+    '''
+    Scratch vectors: take() hands out vectors until reset() makes all of
+    them available again, so nothing taken may be kept past reset().
+    '''
+
+    def __init__(self, size=8):
+        self.vectors = [Vec2d() for i in range(size)]
+        self.used = 0
+
+    def take(self, x=0, y=0):
+        if self.used == len(self.vectors):
+            self.vectors.append(Vec2d())
+        vec = self.vectors[self.used]
+        self.used += 1
+        vec.x = x
+        vec.y = y
+        return vec
+
+    def reset(self):
+        self.used = 0
+
+
 class ParticleOwnerBase():
     def __init__(self, identity):
         self.identity = identity
+        # frames particles of this owner live, None for no limit
+        self.timeToLive = None
 
     def getForce(self, particle):
         '''
@@ -97,6 +189,27 @@ class ParticleOwnerBase():
         '''
         return Vec2d()
 
+    def getForceBatch(self, positions, velocities, masses):
+        '''
+        return forces for many particles as a (n, 2) array
+        positions, velocities - (n, 2) arrays, masses - (n,) array
+        Falls back to getForce per particle, override to vectorize.
+        '''
+        forces = np.zeros((len(masses), 2))
+        if type(self).getForce is ParticleOwnerBase.getForce:
+            return forces
+        scratch = Vec2dPool(2)
+        for i in range(len(masses)):
+            scratch.reset()
+            particle = ParticleState(
+                owner=self,
+                mass=float(masses[i]),
+                vel=scratch.take(*velocities[i].tolist()),
+                pos=scratch.take(*positions[i].tolist())
+            )
+            forces[i] = self.getForce(particle).toTuple()
+        return forces
+
     def getColor(self, particle):
         '''
         for rendering
@@ -115,6 +228,7 @@ class ParticleState():
     K_ACC = "acc"
     K_VEL = "vel"
     K_POS = "pos"
+    K_BORN = "born"
 
     def __init__(self, **args):
         if "data" in args.keys():
@@ -124,6 +238,7 @@ class ParticleState():
             self.acc = data.get(self.K_ACC, Vec2d())  # Vec2d
             self.vel = data.get(self.K_VEL, Vec2d())  # Vec2d
             self.pos = data.get(self.K_POS, Vec2d())  # Vec2d
+            self.born = data.get(self.K_BORN, 0)  # frame
             return
 
         self.owner = args.get("owner")
@@ -131,6 +246,7 @@ class ParticleState():
         self.acc = args.get("acc", Vec2d())
         self.vel = args.get("vel", Vec2d())
         self.pos = args.get("pos", Vec2d())
+        self.born = args.get("born", 0)
 
     def dump(self):
         data = {}
@@ -139,6 +255,7 @@ class ParticleState():
         data[self.K_ACC] = self.acc
         data[self.K_VEL] = self.vel
         data[self.K_POS] = self.pos
+        data[self.K_BORN] = self.born
         return data
 
     def __str__(self):
@@ -152,22 +269,31 @@ class ParticleState():
         force = Vec2d()
         if self.owner != None:
             force = self.owner.getForce(self)
+        acc = force / self.mass
+        pos, vel = self.pos, self.vel
         state = ParticleState(
             owner=self.owner,
-            pos=self.pos+self.vel*step,
+            pos=newVec2d(pos.x + vel.x*step, pos.y + vel.y*step),
             mass=self.mass,
-            acc=force/self.mass,
-            vel=self.vel+force/self.mass*step
+            acc=acc,
+            vel=newVec2d(vel.x + acc.x*step, vel.y + acc.y*step),
+            born=self.born
         )
         return state
 
 
 class ParticleGroup(list):
 
-    def physicalStepCopy(self, step=1):
+    def physicalStepCopy(self, step=1, integrator=None):
         '''
-        return a copy of all particles with states stepped
+        return a copy of all particles with states stepped,
+        by integrator if given (see integrate.py)
         '''
+        if integrator != None:
+            store = ParticleStore(0)
+            store.extend(self)
+            store.physicalStep(step, integrator)
+            return ParticleGroup(view.toState() for view in store)
         group = ParticleGroup()
         for ele in self:
             group.append(ele.physicalStepCopy(step))
@@ -190,106 +316,1050 @@ class ParticleGroup(list):
             self.append(ParticleState(data=data))
 
 
+class OwnerTable():
+    '''
+    Maps particle owners to the small integers stored in ParticleStore.
+    Stores created by one frame manager share a table.
+    '''
+
+    def __init__(self):
+        self.owners = []
+        self.indices = {}
+
+    def indexOf(self, owner):
+        index = self.indices.get(id(owner))
+        if index == None:
+            index = len(self.owners)
+            self.owners.append(owner)
+            self.indices[id(owner)] = index
+        return index
+
+    def __getitem__(self, index):
+        return self.owners[index]
+
+    def __len__(self):
+        return len(self.owners)
+
+    def __deepcopy__(self, memo):
+        ''' indices are keyed by id, rebuild them for the copied owners '''
+        table = OwnerTable()
+        memo[id(self)] = table
+        for owner in self.owners:
+            table.indexOf(copy.deepcopy(owner, memo))
+        return table
+
+
+class ParticleView():
+    '''
+    ParticleState-compatible view on one row of a ParticleStore.
+    Reading a vector attribute returns a fresh Vec2d,
+    assigning one writes it back to the store.
+    '''
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def owner(self):
+        return self.store.owners[self.store.owner[self.index]]
+
+    @property
+    def mass(self):
+        return float(self.store.mass[self.index])
+
+    @mass.setter
+    def mass(self, value):
+        self.store.mass[self.index] = value
+
+    @property
+    def pos(self):
+        return Vec2d(self.store.pos[self.index].tolist())
+
+    @pos.setter
+    def pos(self, vec):
+        self.store.pos[self.index] = vec.toTuple()
+
+    @property
+    def vel(self):
+        return Vec2d(self.store.vel[self.index].tolist())
+
+    @vel.setter
+    def vel(self, vec):
+        self.store.vel[self.index] = vec.toTuple()
+
+    @property
+    def acc(self):
+        return Vec2d(self.store.acc[self.index].tolist())
+
+    @acc.setter
+    def acc(self, vec):
+        self.store.acc[self.index] = vec.toTuple()
+
+    @property
+    def born(self):
+        return int(self.store.born[self.index])
+
+    @born.setter
+    def born(self, frame):
+        self.store.born[self.index] = frame
+
+    def toState(self):
+        return ParticleState(
+            owner=self.owner,
+            mass=self.mass,
+            acc=self.acc,
+            vel=self.vel,
+            pos=self.pos,
+            born=self.born
+        )
+
+    def dump(self):
+        return self.toState().dump()
+
+    def physicalStepCopy(self, step=1):
+        return self.toState().physicalStepCopy(step)
+
+    def __str__(self):
+        return prettyStrDict(self.dump())
+
+
+class ParticleStore():
+    '''
+    Columnar (structure-of-arrays) particle storage.
+    pos, vel and acc are (n, 2) float arrays, mass is a float array,
+    owner holds indices into an OwnerTable and born the frame every
+    particle was spawned in.
+    Offers the ParticleGroup API; iterating yields ParticleView objects.
+    Columns are allocated ahead (see reserve) and removed rows are filled
+    from the end (see remove), so spawning and despawning reuse the same
+    arrays once they are large enough.
+    '''
+    COLUMNS = ("pos", "vel", "acc", "mass", "owner", "born")
+
+    def __init__(self, capacity=16, owners=None):
+        self.owners = optional(owners, OwnerTable())
+        self.size = 0
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.acc = np.zeros((capacity, 2))
+        self.mass = np.zeros(capacity)
+        self.owner = np.zeros(capacity, dtype=np.int32)
+        self.born = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield ParticleView(self, i)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError("particle index out of range")
+        return ParticleView(self, index)
+
+    def columns(self):
+        ''' live part of every column, in a fixed order '''
+        n = self.size
+        return (self.pos[:n], self.vel[:n], self.acc[:n],
+                self.mass[:n], self.owner[:n], self.born[:n])
+
+    def reserve(self, capacity):
+        if capacity <= len(self.mass):
+            return
+        capacity = max(capacity, 2 * len(self.mass))
+        n = self.size
+        for name in self.COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def append(self, particle):
+        ''' append a ParticleState (or anything that looks like one) '''
+        self.reserve(self.size + 1)
+        i = self.size
+        self.pos[i] = particle.pos.toTuple()
+        self.vel[i] = particle.vel.toTuple()
+        self.acc[i] = particle.acc.toTuple()
+        self.mass[i] = particle.mass
+        self.owner[i] = self.owners.indexOf(particle.owner)
+        self.born[i] = particle.born
+        self.size += 1
+
+    def appendBatch(self, owner, pos, vel, mass, born=0):
+        '''
+        append particles of one owner from (n, 2) pos / vel and (n,) mass
+        arrays, their acceleration starts at zero
+        '''
+        count = len(mass)
+        self.reserve(self.size + count)
+        n = self.size
+        self.pos[n:n+count] = pos
+        self.vel[n:n+count] = vel
+        self.acc[n:n+count] = 0
+        self.mass[n:n+count] = mass
+        self.owner[n:n+count] = self.owners.indexOf(owner)
+        self.born[n:n+count] = born
+        self.size += count
+
+    def remove(self, rows):
+        '''
+        remove rows (int array), in time proportional to their number:
+        each hole left below the new end takes a surviving row from the
+        end of the store, so the order of the other rows changes
+        '''
+        rows = np.unique(rows)
+        end = self.size - len(rows)
+        holes = rows[rows < end]
+        tail = np.arange(end, self.size)
+        movers = tail[~np.isin(tail, rows)]
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            column[holes] = column[movers]
+        self.size = end
+
+    def extend(self, particles):
+        if not isinstance(particles, ParticleStore):
+            for particle in particles:
+                self.append(particle)
+            return
+        n, m = self.size, particles.size
+        self.reserve(n + m)
+        pos, vel, acc, mass, owner, born = particles.columns()
+        self.pos[n:n+m] = pos
+        self.vel[n:n+m] = vel
+        self.acc[n:n+m] = acc
+        self.mass[n:n+m] = mass
+        self.born[n:n+m] = born
+        if particles.owners is self.owners:
+            self.owner[n:n+m] = owner
+        else:
+            remap = np.array([self.owners.indexOf(ele)
+                              for ele in particles.owners.owners],
+                             dtype=np.int32)
+            self.owner[n:n+m] = remap[owner]
+        self.size += m
+
+    @classmethod
+    def concat(cls, groups, owners=None):
+        '''
+        build one store out of stores and ParticleGroups,
+        stores sharing the owner table are joined without a python loop
+        '''
+        store = cls(0, owners)
+
+        def shared(group):
+            return isinstance(group, ParticleStore) \
+                and group.owners is store.owners
+
+        stores = [group for group in groups
+                  if shared(group) and len(group) > 0]
+        if len(stores) > 0:
+            for index, name in enumerate(cls.COLUMNS):
+                setattr(store, name, np.concatenate(
+                    [group.columns()[index] for group in stores]))
+            store.size = len(store.mass)
+        for group in groups:
+            if not shared(group):
+                store.extend(group)
+        return store
+
+    def take(self, indices):
+        ''' return a compact copy of the given rows '''
+        store = ParticleStore(0, self.owners)
+        pos, vel, acc, mass, owner, born = self.columns()
+        store.pos = pos[indices]
+        store.vel = vel[indices]
+        store.acc = acc[indices]
+        store.mass = mass[indices]
+        store.owner = owner[indices]
+        store.born = born[indices]
+        store.size = len(store.mass)
+        return store
+
+    def slice(self, start, stop):
+        '''
+        return a store sharing rows [start, stop) with self (no copy).
+        Only used on frozen snapshots, never on the live store.
+        '''
+        store = ParticleStore(0, self.owners)
+        store.pos = self.pos[start:stop]
+        store.vel = self.vel[start:stop]
+        store.acc = self.acc[start:stop]
+        store.mass = self.mass[start:stop]
+        store.owner = self.owner[start:stop]
+        store.born = self.born[start:stop]
+        store.size = stop - start
+        return store
+
+    def nbytes(self):
+        ''' bytes of the live rows '''
+        return sum(column.nbytes for column in self.columns())
+
+    def copy(self):
+        store = self.slice(0, self.size)
+        for name in self.COLUMNS:
+            setattr(store, name, getattr(store, name).copy())
+        return store
+
+    def clear(self):
+        self.size = 0
+
+    def getForces(self):
+        '''
+        force on every particle as a (n, 2) array.
+        Particles are grouped by owner and each owner is asked once
+        through getForceBatch, owners only defining getForce are asked
+        once per particle.
+        '''
+        pos, vel, acc, mass, owner, born = self.columns()
+        return self._forcesOf(range(self.size), pos, vel, mass, owner)
+
+    def _forcesOf(self, rows, pos, vel, mass, owner):
+        ''' getForces for the given rows, other arguments are their columns '''
+        forces = np.zeros((len(mass), 2))
+        for index in np.flatnonzero(np.bincount(owner)).tolist():
+            ownerObj = self.owners[index]
+            if ownerObj == None:
+                continue
+            selected = np.flatnonzero(owner == index)
+            if hasattr(ownerObj, "getForceBatch"):
+                forces[selected] = ownerObj.getForceBatch(
+                    pos[selected], vel[selected], mass[selected])
+            else:
+                for i in selected.tolist():
+                    forces[i] = ownerObj.getForce(ParticleState(
+                        owner=ownerObj,
+                        mass=float(mass[i]),
+                        pos=Vec2d(pos[i].tolist()),
+                        vel=Vec2d(vel[i].tolist()),
+                        acc=Vec2d(self.acc[rows[i]].tolist()),
+                        born=int(self.born[rows[i]])
+                    )).toTuple()
+        return forces
+
+    def accelerationOf(self, rows):
+        '''
+        accel(pos, vel) for integrators: acceleration of the given rows
+        at trial positions and velocities
+        '''
+        mass, owner = self.mass[rows], self.owner[rows]
+
+        def accel(pos, vel):
+            return self._forcesOf(rows, pos, vel, mass, owner) / mass[:, None]
+        return accel
+
+    def physicalStep(self, step=1, integrator=None):
+        '''
+        step all particles in place, by integrator if given (see
+        integrate.py), else by the same (linear) scheme as
+        ParticleState.physicalStepCopy
+        '''
+        pos, vel, acc, mass, owner, born = self.columns()
+        if integrator != None:
+            pos[:], vel[:], acc[:] = integrator.integrate(
+                pos, vel, acc, self.accelerationOf(np.arange(self.size)),
+                step)
+            return
+        force = self.getForces()
+        acc[:] = force / mass[:, None]
+        pos += vel * step
+        vel += acc * step
+
+    def physicalStepRows(self, rows, step=1, integrator=None):
+        '''
+        physicalStep for the given rows (an int array) only, with the
+        same results. Steps of disjoint rows may run in parallel.
+        '''
+        pos, vel, acc, mass, owner, born = self.columns()
+        if integrator != None:
+            pos[rows], vel[rows], acc[rows] = integrator.integrate(
+                pos[rows], vel[rows], acc[rows], self.accelerationOf(rows),
+                step)
+            return
+        rowPos, rowVel, rowMass = pos[rows], vel[rows], mass[rows]
+        force = self._forcesOf(rows, rowPos, rowVel, rowMass, owner[rows])
+        rowAcc = force / rowMass[:, None]
+        acc[rows] = rowAcc
+        pos[rows] = rowPos + rowVel * step
+        vel[rows] = rowVel + rowAcc * step
+
+    def physicalStepCopy(self, step=1, integrator=None):
+        ''' ParticleGroup API '''
+        store = self.copy()
+        store.physicalStep(step, integrator)
+        return store
+
+    def dump(self):
+        return [view.dump() for view in self]
+
+    def additiveLoad(self, listdata):
+        for data in listdata:
+            self.append(ParticleState(data=data))
+
+
+def stateBytes(state):
+    ''' approximate memory held by a ParticleState '''
+    size = sys.getsizeof(state) + sys.getsizeof(state.__dict__)
+    for vec in (state.pos, state.vel, state.acc):
+        size += sys.getsizeof(vec)  # slots, no __dict__
+    return size
+
+
+PARTICLE_STATE_BYTES = stateBytes(ParticleState())
+
+
+def groupBytes(group):
+    ''' approximate memory held by a group of particles '''
+    if isinstance(group, ParticleStore):
+        return group.nbytes()
+    return sys.getsizeof(group) + len(group) * PARTICLE_STATE_BYTES
+
+
+def advanceGroup(group, time):
+    '''
+    copy of a group moved by time frames (negative: back in time), every
+    particle keeping its acceleration; how history fills in frames
+    between samples
+    '''
+    if isinstance(group, ParticleStore):
+        store = group.copy()
+        pos, vel, acc, mass, owner, born = store.columns()
+        pos += vel * time + acc * (0.5 * time * time)
+        vel += acc * time
+        return store
+    return ParticleGroup(ParticleState(
+        owner=particle.owner,
+        mass=particle.mass,
+        acc=particle.acc,
+        pos=particle.pos + particle.vel * time +
+        particle.acc * (0.5 * time * time),
+        vel=particle.vel + particle.acc * time,
+        born=particle.born
+    ) for particle in group)
+
+
+class FrameHistory():
+    '''
+    History of particle groups shared by the containers of a frame manager.
+    Every sample is one entry mapping container keys to the group occupying
+    them, so empty containers cost nothing. A sample is kept every stride
+    frames, frames in between are reconstructed from the nearest sample
+    (see groupAt), so frames may also be fractional. The oldest samples
+    are evicted when they span more than maxFrames frames or when they
+    hold more than budget bytes (None: no byte limit).
+    With a CellGrid the entries holding every cell are also counted in
+    cellFrames, so cells with history are found without visiting keys.
+    '''
+
+    def __init__(self, maxFrames=None, budget=None, stride=None, grid=None):
+        self.maxFrames = optional(maxFrames, CONTAINER_MAX_LENGTH)
+        self.budget = optional(budget, CONTAINER_HISTORY_BUDGET)
+        self.stride = optional(stride, HISTORY_STRIDE)
+        self.grid = grid
+        self.frame = 0
+        self.entries = deque()  # (entry, bytes) of samples, oldest first
+        self.samples = deque()  # frame of every entry
+        self.entryCells = deque()  # grid indices of the keys of every entry
+        self.bytes = 0
+        self.keyFrames = defaultdict(int)  # key -> entries holding it
+        # cell index -> entries holding it, keyFrames by grid
+        self.cellFrames = None if grid == None else \
+            np.zeros(grid.count, dtype=np.int64)
+        self.pending = {}  # entry for the next frame
+        self.clear()
+
+    def oldest(self):
+        return self.samples[0]
+
+    def clear(self):
+        ''' forget all frames but keep counting, the next one is sampled '''
+        self.entries.clear()
+        self.samples.clear()
+        self.entryCells.clear()
+        self.keyFrames.clear()
+        if self.grid != None:
+            self.cellFrames[:] = 0
+        self.bytes = 0
+        self.append({}, self.frame - self.stride + 1, 0)
+
+    def append(self, entry, frame, size):
+        ''' keep entry as the sample of frame, after the others '''
+        if len(self.entries) > 0 and self.entries[-1][0] is entry:
+            # the same entry kept for several frames is counted once,
+            # on its newest copy, so it is freed with the last one
+            size = self.entries[-1][1]
+            self.entries[-1] = (entry, 0)
+        else:
+            self.bytes += size
+        self.entries.append((entry, size))
+        self.samples.append(frame)
+        for key in entry:
+            self.keyFrames[key] += 1
+        if self.grid != None:
+            # an entry kept for several frames is indexed once
+            if len(self.entryCells) > 0 and self.entries[-2][0] is entry:
+                cells = self.entryCells[-1]
+            else:
+                cells = self.grid.indexOfKeys(entry)
+            self.entryCells.append(cells)
+            np.add.at(self.cellFrames, cells, 1)
+
+    def sampling(self, delta=1):
+        ''' whether commit(delta) keeps a sample '''
+        return self.frame + delta >= self.samples[-1] + self.stride
+
+    def commit(self, delta=1):
+        '''
+        the pending entry becomes the next delta frames, kept as a sample
+        of the frames due for one (pending is dropped when none is)
+        '''
+        entry = self.pending
+        self.pending = {}
+        size = sys.getsizeof(entry) + \
+            sum(groupBytes(group) for group in entry.values())
+        first = max(self.frame + 1, self.samples[-1] + self.stride,
+                    self.frame + delta - self.maxFrames + 1)
+        for frame in range(first, self.frame + delta + 1, self.stride):
+            self.append(entry, frame, size)
+        self.frame += delta
+        while self.samples[-1] - self.samples[0] >= self.maxFrames:
+            self.evict()
+        while self.budget != None and self.bytes > self.budget \
+                and len(self.entries) > 1:
+            self.evict()
+        return entry
+
+    def evict(self):
+        entry, size = self.entries.popleft()
+        self.samples.popleft()
+        if self.grid != None:
+            np.subtract.at(self.cellFrames, self.entryCells.popleft(), 1)
+        self.bytes -= size
+        for key in entry:
+            self.keyFrames[key] -= 1
+            if self.keyFrames[key] == 0:
+                del self.keyFrames[key]
+
+    def nearestSample(self, frame):
+        ''' index of the sample closest to frame (the earlier on ties) '''
+        index = bisect.bisect_right(self.samples, frame)
+        if index == 0:
+            return 0
+        if index == len(self.samples) or \
+                frame - self.samples[index - 1] <= self.samples[index] - frame:
+            return index - 1
+        return index
+
+    def groupAt(self, frame, key):
+        '''
+        group of the key at the frame, empty if not recorded.
+        Between samples the group of the nearest one is moved by the time
+        in between (see advanceGroup): particles crossing into the
+        container meanwhile are missing.
+        '''
+        if frame < self.oldest() or frame > self.frame:
+            return ParticleGroup()
+        index = self.nearestSample(frame)
+        group = self.entries[index][0].get(key)
+        if group == None:
+            return ParticleGroup()
+        if frame == self.samples[index]:
+            return group
+        return advanceGroup(group, frame - self.samples[index])
+
+    def memoryReport(self):
+        frames = len(self.entries)
+        depth = self.frame - self.oldest()
+        return {
+            "frames": frames,
+            "rewindDepth": depth,
+            "stride": self.stride,
+            "bytes": self.bytes,
+            "bytesPerSample": self.bytes / frames,
+            "bytesPerFrame": self.bytes / max(1, depth),
+            "budget": self.budget,
+            "keys": len(self.keyFrames)
+        }
+
+
 class ParticleContainer():
     '''
-    Container maintains history of particle group at one place
+    Container maintains history of particle group at one place.
+    Groups are kept in a FrameHistory, shared with other containers when
+    history is given (a container creates its own otherwise, and advances
+    it in updateToNext). The container only maps its own timeline onto
+    history frames; the two differ once the container went backward.
     '''
 
-    def __init__(self, maxlength=None):
+    def __init__(self, maxlength=None, history=None, key=None):
         self.maxLength = CONTAINER_MAX_LENGTH
         if maxlength != None:
             self.maxLength = maxlength
         self.timeSlice = CONTAINER_TIME_SLICE
-        self.groups = []
-        self.cptr = 0
-        for i in range(self.maxLength):
-            self.groups.append(ParticleGroup())
-        self.nextGroup = ParticleGroup()
+        self.ownsHistory = history == None
+        self.history = optional(history, FrameHistory(self.maxLength))
+        self.key = key
+        # (localStart, lag) pairs, oldest first:
+        # local frame L >= localStart of the last matching pair
+        # is history frame L + lag
+        self.segments = []
+
+    def lag(self):
+        if len(self.segments) == 0:
+            return 0
+        return self.segments[-1][1]
+
+    def historyFrame(self, local):
+        for localStart, lag in reversed(self.segments):
+            if local >= localStart:
+                return local + lag
+        return local
 
     def currentGroup(self):
-        return self.groups[self.cptr]
+        local = self.history.frame - self.lag()
+        return self.history.groupAt(self.historyFrame(local), self.key)
 
     def addNextParticle(self, particle):
-        self.nextGroup.append(particle)
+        group = self.history.pending.get(self.key)
+        if group == None:
+            group = ParticleGroup()
+            self.history.pending[self.key] = group
+        group.append(particle)
+
+    def addNextGroup(self, group):
+        '''
+        add a whole group (ParticleGroup or ParticleStore slice),
+        the group is kept as it is when nothing else was added
+        '''
+        pending = self.history.pending.get(self.key)
+        if pending == None:
+            self.history.pending[self.key] = group
+        else:
+            pending.extend(group)
 
     def updateToNext(self, period=1):
-        delta = int(period / self.timeSlice)
-        delta = min(delta, self.maxLength)
-        for i in range(delta):
-            self.cptr = (self.cptr + 1) % self.maxLength
-            self.groups[self.cptr] = self.nextGroup
-        self.nextGroup = ParticleGroup()
+        '''
+        only for a container owning its history,
+        shared history is advanced by the frame manager
+        '''
+        if self.ownsHistory:
+            self.history.commit(int(period / self.timeSlice))
 
     def backward(self, period):
-        delta = int(period / self.timeSlice)
+        ''' go back period (a float is fine) in the container timeline '''
+        delta = period / self.timeSlice
         delta = min(delta, self.maxLength)
-        for i in range(delta):
-            self.groups[self.cptr] = ParticleGroup()
-            self.cptr = (self.cptr - 1 + self.maxLength) % self.maxLength
+        if delta <= 0:
+            return
+        frame = self.history.frame
+        local = frame - self.lag() - delta
+        while len(self.segments) > 0 and self.segments[-1][0] > local:
+            self.segments.pop()
+        self.segments.append((local + 1, frame - local))
+        # drop pairs only mapping to evicted frames
+        oldest = self.history.oldest()
+        while len(self.segments) > 1 and \
+                self.segments[1][0] + self.segments[0][1] <= oldest:
+            self.segments.pop(0)
 
     def flush(self):
-        for i in range(self.maxLength):
-            self.groups[i] = ParticleGroup()
+        if self.ownsHistory:
+            self.history.clear()
+        self.segments = []
 
     def detailPrinter(self):
-        print("buffered group count: ", len(self.groups))
+        print("buffered group count: {0}, lag: {1}".format(
+            len(self.history.entries), self.lag()))
         group = self.currentGroup()
         print("current group size: {0}".format(len(group)))
         for ele in group:
             print(ele)
 
 
+class CellGrid():
+    '''
+    Regular grid of cells covering a world rect of given intervals.
+    Cells are addressed by an integer index, ix * rows + iy, so per-cell
+    data fits in flat arrays. The key of a cell is its corner
+    (ix * interX, iy * interY), as used for containers.
+    Region queries test cell keys and return the indices of the cells
+    inside as a sorted int array, visiting only cells near the region.
+    '''
+
+    def __init__(self, worldRect, interval):
+        self.rangeX, self.rangeY = worldRect
+        self.interX, self.interY = interval
+        self.cols = -(-self.rangeX // self.interX)
+        self.rows = -(-self.rangeY // self.interY)
+        self.count = self.cols * self.rows
+
+    def indexOf(self, key):
+        ''' index of the cell with the key, -1 if there is none '''
+        ix, restX = divmod(key[0], self.interX)
+        iy, restY = divmod(key[1], self.interY)
+        if restX != 0 or restY != 0 or not \
+                (0 <= ix < self.cols and 0 <= iy < self.rows):
+            return -1
+        return int(ix) * self.rows + int(iy)
+
+    def keyOf(self, index):
+        ix, iy = divmod(int(index), self.rows)
+        return (ix * self.interX, iy * self.interY)
+
+    def keysOf(self, indices):
+        ix, iy = np.divmod(np.asarray(indices, dtype=np.int64), self.rows)
+        return list(zip((ix * self.interX).tolist(),
+                        (iy * self.interY).tolist()))
+
+    def indexOfKeys(self, keys):
+        ''' indexOf for a collection of keys, keys of no cell left out '''
+        keys = np.fromiter(itertools.chain.from_iterable(keys), np.int64,
+                           2 * len(keys)).reshape(-1, 2)
+        ix, restX = np.divmod(keys[:, 0], self.interX)
+        iy, restY = np.divmod(keys[:, 1], self.interY)
+        valid = (restX == 0) & (restY == 0) & (ix >= 0) & \
+            (ix < self.cols) & (iy >= 0) & (iy < self.rows)
+        return (ix * self.rows + iy)[valid]
+
+    def keys(self):
+        return self.keysOf(range(self.count))
+
+    def indexBatch(self, positions):
+        '''
+        cell index of every row of a (n, 2) position array, -1 outside.
+        Positions are truncated like ParticleManager.getKey does.
+        '''
+        ix = np.trunc(positions[:, 0] / self.interX)
+        iy = np.trunc(positions[:, 1] / self.interY)
+        inside = (ix >= 0) & (ix < self.cols) & (iy >= 0) & (iy < self.rows)
+        return np.where(inside, ix * self.rows + iy, -1).astype(np.int64)
+
+    def _window(self, x1, y1, x2, y2):
+        ''' indices, key x and key y of cells with keys in the bounds '''
+        ix1 = max(0, int(np.ceil(x1 / self.interX)))
+        ix2 = min(self.cols - 1, int(np.floor(x2 / self.interX)))
+        iy1 = max(0, int(np.ceil(y1 / self.interY)))
+        iy2 = min(self.rows - 1, int(np.floor(y2 / self.interY)))
+        if ix1 > ix2 or iy1 > iy2:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        ix, iy = np.meshgrid(np.arange(ix1, ix2 + 1, dtype=np.int64),
+                             np.arange(iy1, iy2 + 1, dtype=np.int64),
+                             indexing="ij")
+        ix, iy = ix.ravel(), iy.ravel()
+        return ix * self.rows + iy, ix * self.interX, iy * self.interY
+
+    def _distances(self, center, radius, manhattan):
+        x, y = center
+        indices, keyX, keyY = self._window(
+            x - radius, y - radius, x + radius, y + radius)
+        dx, dy = x - keyX, y - keyY
+        if manhattan:
+            return indices, np.abs(dx) + np.abs(dy)
+        return indices, np.sqrt(dx * dx + dy * dy)
+
+    def queryRect(self, boundA, boundB):
+        ''' cells with keys inside the rect of two corners (inclusive) '''
+        x1, x2 = sorted((boundA[0], boundB[0]))
+        y1, y2 = sorted((boundA[1], boundB[1]))
+        return self._window(x1, y1, x2, y2)[0]
+
+    def queryCircle(self, center, radius, manhattan=False):
+        ''' cells with keys closer than radius to center '''
+        indices, dist = self._distances(center, radius, manhattan)
+        return indices[dist < radius]
+
+    def queryAnnulus(self, center, inner, outer, manhattan=False):
+        ''' cells with keys farther than inner and closer than outer '''
+        indices, dist = self._distances(center, outer, manhattan)
+        return indices[(dist > inner) & (dist < outer)]
+
+    def queryCone(self, apex, direction, angle, radius, manhattan=False):
+        '''
+        cells with keys closer than radius to apex, at most angle / 2
+        (radians) away from direction seen from apex
+        '''
+        x, y = apex
+        indices, keyX, keyY = self._window(
+            x - radius, y - radius, x + radius, y + radius)
+        dx, dy = keyX - x, keyY - y
+        euclidean = np.sqrt(dx * dx + dy * dy)
+        dist = np.abs(dx) + np.abs(dy) if manhattan else euclidean
+        length = np.hypot(direction[0], direction[1])
+        along = (dx * direction[0] + dy * direction[1]) / length
+        inside = along >= np.cos(angle / 2) * euclidean
+        return indices[inside & (dist < radius)]
+
+    def querySegment(self, start, end, radius):
+        ''' cells with keys closer than radius to the segment start-end '''
+        (x1, y1), (x2, y2) = start, end
+        indices, keyX, keyY = self._window(
+            min(x1, x2) - radius, min(y1, y2) - radius,
+            max(x1, x2) + radius, max(y1, y2) + radius)
+        ex, ey = x2 - x1, y2 - y1
+        dx, dy = keyX - x1, keyY - y1
+        length = ex * ex + ey * ey
+        t = np.zeros(len(indices)) if length == 0 else \
+            np.clip((dx * ex + dy * ey) / length, 0, 1)
+        dx, dy = dx - t * ex, dy - t * ey
+        return indices[dx * dx + dy * dy < radius * radius]
+
+
 def findContainerKeyDefault(particle):
     return particle.pos.copy().toInt().toTuple()
 
 
 class ParticleFrameManager():
-    def __init__(self, getKey=None):
-        self.group = ParticleGroup()
+    '''
+    Steps particles and distributes them to containers by key.
+    columnar - keep live particles in a ParticleStore, stepped in place.
+    In this mode getKeyBatch(positions) may be provided, returning two
+    int arrays (key x, key y) so that particles are distributed without
+    per-particle calls to getKey.
+    historyBudget - bytes of history to keep at most (see FrameHistory)
+    historyStride - frames between two samples of history (see
+    FrameHistory), particles are only handed to containers when sampled
+    grid - CellGrid matching getKey; containers are then also addressed
+    by cell index and columnar particles are distributed by it.
+    stepper - optional object stepping the store in columnar mode through
+    physicalStep(store, step, integrator), e.g. a parallel TileStepper.
+    integrator - steps particles (see integrate.py), explicit Euler if None
+    Only containers holding particles somewhere in history are visited.
+    '''
+
+    def __init__(self, getKey=None, columnar=False, historyBudget=None,
+                 grid=None, historyStride=None):
+        self.columnar = columnar
+        self.owners = OwnerTable()
+        self.group = self.newGroup()
         self.containers = {}
+        self.grid = grid
+        # cell index -> container, None for cells without one
+        self.cells = [] if grid == None else [None] * grid.count
+        # cell index -> has a container, one more False for no cell (-1)
+        self.hasContainer = np.zeros(len(self.cells) + 1, dtype=bool)
+        self.stepper = None
+        self.integrator = None
+        self.history = FrameHistory(budget=historyBudget,
+                                    stride=historyStride, grid=grid)
+        self.rewound = {}  # key -> container with its own timeline
+        self.timeSlice = CONTAINER_TIME_SLICE
+        self.getKeyBatch = None
         if getKey == None:
             self.getKey = findContainerKeyDefault
         else:
             self.getKey = getKey
 
+    def newGroup(self):
+        if self.columnar:
+            return ParticleStore(owners=self.owners)
+        return ParticleGroup()
+
     def createContainer(self, key):
-        container = ParticleContainer()
+        container = ParticleContainer(history=self.history, key=key)
         self.containers[key] = container
+        if self.grid != None and self.grid.indexOf(key) >= 0:
+            self.cells[self.grid.indexOf(key)] = container
+            self.hasContainer[self.grid.indexOf(key)] = True
         return container
 
+    def activeContainers(self):
+        ''' (key, container) pairs holding particles somewhere in history '''
+        for key in list(self.history.keyFrames.keys()):
+            container = self.containers.get(key)
+            if container != None:
+                yield key, container
+
     def step(self, physical=True):
         '''
         step forward and distribute particles to containers
         '''
-        if physical:
-            self.group = self.group.physicalStepCopy()
+        delta = int(1 / self.timeSlice)
+        # frames between samples of history are not handed to containers
+        sampling = self.history.sampling(delta)
+        if self.columnar:
+            self._stepColumnar(physical, sampling)
+        else:
+            if physical:
+                self.group = self.group.physicalStepCopy(
+                    integrator=self.integrator)
 
-        for particle in self.group:
-            key = self.getKey(particle)
-            if not key in self.containers.keys():
-                # createContainer(key)
-                continue
-            self.containers[key].addNextParticle(particle)
+            for particle in self.group if sampling else ():
+                key = self.getKey(particle)
+                container = self.containers.get(key)
+                if container == None:
+                    # createContainer(key)
+                    continue
+                container.addNextParticle(particle)
 
-        for container in self.containers.values():
-            container.updateToNext()
+        self.history.commit(delta)
+
+    def _stepColumnar(self, physical, sampling=True):
+        '''
+        step the store in place, then hand each container a slice of
+        one frozen, key-sorted snapshot of the frame
+        '''
+        store = self.group
+        if physical and self.stepper != None:
+            self.stepper.physicalStep(store, integrator=self.integrator)
+        elif physical:
+            store.physicalStep(integrator=self.integrator)
+        if len(store) == 0 or not sampling:
+            return
+        if self.grid != None:
+            cells = self.grid.indexBatch(store.columns()[0])
+            order = np.argsort(cells, kind="stable")
+            cells = cells[order]
+            starts = np.concatenate(
+                ([0], np.flatnonzero(cells[1:] != cells[:-1]) + 1))
+            stops = np.concatenate((starts[1:], [len(order)]))
+            snapshot = store.take(order)
+            for cell, start, stop in zip(cells[starts].tolist(),
+                                         starts, stops):
+                container = self.cells[cell] if cell >= 0 else None
+                if container != None:
+                    container.addNextGroup(snapshot.slice(start, stop))
+            return
+        if self.getKeyBatch != None:
+            keyX, keyY = self.getKeyBatch(store.columns()[0])
+            order = np.lexsort((keyY, keyX))
+            keyX, keyY = keyX[order], keyY[order]
+            bounds = np.flatnonzero(
+                (keyX[1:] != keyX[:-1]) | (keyY[1:] != keyY[:-1])) + 1
+            starts = np.concatenate(([0], bounds))
+            stops = np.concatenate((bounds, [len(order)]))
+            keys = zip(keyX[starts].tolist(), keyY[starts].tolist())
+        else:
+            byKey = {}
+            for particle in store:
+                key = self.getKey(particle)
+                byKey.setdefault(key, []).append(particle.index)
+            sizes = [len(indices) for indices in byKey.values()]
+            order = np.array(sum(byKey.values(), []), dtype=np.intp)
+            stops = np.cumsum(sizes, dtype=np.intp)
+            starts = stops - sizes
+            keys = byKey.keys()
+        snapshot = store.take(order)
+        for key, start, stop in zip(keys, starts, stops):
+            container = self.containers.get(key)
+            if container == None:
+                continue
+            container.addNextGroup(snapshot.slice(start, stop))
 
     def backward(self, getPeriod):
         '''
         step backward according to the given function
-        getPeriod(key) should return a period of int/float
+        getPeriod(key) should return a period of int/float,
+        it may also be a dict key -> period (keys left out: 0), then only
+        its keys are visited.
+        Only rewound containers are read back from history: the live
+        particles of other containers are kept as they are (particles
+        outside every container are dropped).
+        return (removed, restored): live particles taken out and
+        particles read back from history
         '''
-        groupNext = ParticleGroup()
-        for key, container in self.containers.items():
-            period = getPeriod(key)
+        if isinstance(getPeriod, dict):
+            periods = [(key, period) for key, period in getPeriod.items()
+                       if period > 0 and key in self.containers
+                       and key in self.history.keyFrames]
+        else:
+            periods = [(key, getPeriod(key))
+                       for key, container in self.activeContainers()]
+        return self.rewind(periods)
+
+    def backwardField(self, depth):
+        '''
+        step backward by a depth for every cell of grid, a flat or
+        (cols, rows) array, 0 for cells kept (see TimeField).
+        Cells to rewind are found and live particles sorted out with
+        array operations, only rewound containers are visited.
+        return (removed, restored) like backward
+        '''
+        depth = np.asarray(depth).ravel()
+        cells = np.flatnonzero((depth > 0) & (self.history.cellFrames > 0) &
+                               self.hasContainer[:-1])
+        periods = zip(self.grid.keysOf(cells), depth[cells].tolist())
+        return self.rewind(periods, cells)
+
+    def rewind(self, periods, cells=None):
+        '''
+        rewind containers by (key, period) pairs, cells being their grid
+        indices when known; return (removed, restored)
+        '''
+        restored = []
+        rewoundKeys = set()
+        for key, period in periods:
             if period > 0:
+                container = self.containers[key]
                 container.backward(period)
-            groupNext.extend(container.currentGroup())
-        self.group = groupNext
+                self.rewound[key] = container
+                rewoundKeys.add(key)
+                restored.append(container.currentGroup())
+        keep = self.keepMask(rewoundKeys, cells)
+        if len(rewoundKeys) == 0 and keep.all():
+            return self.newGroup(), self.newGroup()
+        if self.columnar:
+            live = self.group
+            removed = live.take(np.flatnonzero(~keep))
+            restored = ParticleStore.concat(restored, self.owners)
+            self.group = ParticleStore.concat(
+                [live.take(np.flatnonzero(keep)), restored], self.owners)
+        else:
+            live = self.group
+            removed = ParticleGroup(p for p, k in zip(live, keep) if not k)
+            self.group = ParticleGroup(p for p, k in zip(live, keep) if k)
+            restored = ParticleGroup(p for group in restored for p in group)
+            self.group.extend(restored)
+        return removed, restored
+
+    def keepMask(self, rewoundKeys, rewoundCells=None):
+        '''
+        bool array, True for live particles staying through a rewind of
+        the given keys: those in a container that did not rewind.
+        rewoundCells - grid indices of the keys, when known
+        '''
+        if self.columnar and self.grid != None:
+            cells = self.grid.indexBatch(self.group.columns()[0])
+            keep = self.hasContainer.copy()
+            if rewoundCells is None:
+                rewoundCells = [self.grid.indexOf(key) for key in rewoundKeys]
+            keep[rewoundCells] = False
+            return keep[cells]
+        if self.columnar and self.getKeyBatch != None:
+            keyX, keyY = self.getKeyBatch(self.group.columns()[0])
+            keys = zip(keyX.tolist(), keyY.tolist())
+        else:
+            keys = (self.getKey(particle) for particle in self.group)
+        return np.array([key in self.containers and key not in rewoundKeys
+                         for key in keys], dtype=bool)
+
+    def spawn(self, particles):
+        ''' add particles to the live group, history is kept '''
+        self.group.extend(particles)
+
+    def despawn(self, rows):
+        ''' remove live particles by row (int array), return them '''
+        if self.columnar:
+            removed = self.group.take(rows)
+            self.group.remove(rows)
+            return removed
+        dead = set(np.asarray(rows).tolist())
+        removed = ParticleGroup(self.group[i] for i in sorted(dead))
+        self.group = ParticleGroup(p for i, p in enumerate(self.group)
+                                   if i not in dead)
+        return removed
 
     def flushAndAddParticles(self, particles):
-        for container in self.containers.values():
+        self.history.clear()
+        for container in self.rewound.values():
             container.flush()
+        self.rewound.clear()
         self.group.extend(particles)
         self.step(physical=False)
 